@@ -4,10 +4,17 @@ import numpy as np
 import pandas as pd
 import pandas.io.sql
 import logging
+import hashlib
+import itertools
+import json
+import os
 import random, re
 import sys
 import sqlite3
+import threading
+import time
 import traceback
+from collections import OrderedDict
 
 #logging.basicConfig(filename='example.log',level=logging.DEBUG)
 #logging.debug('This message should go to the log file')
@@ -15,6 +22,11 @@ import traceback
 #logging.warning('And this, too')
 
 from timeit import default_timer as currentTime
+import cachetools # pip install cachetools
+try:
+  import scipy.sparse as sparse
+except ImportError: # the shape dictionaries are then stored as dense matrices
+  sparse = None
 import six
 from six.moves import range
 def timefn(func): 
@@ -22,7 +34,7 @@ def timefn(func):
       '''source: http://www.daniweb.com/code/snippet368.html'''
       _start = currentTime()
       res = func(*arg, **kw)
-      print('%s took %0.3f seconds' % (func.__name__,currentTime() - _start))
+      querystats.total(func.__name__,currentTime() - _start)
       return res
   return wrapper
 
@@ -92,9 +104,28 @@ def parseSource(argStr):
 
   return {name:cols}
 
+def parseJoin(name):
+  ''' Parse the source name 'source*other@key*another@myKey=theirKey' of a /s/ query into 
+  ('source',[('other','key','key'),('another','myKey','theirKey')]), the first source and the sources joined to it'''
+  parts = name.split('*')
+  joins = []
+  for part in parts[1:]:
+    other,at,keys = part.partition('@')
+    if keys == '': raise ValueError('No @key to join %s on in %s' % (other,name))
+    myKey,eq,theirKey = keys.partition('=')
+    joins.append((other,myKey,theirKey if theirKey != '' else myKey))
+  return parts[0],joins
+
+# precompiled patterns for the /f/ filter language
+PAREN_PATTERN    = re.compile(r'(\(|\))')
+BOOLEAN_PATTERN  = re.compile(r'(&|\||\^|\+)') # & or | or ^ or + where ^ + each mean the same thing as &
+OPERATOR_PATTERN = re.compile("(!?=?=|!?<=?|!?>=?|!?'isnull'|!?'in')")
+BRACKET_PATTERN  = re.compile(r'[\[\]]')
+IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_]\w*') # candidate column names in eval and formula expressions
+
 def parseFilters(fStr,expandFilters=False):
   if fStr is None: return None
-  parenSections = re.split('(\(|\))',fStr)
+  parenSections = PAREN_PATTERN.split(fStr)
   # get rid of emptys created by leading, trailing nad sequential matching elements 
   parenSections = [x for x in parenSections if x != '']
   parenSections.insert(0,'(')
@@ -107,7 +138,7 @@ def parseFilters(fStr,expandFilters=False):
 def parseFilter(fStr):
   # operators include >,>=,<,<=,'in','isnull',= and can all be negated with !
   #print( re.split("(!?=?=|!?<=?|!?>=?|!?'isnull'|!?'in')",fStr) )
-  (featureName,opr,val) = re.split("(!?=?=|!?<=?|!?>=?|!?'isnull'|!?'in')",fStr)
+  (featureName,opr,val) = OPERATOR_PATTERN.split(fStr)
   inverseSelection = opr[0] == '!'    
   if inverseSelection: opr = opr[1:]
   return { 'featureName' : featureName, 'operator' : opr, 'value' : val, 'negate' : inverseSelection }
@@ -131,81 +162,285 @@ def processFilterGroup(pieces,idx=0):
   raise ValueError('Unbalanced parens:' + str(pieces))
 
 def splitFilterBoolean(fStr):
-  pieces = re.split('(&|\||\^|\+)',fStr) # & or | or ^ or + where ^ + each mean the same thing as &
+  pieces = BOOLEAN_PATTERN.split(fStr) # & or | or ^ or + where ^ + each mean the same thing as &
   pieces = [x for x in pieces if x != '']
   #print pieces
   return pieces
 
-def runFilters(df,filters,cache=None):
-  DEBUG = False
-  ands = [0] + [i+1 for i, x in enumerate(filters) if x == '&' or x == '^' or x == '+']
-  ors  = [i+1 for i, x in enumerate(filters) if x == '|']
-  
-  subset = None
-  if DEBUG: print('ANDs:')
-  for a in ands:
-    fltr = filters[a]
-    if type(fltr) == list:
-      subs = runFilters(df,fltr,cache)
-    else: 
-      if DEBUG: print(('    ' + str(fltr)))
-      subs = runFilter(df,fltr,cache)
-    if subset is None: subset = subs
-    else: subset = subset & subs
-    
-  if DEBUG: print('ORs:')
-  for o in ors:
-    fltr = filters[o]
-    if type(fltr) == list:
-      subs = runFilters(df,fltr,cache)
-    else: 
-      if DEBUG: print(('    ' + str(fltr)))
-      subs = runFilter(df,fltr,cache)
-    subset = subset | subs
-  return subset
-
-def runFilter(df,fltr,cache=None):
-  DEBUG = False
-  cacheKey = '%d_%s' % (id(df),fltr)
-  try:    # if there is no cache, this will fail and the remaining code will execute
-    cachedResult = cache.get(cacheKey)
-    #print cachedResult
-    if cachedResult is not None: 
-      #print 'Found cached data for %s' % cacheKey
-      cache[cacheKey] = cachedResult # HACK to reset the TTL for the entry in a potentially expiring cache
-      return cachedResult            # guart clause returns if result was in cache
-  except AttributeError as e: pass
+AND_OPERATORS    = ('&','^','+')
+RANGE_OPERATORS  = { '>' : np.greater, '>=' : np.greater_equal, '<' : np.less, '<=' : np.less_equal }
 
+def clauseNode(fltr):
+  '''Parse a single filter clause like kw_mean>1.0 or zip5'in'[94611,93304] into a normalized clause node, 
+     ('clause', canonical string, feature name, operator, value, negate), with the value pre-converted for its operator.
+     Clauses that differ only in whitespace, '=' vs '==', or the order of their 'in' list produce the same node.'''
   fMap = parseFilter(fltr)
-  featureName      = fMap['featureName']
-  opr              = fMap['operator']
-  val              = fMap['value']
-  inverseSelection = fMap['negate']
-  
-  feature = df[featureName]
-  if   opr == '>'        : subset = feature >  float(val)
-  elif opr == '>='       : subset = feature >= float(val)
-  elif opr == '<'        : subset = feature <  float(val)
-  elif opr == '<='       : subset = feature <= float(val)
-  elif opr == '=' or opr == '==' : 
-    try   :                subset = feature == val
-    except:                subset = feature == float(val)
-  elif opr == "'isnull'" : subset = feature.isnull()
-  elif opr == "'in'"     : 
-    # string ( or [ brackets and split on ',' to create a list of one or more.
-    argList = re.sub('[\[\]]','',val).split(',') # note that this will produce a list of strings
-    subset = feature.isin(argList)
+  featureName = fMap['featureName'].strip()
+  opr         = fMap['operator']
+  val         = fMap['value'].strip()
+  negate      = fMap['negate']
+  if   opr in RANGE_OPERATORS: 
+    value = float(val)
+    text  = repr(value)
+  elif opr == '=' or opr == '==':
+    opr   = '='
+    value = val
+    text  = val
+  elif opr == "'isnull'": 
+    value = None
+    text  = ''
+  elif opr == "'in'":
+    # strip ( or [ brackets and split on ',' to create a list of one or more.
+    value = tuple(sorted(set([v.strip() for v in BRACKET_PATTERN.sub('',val).split(',')]))) # note that these are strings
+    text  = '[%s]' % ','.join(value)
   else: 
     raise ValueError('Unrecognized filter criteria %s' % fltr)
-  if inverseSelection: subset = np.logical_not(subset)
-  before = len(df.index)
-  if DEBUG: print(('filter: %d -> %d' % (before,sum(subset))))
-  try:    
-    cache[cacheKey] = subset
-    print('Cached result at %s' % cacheKey)
-  except: pass
+  return ('clause', '%s%s%s%s' % (featureName, '!' if negate else '', opr, text), featureName, opr, value, negate)
+
+def rangeNode(featureName,clauses):
+  '''Collapse the range clauses ANDed together on one feature into a single interval node, 
+     ('range', canonical string, feature name, lo, lo inclusive, hi, hi inclusive), keeping the tightest bounds.'''
+  lo,loInclusive,hi,hiInclusive = None,False,None,False
+  for clause in clauses:
+    opr,value = clause[3],clause[4]
+    if opr in ('>','>='):
+      if lo is None or value > lo or (value == lo and opr == '>'): lo,loInclusive = value,(opr == '>=')
+    else:
+      if hi is None or value < hi or (value == hi and opr == '<'): hi,hiInclusive = value,(opr == '<=')
+  text = []
+  if lo is not None: text.append('%s%s%r' % (featureName,'>=' if loInclusive else '>',lo))
+  if hi is not None: text.append('%s%s%r' % (featureName,'<=' if hiInclusive else '<',hi))
+  return ('range', '&'.join(text), featureName, lo, loInclusive, hi, hiInclusive)
+
+def booleanNode(kind,children):
+  '''Build a normalized 'and' or 'or' node: nested nodes of the same kind are flattened, duplicates dropped and 
+     the children sorted, so equivalent filters written in a different clause order produce the same node.
+     Range clauses ANDed together on the same feature, like a (lo < x < hi) pair, become a single interval.'''
+  flat = set()
+  for child in children:
+    if child[0] == kind: flat.update(child[1])
+    else:                flat.add(child)
+  if kind == 'and':
+    ranges = {}
+    for child in flat:
+      if child[0] == 'clause' and child[3] in RANGE_OPERATORS and not child[5]: 
+        ranges.setdefault(child[2],[]).append(child)
+    for featureName,clauses in ranges.items():
+      if len(clauses) < 2: continue
+      flat.difference_update(clauses)
+      flat.add(rangeNode(featureName,clauses))
+  if len(flat) == 1: return flat.pop()
+  return (kind, tuple(sorted(flat,key=repr)))
+
+def filterNode(filters):
+  '''Convert the nested list produced by parseFilters into a normalized tree of hashable nodes.
+     Within each (paren) group all the &/^/+ terms are ANDed together and the | terms are then ORed onto the result.'''
+  def node(f):
+    if type(f) == list: return filterNode(f)
+    return clauseNode(f)
+  ands = [filters[0]] + [filters[i+1] for i, x in enumerate(filters) if x in AND_OPERATORS]
+  ors  = [filters[i+1] for i, x in enumerate(filters) if x == '|']
+  root = booleanNode('and',[node(f) for f in ands])
+  if len(ors) > 0: root = booleanNode('or',[root] + [node(f) for f in ors])
+  return root
+
+def rangeMask(df,featureName,lo,loInclusive,hi,hiInclusive,srcIndexes=None):
+  '''Compute the boolean mask of the rows with featureName values within the bounds, using the sorted 
+     index of the column if it has one and otherwise comparing the whole column'''
+  idx = srcIndexes.sorted(featureName) if srcIndexes is not None else None
+  if idx is not None: return idx.rangeMask(lo,loInclusive,hi,hiInclusive)
+  vals = df[featureName].values
+  subset = None
+  with np.errstate(invalid='ignore'): # NaN comparisons are simply False
+    if lo is not None: subset = RANGE_OPERATORS['>=' if loInclusive else '>'](vals,lo)
+    if hi is not None: 
+      subs = RANGE_OPERATORS['<=' if hiInclusive else '<'](vals,hi)
+      subset = subs if subset is None else np.logical_and(subset,subs,out=subset)
+  return np.asarray(subset,dtype=bool)
+
+def clauseMask(df,node,srcIndexes=None):
+  '''Compute the boolean mask for a single clause node directly over the raw numpy array of the column'''
+  kind,text,featureName,opr,value,negate = node
+  if opr in RANGE_OPERATORS:
+    isLo = opr in ('>','>=')
+    subset = rangeMask(df,featureName,value if isLo else None,opr == '>=',None if isLo else value,opr == '<=',srcIndexes)
+    if negate: subset = np.logical_not(subset)
+    return subset
+  idx = srcIndexes.category(featureName) if srcIndexes is not None else None
+  if idx is not None: # answer from the row lists of the category index
+    if   opr == '=':        subset = idx.mask([value])
+    elif opr == "'in'":     subset = idx.mask(value)
+    elif opr == "'isnull'": subset = idx.nullMask()
+    if negate: subset = np.logical_not(subset)
+    return subset
+  vals = df[featureName].values
+  numeric = vals.dtype.kind in 'biuf'
+  with np.errstate(invalid='ignore'): # NaN comparisons are simply False
+    if opr == '=':
+      if numeric:
+        try:    subset = vals == float(value)
+        except ValueError: subset = np.zeros(len(vals),dtype=bool) # a non-numeric value never equals a number
+      else:     subset = vals == value
+    elif opr == "'isnull'": 
+      subset = pd.isnull(vals)
+    elif opr == "'in'":
+      if numeric:
+        nums = []
+        for v in value:
+          try:    nums.append(float(v))
+          except ValueError: pass
+        subset = np.isin(vals,nums)
+      else: 
+        subset = pd.Series(vals).isin(value).values
+  subset = np.asarray(subset,dtype=bool)
+  if negate: subset = np.logical_not(subset)
   return subset
 
+class FilterPlan(object):
+  '''A compiled, normalized filter tree that can be evaluated against any version of a source.
+     Each clause mask is looked up in, or computed and stored into, the cache and the masks are combined
+     in place with numpy boolean operations over whole arrays, with no pandas index alignment.
+     If the indexes of the source are provided, range clauses are answered from its sorted column indexes and
+     = and 'in' clauses from its category indexes.'''
+  def __init__(self,root):
+    self.root = root
+
+  def evaluate(self,df,cache=None,version=None,srcIndexes=None):
+    return self.evalNode(self.root,df,cache,version if version is not None else id(df),srcIndexes)
+
+  def evalNode(self,node,df,cache,version,srcIndexes=None):
+    if node[0] in ('clause','range'):
+      cacheKey = (version, node[1])
+      try:    # if there is no cache, this will fail and the remaining code will execute
+        cachedResult = cache.get(cacheKey)
+        if cachedResult is not None: return cachedResult # guard clause returns if result was in cache
+      except AttributeError as e: pass
+      if node[0] == 'range': subset = rangeMask(df,*node[2:],srcIndexes=srcIndexes)
+      else:                  subset = clauseMask(df,node,srcIndexes)
+      try:    cache[cacheKey] = subset
+      except TypeError: pass
+      return subset
+    combine = np.logical_and if node[0] == 'and' else np.logical_or
+    subset = None
+    owned  = False # masks that came from a cache can't be modified in place
+    for child in node[1]:
+      subs = self.evalNode(child,df,cache,version,srcIndexes)
+      if   subset is None: subset = subs
+      elif owned:          combine(subset,subs,out=subset)
+      else: 
+        subset = combine(subset,subs)
+        owned  = True
+    return subset
+
+  def __repr__(self):
+    return 'FilterPlan(%r)' % (self.root,)
+
+# compiled plans, keyed on the filter text, and the plans themselves interned by their normalized tree 
+# so that equivalent filters share one plan
+FILTER_PLAN_CACHE_SIZE = 256
+planCache     = cachetools.LRUCache(maxsize=FILTER_PLAN_CACHE_SIZE)
+planByNode    = cachetools.LRUCache(maxsize=FILTER_PLAN_CACHE_SIZE)
+planCacheLock = threading.Lock()
+
+def compileFilters(filters):
+  '''Compile a filter string or the nested list form produced by parseFilters into a (cached) FilterPlan'''
+  if isinstance(filters,six.string_types): 
+    key = filters
+  else: 
+    key = json.dumps(filters)
+  with planCacheLock:
+    plan = planCache.get(key)
+  querystats.hit('filterPlans',plan is not None)
+  if plan is not None: return plan
+  if isinstance(filters,six.string_types): filters = parseFilters(filters)
+  root = filterNode(filters)
+  with planCacheLock:
+    plan = planByNode.get(root)
+    if plan is None:
+      plan = FilterPlan(root)
+      planByNode[root] = plan
+    planCache[key] = plan
+  return plan
+
+def filterFeatures(filters):
+  '''The set of feature names tested by the filters'''
+  features = set()
+  if filters is None: return features
+  pending = [compileFilters(filters).root]
+  while len(pending) > 0:
+    node = pending.pop()
+    if node[0] in ('clause','range'): features.add(node[2])
+    else:                             pending.extend(node[1])
+  return features
+
+def normalizeFilter(fltr):
+  '''Return a canonical string form of a single filter clause, so equivalent clauses that differ only in 
+     surrounding whitespace or the order of their 'in' list share one cache entry.'''
+  return clauseNode(fltr)[1]
+
+class MaskCache(object):
+  '''Process wide LRU cache of boolean filter masks, shared by every session and thread.
+     Masks are stored bit packed (1 bit per row) and the least recently used entries are evicted 
+     once the packed masks exceed maxBytes. Keys are (source version token, normalized filter clause) tuples.'''
+  def __init__(self,maxBytes):
+    self.maxBytes  = maxBytes
+    self.nBytes    = 0
+    self.entries   = OrderedDict() # key -> (packed bits, mask length) in least to most recently used order
+    self.lock      = threading.Lock()
+    self.hits      = 0
+    self.misses    = 0
+    self.evictions = 0
+
+  def get(self,key,default=None):
+    with self.lock:
+      entry = self.entries.pop(key,None)
+      querystats.hit('masks',entry is not None)
+      if entry is None:
+        self.misses += 1
+        return default
+      self.entries[key] = entry # re-insert as the most recently used
+      self.hits += 1
+    packed,n = entry
+    return np.unpackbits(packed)[:n].view(bool)
+
+  def __setitem__(self,key,mask):
+    packed = np.packbits(np.asarray(mask,dtype=bool))
+    with self.lock:
+      old = self.entries.pop(key,None)
+      if old is not None: self.nBytes -= old[0].nbytes
+      if packed.nbytes > self.maxBytes: return # never going to fit
+      self.entries[key] = (packed,len(mask))
+      self.nBytes += packed.nbytes
+      while self.nBytes > self.maxBytes:
+        oldKey,(oldPacked,oldN) = self.entries.popitem(last=False) # evict the least recently used
+        self.nBytes -= oldPacked.nbytes
+        self.evictions += 1
+
+  def purge(self,version):
+    '''Drop every cached mask computed against the given source version token'''
+    with self.lock:
+      for key in [k for k in self.entries if k[0] == version]:
+        self.nBytes -= self.entries.pop(key)[0].nbytes
+
+  def stats(self):
+    with self.lock:
+      return { 'hits'      : self.hits, 
+               'misses'    : self.misses, 
+               'evictions' : self.evictions,
+               'entries'   : len(self.entries), 
+               'bytes'     : self.nBytes, 
+               'maxBytes'  : self.maxBytes }
+
+def runFilters(df,filters,cache=None,version=None,srcIndexes=None):
+  '''Compute the boolean mask (as a numpy array) selecting the rows of df that match the parsed filters.
+     If a cache is provided, clause masks are stored in and looked up from it keyed on the version token of the source
+     (falling back to id(df) if no version is given) and the normalized filter clause.'''
+  return compileFilters(filters).evaluate(df,cache,version,srcIndexes)
+
+def runFilter(df,fltr,cache=None,version=None):
+  '''Compute the boolean mask selecting the rows of df that match the single filter clause fltr'''
+  return FilterPlan(clauseNode(fltr)).evaluate(df,cache,version)
+
 def parseDesc(path,expandFilters=False):
   # first allow for escaping of queries
   pieces = path.split('/')
@@ -222,9 +457,10 @@ def parseDesc(path,expandFilters=False):
     'desc'        : pullNext( pieces,'desc' ),
     'histogram'   : histSplit( pullNext( pieces,'hist' ) ),
     'cumsum'      : pull( pieces,'cum' ),
+    'approx'      : pull( pieces,'approx' ),  # approximate /bin/ quantiles
     'colInfo'     : pull( pieces,'colInfo' ),
     'colList'     : pull( pieces,'colList' ),
-    'fmt'         : pullNext( pieces,'fmt' ),   # json or csv
+    'fmt'         : pullNext( pieces,'fmt' ),   # json, csv or npy
   }
   # backwards compatability. 
   if queryParams['filter'] is None: 
@@ -232,29 +468,170 @@ def parseDesc(path,expandFilters=False):
     if queryParams['filter'] is not None: print('Warning: parsed filter with deprecated /f2/ name. These can be changes to /f/')
   return queryParams
 
-import pandas.core.algorithms
-
 def quantileStats(df,col,n):
   '''Split data into n bins with roughly equal numbers of members in each bin (i.e. split into n quantiles)
-     return the min and max value of each quantile keyed by the bin range for each.'''
-  # cut the column by quantile to get the boindaries of the equal sized bins
-  # TODO: this chokes if there are so many values in a bin that there is more than one edge with the same value
-  bins = pandas.core.algorithms.quantile(df[col],np.linspace(0, 1, n+1))
-  #print bins
-  #bins = pd.qcut(df[col],n,retbins=True)[1]
-  bins[0] = bins[0] - 0.001 # the bins are (low,high], but we need to include the low value, 
-                            # so we adjust the left edge of the first bin to include it
-  bins = sorted(set(bins))  # because we are doing quantiles, it is possible to get duplicate bins
-  #print bins
-  groups = df.groupby(pandas.cut(df[col], bins))
-  mn = groups.min()[col]
-  qstats = pd.DataFrame(mn)
-  qstats.index.name = 'bin_bounds'
-  qstats.columns = ['min']
-  qstats['max']   = groups.max()[col]
-  qstats['count'] = groups.count()[col]
-  qstats = qstats[~np.isnan(qstats['min'])]
-  return qstats
+     return the min and max value of each quantile keyed by the bin range for each. See quantiles.py.'''
+  vals = np.asarray(df[col].values,dtype=float)
+  return quantiles.exactBins(np.sort(vals[~np.isnan(vals)]),n)
+
+def sortedQuantileStats(srcIndexes,col,n,subset=None):
+  '''quantileStats of col over the rows selected by the subset mask (or all rows) from the SortedIndex of the 
+     column, or None if it has none'''
+  idx = srcIndexes.sorted(col) if srcIndexes is not None else None
+  if idx is None: return None
+  vals = idx.values[:idx.nValid]
+  if subset is not None: vals = vals[np.asarray(subset)[idx.order[:idx.nValid]]] # still in sorted order
+  return quantiles.exactBins(vals,n)
+
+HISTOGRAM_BINS  = 100   # the bins of the filter panel histograms, precomputed for every numeric column
+HISTOGRAM_CHUNK = 16384 # rows binned at a time by histogramCounts, which keeps each chunk of rows in cache
+
+def histogramRange(vals,rng=None):
+  '''The (min,max) range np.histogram bins vals over, given rng or the range of the finite values'''
+  if rng is None:
+    lo,hi = (np.fmin.reduce(vals),np.fmax.reduce(vals)) if len(vals) > 0 else (0.0,1.0) # ignoring NaNs
+    if not (np.isfinite(lo) and np.isfinite(hi)): # Inf values, or nothing but NaNs
+      finite = vals[np.isfinite(vals)]
+      lo,hi = (finite.min(),finite.max()) if len(finite) > 0 else (0.0,1.0)
+    lo,hi = float(lo),float(hi)
+  else:
+    lo,hi = float(rng[0]),float(rng[1])
+  if lo == hi: lo,hi = lo - 0.5,hi + 0.5
+  return lo,hi
+
+def histogramCounts(columns,bins,ranges,rows=None,chunk=HISTOGRAM_CHUNK):
+  '''Bin several columns (arrays of the same length) in one pass, each into its number of bins over its range
+     (or None for the range of its values), counting only the rows at the positions in rows (or all of them).
+     The rows are visited a chunk at a time and every column of the chunk is binned before moving on: the bin 
+     of each value is computed by arithmetic on the range of its column and tallied by bincount. NaN and Inf 
+     values are skipped. Returns a list of (counts,edges) like np.histogram.'''
+  columns = [np.asarray(vals) for vals in columns]
+  nRows   = len(rows) if rows is not None else (len(columns[0]) if len(columns) > 0 else 0)
+  edges   = []
+  for vals,n,rng in zip(columns,bins,ranges):
+    if rng is not None:   lo,hi = histogramRange(None,rng)
+    elif rows is None:    lo,hi = histogramRange(vals.astype(float,copy=False))
+    else:                 lo,hi = histogramRange(vals[rows].astype(float,copy=False))
+    edges.append(np.linspace(lo,hi,n + 1))
+  counts = [np.zeros(len(e) - 1,dtype=np.int64) for e in edges]
+  for start in range(0,nRows,chunk):
+    chunkRows = slice(start,start + chunk) if rows is None else rows[start:start + chunk]
+    for vals,e,binCounts in zip(columns,edges,counts):
+      n = len(e) - 1
+      v = vals[chunkRows]
+      if v.dtype != np.float64: v = v.astype(float)
+      inRange = (v >= e[0]) & (v <= e[-1]) # no NaN, no Inf and nothing out of range
+      if not inRange.all(): v = v[inRange]
+      f = v - e[0]
+      f *= n / (e[-1] - e[0])
+      idx = f.astype(np.intp)
+      np.minimum(idx,n - 1,out=idx)        # the last bin is closed
+      idx -= v < e[idx]                    # correct for rounding against the edges, as np.histogram does
+      idx += (v >= e[idx + 1]) & (idx != n - 1)
+      binCounts += np.bincount(idx,minlength=n)
+  return list(zip(counts,edges))
+
+def histogramFrame(counts,edges):
+  histdf = pd.DataFrame(counts,columns=['counts'])
+  histdf['bin_min'] = edges[:len(edges)-1] # the leading edge of each bin is the first through second to last of the bin edges
+  histdf['bin_max'] = edges[1:]            # the trailing edge of each bin is the second through last of the bin edges
+  return histdf
+
+def histogram(values,n,rng=None):
+  '''Bin a column of values into n equal width bins spanning rng=(min,max), or the range of the data if rng is None.
+     Returns a DataFrame with the counts and the bin_min and bin_max edges of each bin.'''
+  return histogramFrame(*histogramCounts([values.values],[n],[rng])[0]) # NaN and Inf values are skipped
+
+def numericColumns(df):
+  return [col for col in df.columns if df[col].dtype.kind in 'iuf']
+
+def supersetHistograms(sourceName,columns=None):
+  '''The unfiltered HISTOGRAM_BINS bin histograms of the numeric columns (or just the given columns) of 
+     sourceName over the whole range of their values, keyed by column. They are computed in one pass over the
+     source, once per version, and must be treated as read only.'''
+  df,version,srcIndexes = DataSource().getLoaded(sourceName,columns)
+  if columns is None: columns = numericColumns(df)
+  def build(df,missing):
+    numeric = [col for col in missing if col in df.columns and df[col].dtype.kind in 'iuf']
+    hists = histogramCounts([df[col].values for col in numeric],[HISTOGRAM_BINS] * len(numeric),[None] * len(numeric))
+    out = dict([(col,None) for col in missing]) # so the other columns aren't looked at again
+    out.update([(col,histogramFrame(*hist)) for col,hist in zip(numeric,hists)])
+    return out
+  hists = srcIndexes.extend(('superset',HISTOGRAM_BINS),columns,build)
+  return dict([(col,hists[col]) for col in columns if hists.get(col) is not None])
+
+def supersetHistogram(sourceName,col,n,rng=None):
+  '''A copy of the unfiltered histogram of col if it was asked for with the precomputed bins and range, or None'''
+  if n != HISTOGRAM_BINS: return None
+  histdf = supersetHistograms(sourceName,[col]).get(col)
+  if histdf is not None and rng is not None and histogramRange(None,rng) != (histdf['bin_min'].iloc[0],histdf['bin_max'].iloc[-1]): 
+    histdf = None
+  querystats.hit('histograms',histdf is not None)
+  if histdf is None: return None
+  return histdf.copy()
+
+def leaveOneOutMasks(masks):
+  '''Given k boolean masks, return the k combinations that AND together all but one of them, where
+     element i is the AND of every mask except masks[i] (or None if there are no other masks).
+     Prefix and suffix running ANDs are used so that building all k combinations takes O(k) mask operations.'''
+  k = len(masks)
+  prefix = [None] * (k + 1) # prefix[i] is masks[0] & ... & masks[i-1]
+  suffix = [None] * (k + 1) # suffix[i] is masks[i] & ... & masks[k-1]
+  for i in range(k):
+    prefix[i+1] = masks[i] if prefix[i] is None else prefix[i] & masks[i]
+  for i in range(k-1,-1,-1):
+    suffix[i] = masks[i] if suffix[i+1] is None else masks[i] & suffix[i+1]
+  out = []
+  for i in range(k):
+    before,after = prefix[i],suffix[i+1]
+    if   before is None: out.append(after)
+    elif after  is None: out.append(before)
+    else:                out.append(before & after)
+  return out
+
+def leaveOneOutHistograms(sourceName,filters,hists,cache=None):
+  '''Compute a batch of crossfilter histograms over sourceName in one pass.
+     filters is a list of /f/ filter strings and hists is a list of dicts like
+     { 'column' : 'kw_mean', 'bins' : 100, 'domain' : [0,10], 'exclude' : 0 }
+     where each histogram is filtered by every filter except filters[exclude] (exclude defaults to the
+     position of the histogram in the list and can be -1 or None to apply all of the filters).
+     The mask of each filter is computed once and shared by all the histograms.'''
+  if cache is None: cache = DataSource.maskCache
+  columns = set([h['column'] for h in hists])
+  for f in filters: columns.update(filterFeatures(f))
+  laps = querystats.Laps()
+  df,version,srcIndexes = DataSource().getLoaded(sourceName,sorted(columns))
+  laps.lap('load')
+  masks = [compileFilters(f).evaluate(df,cache,version,srcIndexes) for f in filters]
+  looMasks = leaveOneOutMasks(masks)
+  laps.lap('filter')
+  groups = {} # the positions of the histograms that share each subset, which are binned together
+  for i,h in enumerate(hists):
+    exclude = h.get('exclude',i)
+    if exclude is None or exclude < 0 or exclude >= len(masks): exclude = -1 # apply all of the filters
+    groups.setdefault(exclude,[]).append(i)
+  out = [None] * len(hists)
+  for exclude,positions in groups.items():
+    if exclude >= 0:
+      subset = looMasks[exclude]
+    else:
+      subset = None
+      for m in masks:
+        subset = m if subset is None else subset & m
+    binned = []
+    for i in positions:
+      h = hists[i]
+      domain = h.get('domain',None)
+      rng = ( float(domain[0]),float(domain[1]) ) if domain is not None else None
+      if subset is None: out[i] = supersetHistogram(sourceName,h['column'],int(h.get('bins',10)),rng)
+      if out[i] is None: binned.append((i,int(h.get('bins',10)),rng))
+    if len(binned) == 0: continue
+    rows = None if subset is None else np.flatnonzero(subset)
+    counts = histogramCounts([df[hists[i]['column']].values for i,n,rng in binned],
+                             [n for i,n,rng in binned],[rng for i,n,rng in binned],rows)
+    for (i,n,rng),hist in zip(binned,counts): out[i] = histogramFrame(*hist)
+  laps.lap('hist')
+  return out
 
 def histSplit(s):
   if s is None: return s
@@ -269,9 +646,203 @@ def histSplit(s):
 def restQuery(qs,cache=None):
   return executeQuery(parseDesc(qs),cache)
 
+def queryColumns(query,cols):
+  '''The columns of a source that a parsed query reads (from its column list cols), or None for all of them'''
+  if cols is None or cols[0] is None: return None
+  columns = set()
+  for col in cols:
+    evalExpr = re.findall('eval\((.*)\)',col)
+    if len(evalExpr) > 0: columns.update(IDENTIFIER_PATTERN.findall(evalExpr[0])) # names that aren't columns are ignored
+    else:                 columns.add(col)
+  columns.update(filterFeatures(query.get('filter')))
+  if query.get('aggregator') is not None: columns.update(query['aggregator'].keys())
+  for key in ('asc','desc'):
+    if query.get(key) is not None: columns.add(query[key])
+  return sorted(columns)
+
+DERIVED = 'derived' # the name of the column computed by an eval(...) column expression
+
+def lookupValues(vals,rows):
+  '''The values at positions rows, with missing values where rows is -1 as a left merge would have them'''
+  missing = rows < 0
+  if not missing.any(): return vals[rows]
+  if len(vals) == 0: return np.full(len(rows),np.nan)
+  out = vals[np.where(missing,0,rows)]
+  if   out.dtype.kind in 'biu': out = out.astype(float)
+  elif out.dtype.kind in 'SUV': out = out.astype(object)
+  out[missing] = out.dtype.type('NaT') if out.dtype.kind in 'mM' else np.nan
+  return out
+
+def joinColumns(df,srcIndexes,joins,columns=None):
+  '''The columns of the sources joined to the loaded df by joins (see parseJoin) that df doesn't have itself, out 
+     of columns or all of them, as an OrderedDict of the values of each column and the row of its source that 
+     matches each row of df (-1 for none), along with a token for the version of each joined source. The matching
+     rows are looked up in the KeyIndex of the joined source once per version of the two sources, so joining the
+     rows of a query is a gather of just those rows rather than a merge.'''
+  lookups  = OrderedDict()
+  versions = []
+  for other,myKey,theirKey in joins:
+    wanted = None if columns is None else [c for c in columns if c not in df.columns and c not in lookups] + [theirKey]
+    odf,oversion,oIndexes = DataSource().getLoaded(other,wanted)
+    rows = srcIndexes.derived(('join',other,oversion,myKey,theirKey),lambda d: oIndexes.keys(theirKey).lookup(d[myKey].values))
+    for col in odf.columns:
+      if col not in df.columns and col not in lookups: lookups[col] = (odf[col].values,rows) # earlier sources win
+    versions.append('%s@%s=%s:%s' % (other,myKey,theirKey,oversion))
+  return lookups,versions
+
+def aggregateColumns(columns,query,cols,evalExpr):
+  '''The columns (out of those available) the aggregate and cumsum stages of a parsed query use, from its output
+     columns cols (None for all of them) and its eval expression if it has one'''
+  if cols is None: return None
+  names = IDENTIFIER_PATTERN.findall(evalExpr) if evalExpr is not None else list(cols)
+  if query['aggregator'] is not None: names += list(query['aggregator'].keys())
+  return [col for i,col in enumerate(names) if col in columns and col not in names[:i]]
+
+def topOrder(vals,k,ascending=True):
+  '''The first k positions of sortOrder(vals,ascending), found by partitioning around the kth value and only
+     sorting the rows up to it'''
+  vals = np.asarray(vals)
+  if vals.dtype.kind not in 'biuf' or k >= len(vals): return sortOrder(vals,ascending)[:k]
+  vals  = vals.astype(float)
+  valid = np.flatnonzero(~np.isnan(vals))
+  if k >= len(valid): return sortOrder(vals,ascending)[:k] # NaNs are last, so most of the rows are kept anyway
+  key = vals[valid] if ascending else -vals[valid]
+  kth = np.partition(key,k - 1)[k - 1]
+  ties = np.flatnonzero(key == kth)
+  top = np.concatenate([np.flatnonzero(key < kth),ties[:k - int((key < kth).sum())]]) # the first ties, as a stable sort
+  top.sort()
+  return valid[top[np.argsort(key[top],kind='mergesort')]]
+
+GROUP_REDUCTIONS = ('mean','sum','min','max','count') # the /a/ functions computed from factorized keys
+
+def groupAggregate(df,rows,catIndex,key,fn,cols,size=False):
+  '''The fn (one of GROUP_REDUCTIONS) of each of the numeric cols over the rows of df at positions rows (or all
+     of them) grouped by the key column, like df.iloc[rows].groupby(key).agg(fn)[cols], plus the size of each group
+     as the key column if size. The rows are grouped by the codes of the CategoryIndex of the key, so nothing is
+     hashed: counts, sums and means are bincounts of the codes (weighted by the values), taken in row order, and 
+     mins and maxes are reduceats over the rows of each group, taken in the grouped order of the index.'''
+  codes = catIndex.codes if rows is None else catIndex.codes[rows]
+  keyed = codes >= 0                               # groupby leaves out the rows without a key
+  sizes = np.bincount(codes[keyed],minlength=len(catIndex.uniques))
+  full  = sizes > 0                                # and the groups without rows
+  keys  = catIndex.sortOrder()
+  keys  = keys[full[keys]]                         # the codes of the groups, in sorted order
+  grouped = None
+  out = OrderedDict()
+  for col in cols:
+    vals = df[col].values
+    if fn in ('min','max'):
+      if grouped is None:
+        mask = None
+        if rows is not None:
+          mask = np.zeros(len(df.index),dtype=bool)
+          mask[rows] = True
+        grouped = catIndex.grouped(mask)[0]
+        starts  = (np.cumsum(sizes) - sizes)[full] # the position in grouped of the first row of each group
+      reduced = np.zeros(len(sizes),dtype=vals.dtype)
+      if len(grouped) > 0: reduced[full] = (np.fmin if fn == 'min' else np.fmax).reduceat(vals[grouped],starts) # NaNs skipped
+      out[col] = reduced[keys]
+      continue
+    if rows is not None: vals = vals[rows]
+    valid = keyed & ~np.isnan(vals) if vals.dtype.kind == 'f' else keyed
+    if fn in ('count','mean'): counts = np.bincount(codes[valid],minlength=len(sizes))
+    if fn in ('sum','mean'):   sums   = np.bincount(codes[valid],weights=vals[valid],minlength=len(sizes)).astype(float) # even if empty
+    if   fn == 'count': out[col] = counts[keys]
+    elif fn == 'mean':
+      with np.errstate(invalid='ignore',divide='ignore'):
+        out[col] = sums[keys] / counts[keys] # NaN for groups of NaNs
+    elif vals.dtype.kind == 'f': out[col] = sums[keys]
+    else:                        out[col] = np.rint(sums[keys]).astype(np.int64) # sums of ints stay ints
+  result = pd.DataFrame(out,index=pd.Index(catIndex.uniques[keys],name=key),columns=list(cols))
+  if size: result[key] = sizes[keys]
+  return result
+
+def indexedAggregate(df,rows,srcIndexes,aggregator,columns,cols):
+  '''The /a/ aggregation of the columns of df used by a query (or all of them) at positions rows (or all of 
+     them) by groupAggregate, as executeQuery would compute it with groupby, or None if its key has no 
+     CategoryIndex or it needs more than the GROUP_REDUCTIONS of numeric columns'''
+  if srcIndexes is None or len(aggregator) != 1: return None
+  key,fns = list(aggregator.items())[0]
+  fn = str(fns[0])
+  if fn not in GROUP_REDUCTIONS: return None
+  catIndex = srcIndexes.category(key)
+  if catIndex is None: return None
+  values = [col for col in (columns if columns is not None else df.columns) if col != key]
+  if len([col for col in values if col not in df.columns or df[col].dtype.kind not in 'iuf']) > 0: return None
+  return groupAggregate(df,rows,catIndex,key,fn,values,size=(cols is not None and key in cols))
+
+class RowPlan(object):
+  '''The rows of a frame that the stages of a query have selected so far, in order, as positions into it (or 
+     None for all of its rows), so the sampling, sorting and slicing stages don't copy any columns and the
+     frame is copied once, for the rows and columns of the result. expr is the eval(...) expression of a 
+     derived column, which is computed from just the rows that are left when it's needed, and lookups are the
+     columns of joined sources (see joinColumns), which are gathered for just those rows too.'''
+  def __init__(self,df,expr=None,lookups=None):
+    self.df   = df
+    self.rows = None
+    self.expr = expr
+    self.lookups = lookups if lookups is not None else OrderedDict()
+
+  def columns(self):
+    return list(self.df.columns) + list(self.lookups.keys())
+
+  def count(self):
+    return len(self.df.index) if self.rows is None else len(self.rows)
+
+  def take(self,positions):
+    '''Keep the rows at positions, relative to the rows selected so far'''
+    positions = np.asarray(positions,dtype=np.intp)
+    self.rows = positions if self.rows is None else self.rows[positions]
+
+  def frame(self,cols=None):
+    '''A frame of the selected rows of cols, or of all the columns if cols is None'''
+    if len(self.lookups) > 0 and (cols is None or len([col for col in cols if col in self.lookups]) > 0):
+      names = self.columns() if cols is None else list(cols)
+      index = self.df.index if self.rows is None else self.df.index[self.rows]
+      return pd.DataFrame(OrderedDict([(col,self.values(col)) for col in names]),index=index,columns=names)
+    if cols is None: return self.df if self.rows is None else self.df.iloc[self.rows]
+    locs = [self.df.columns.get_loc(col) for col in cols]
+    return self.df.iloc[:,locs] if self.rows is None else self.df.iloc[self.rows,locs]
+
+  def derived(self):
+    names = sorted(set([name for name in IDENTIFIER_PATTERN.findall(self.expr) if name in self.columns()]))
+    rows = self.frame(names)
+    derived = rows.eval(self.expr)
+    if isinstance(derived,pd.Series): return derived
+    return pd.Series(derived,index=rows.index) # a constant expression is repeated for every row
+
+  def values(self,col):
+    if col == DERIVED and self.expr is not None: return self.derived().values
+    if col in self.lookups:
+      vals,rows = self.lookups[col]
+      return lookupValues(vals,rows if self.rows is None else rows[self.rows])
+    vals = self.df[col].values
+    return vals if self.rows is None else vals[self.rows]
+
+  def sort(self,col,ascending=True,k=None):
+    '''Order the rows by col, with NaNs last, keeping just the first k if k is given'''
+    vals = self.values(col)
+    self.take(sortOrder(vals,ascending) if k is None else topOrder(vals,k,ascending))
+
+  def materialize(self,cols=None):
+    if self.expr is not None: return pd.DataFrame({ DERIVED : self.derived() })
+    return self.frame(cols)
+
 @timefn
 def executeQuery(query,cache=None):
+  '''Run a parsed query. Filter masks are cached in the process wide DataSource.maskCache unless 
+     another cache (i.e. a dict) is provided.'''
   #print query
+  if cache is None: cache = DataSource.maskCache
+  laps = querystats.Laps() # the time of each stage, for the stats and the Server-Timing header of the request
+  for source in query['dataSource']:
+    if len(parseJoin(source)[1]) == 0 and DataSource().isPushedDown(source): # run it in the database if it can be translated to sql
+      querystats.source(source)
+      try: 
+        pushed = sqlpushdown.executeQuery(query,source)
+        laps.lap('pushdown')
+        return pushed
+      except sqlpushdown.NotPushable as e: print('[DataService.executeQuery] Running in memory: %s' % e)
   df   = None
   cols = []
   aggCols = []
@@ -279,120 +850,468 @@ def executeQuery(query,cache=None):
   #  print(cache.keys())
   #except AttributeError: pass
   # load data and take note of which cols of data have been requested  
-  for source in query['dataSource']:
-    cols = query['dataSource'][source]
-    df = DataSource().getdf(source)
-    # protect against Inf and -Inf values. VISDOM can handle NaNs
-    df = df.replace([np.inf, -np.inf], np.nan)
-
-    print('[DataService.executeQuery]', source, df.shape)
-    print(id(df))
-    # TODO: support some form of merging data sources (would require new syntax and changes to parseSource
-    # df = df.mergeWith( ... )
-    #pd.merge(left_frame, right_frame, on='key', how='inner')
-    #pd.merge(left_frame, right_frame, left_on='left_key', right_on='right_key')
-    #pd.merge(left_frame, right_frame, on='key', how='left') # or right or outer
-    #pd.concat([left_frame, right_frame], axis=1) # concat dfs by column
-  newdf = df
+  for spec in query['dataSource']:
+    cols = query['dataSource'][spec]
+    source,joins = parseJoin(spec) # other sources joined to this one with source*other@key
+    columns = queryColumns(query,cols)
+    if columns is not None: columns = sorted(set(columns + [myKey for other,myKey,theirKey in joins]))
+    # note that the cached df is shared by all requests and has already been cleaned of Inf and -Inf values
+    # so it is used as is and its arrays are read only. Stages below that add columns work on copies.
+    df,version,srcIndexes = DataSource().getLoaded(source,columns) # column oriented sources load just these columns
+    # the columns of joined sources are gathered from them at the rows each stage needs, like a left merge
+    lookups,joinVersions = joinColumns(df,srcIndexes,joins,columns)
+  laps.lap('load')
+  outCols  = None if cols is None or cols[0] is None else list(cols) # None for all of them
+  evalExpr = re.findall('eval\((.*)\)',outCols[0]) if outCols is not None else []
+  evalExpr = evalExpr[0] if len(evalExpr) > 0 else None
+  # stages that only select or reorder rows update the row positions of the plan, and the cached df is copied 
+  # once, when the result is materialized with just the requested columns
+  plan   = RowPlan(df,lookups=lookups)
+  subset = None
   #print df.columns.values
   # filter rows using simple criteria
   if query['filter'] is not None:
-    subset = runFilters(df,query['filter'],cache) # use the original df here to ensure that cache of id(df) works
-    before = len(df.index)
-    newdf = newdf.loc[subset,:]
+    fdf,fversion = df,version
+    features = filterFeatures(query['filter'])
+    if len([col for col in features if col in lookups]) > 0: # the joined columns the filter uses, for all of the rows
+      names = [col for col in plan.columns() if col in features]
+      fdf = pd.DataFrame(OrderedDict([(col,plan.values(col)) for col in names]),index=df.index,columns=names)
+      fversion = '*'.join([str(version)] + joinVersions)
+    subset = runFilters(fdf,query['filter'],cache,fversion,srcIndexes) # cached masks are keyed on the version of the source
+    plan.take(np.flatnonzero(subset))
     # TODO: this could be done using the query interface...
     #newdf = newdf.query(query['filter2'],local_dict={ 'null' : np.array([None] * before) } ) #pd.Series([None] * before) } )
-    print(('filter: %d -> %d' % (before,len(newdf.index))))
-  if query['aggregator'] is not None:
-    aggCols = list(query['aggregator'].keys())
-    for agg in query['aggregator']:
-      grps = newdf.groupby(agg)
-      newdf = grps.agg(query['aggregator'][agg][0])
-      if (agg in cols): 
-        newdf[agg] =  grps.size()
-  # strip down to just the cols we are interested in
-  if cols is not None and cols[0] is not None:
-    evalExpr = re.findall('eval\((.*)\)',cols[0])
-    #print cols
-    #print newdf.columns.values
-    #print evalExpr
-    if len(evalExpr) > 0:
-      print("Dynamic column %s" % evalExpr)
-      cols = ['derived']                        # set the filter columns to the derived one
-      newdf[cols[0]] = newdf.eval(evalExpr[0])  # add the derived values to the data frame
-    newdf = newdf[list(cols)] 
-  if query['cumsum'] is not None:
-    # post process - applications include cumsum, random sub sampling, and targeted sub-sampling 
-    # see also inplace=True arg for sort
-    #chicago.sort('salary', ascending=False, inplace=True)
-    #chicago = chicago.groupby('department').apply(ranker)
-    cumdf = None
-    for col in cols:
-      newdf = newdf.loc[newdf[col].notnull(),:] # filter out nulls before the cum sum
-      colData = newdf[col].order(ascending=False)
-      forcePositive = True
-      if(forcePositive):
-        colData[colData < 0] = 0  # force negative values to be zero
-      cumcol = colData.cumsum()   # calculate the cumsum 
-      cumcol.index = newdf.index  # align the indices with the original to keep the cumsum order
-      newdf['%s_cumsum' % col] = cumcol
+    laps.lap('filter')
+  if query['aggregator'] is not None or query['cumsum'] is not None:
+    # aggregations by category columns are computed from the positions and the factorized keys
+    newdf = None
+    if query['aggregator'] is not None:
+      columns = aggregateColumns(plan.columns(),query,outCols,evalExpr)
+      newdf = indexedAggregate(df,plan.rows,srcIndexes,query['aggregator'],columns if columns is not None else plan.columns(),cols)
+    if newdf is None:
+      # the other stages work on frames, so copy the selected rows of just the columns they use
+      newdf = plan.frame(aggregateColumns(plan.columns(),query,outCols,evalExpr))
+      if query['aggregator'] is not None:
+        aggCols = list(query['aggregator'].keys())
+        for agg in query['aggregator']:
+          grps = newdf.groupby(agg)
+          newdf = grps.agg(query['aggregator'][agg][0])
+          if (agg in cols): 
+            newdf[agg] =  grps.size()
+    # strip down to just the cols we are interested in
+    if outCols is not None:
+      if evalExpr is not None:
+        print("Dynamic column %s" % evalExpr)
+        cols = [DERIVED]                          # set the filter columns to the derived one
+        newdf = pd.DataFrame({ cols[0] : newdf.eval(evalExpr) }, index=newdf.index)
+      newdf = newdf[list(cols)] 
+    if query['cumsum'] is not None:
+      # post process - applications include cumsum, random sub sampling, and targeted sub-sampling 
+      # see also inplace=True arg for sort
+      #chicago.sort('salary', ascending=False, inplace=True)
+      #chicago = chicago.groupby('department').apply(ranker)
+      cumdf = None
+      for col in cols:
+        newdf = newdf.loc[newdf[col].notnull(),:] # filter out nulls before the cum sum
+        colData = newdf[col].order(ascending=False)
+        forcePositive = True
+        if(forcePositive):
+          colData[colData < 0] = 0  # force negative values to be zero
+        cumcol = colData.cumsum()   # calculate the cumsum 
+        cumcol.index = newdf.index  # align the indices with the original to keep the cumsum order
+        newdf['%s_cumsum' % col] = cumcol
+    plan,outCols = RowPlan(newdf),None
+    laps.lap('aggregate')
+  elif evalExpr is not None:
+    print("Dynamic column %s" % evalExpr)
+    plan.expr = evalExpr # computed for the rows that are left when it's needed
+    cols = [DERIVED]
   if query['histogram'] is not None:
     n = query['histogram']['bins']
     if query['histogram']['min'] is not None: 
       rng = ( query['histogram']['min'],query['histogram']['max'] )
     else: 
       rng = None
-    cumdf = None
-    for col in cols:
-      #print col
-      #print newdf[col]
-      newdf = newdf.loc[newdf[col].notnull(),:] # filter out nulls 
-      histdf = newdf[col].replace([np.inf, -np.inf], np.nan) # no inf values
-      histdf = histdf.dropna() # no nan values
-      hist,bin_edges = np.histogram(histdf,bins=n,range=rng)
-      #print hist
-      newdf = pd.DataFrame(hist,columns=['counts'])
-      newdf['bin_min'] = bin_edges[:len(bin_edges)-1] # the leading edge of each bin is the first through second to last of the bin edges
-      newdf['bin_max'] = bin_edges[1:]                # the trailing edge of each bin is the second through last of the bin edges
-      #newdf[''] = df['bin_max'].map(lambda x: 42 if x > 1 else 55)
-      #cumcol = newdf[col].order(ascending=False).cumsum() # calculate the cumsum
-      #cumcol.index = newdf.index           # align the indices with the original to keep the cumsum order
-      #newdf['%s_cumsum' % col] = cumcol
+    # unfiltered histograms with the default bins and range were computed once for the version of the source
+    col = cols[0]
+    newdf = None
+    if plan.df is df and plan.rows is None and col == query['dataSource'][spec][0] and col in df.columns: 
+      newdf = supersetHistogram(source,col,n,rng)
+    if newdf is None: newdf = histogramFrame(*histogramCounts([plan.values(col)],[n],[rng])[0])
+    plan,outCols = RowPlan(newdf),None
+    laps.lap('hist')
   if query['rnd'] is not None:
     # post-process to take a random sample of n values from the full set
     n = int(query['rnd'])
-    if n < len(newdf.index):
-      newdf = newdf.iloc[random.sample(list(range(len(newdf.index))), n)] # n row index samples drawn at random from 0 to len(index)-1
+    if n < plan.count():
+      plan.take(random.sample(list(range(plan.count())), n)) # n row index samples drawn at random from 0 to len(index)-1
+    laps.lap('sample')
   if query['thin'] is not None:
     # post-process to take an ordered sample of n evenly spaced values from the full set
     n = int(query['thin'])
     #print 'thinning %d' % n
-    if n < len(newdf.index):
-      thinidx = [(x+1) * (len(newdf.index) / n) - 1 for x in range(n)] # n evenly spaced row index samples drawn between n to len(index) - 1
+    if n < plan.count():
+      thinidx = [(x+1) * (plan.count() // n) - 1 for x in range(n)] # n evenly spaced row index samples drawn between n to len(index) - 1
       # todo: this returns int values rounded down, so if we want it, we often will need to add the final reading
-      newdf = newdf.iloc[thinidx]
-  if query['desc'] is not None:
-    newdf = newdf.sort([query['desc']],ascending=[0])
-  if query['asc'] is not None:
-    newdf = newdf.sort([query['asc']],ascending=[1])
-  if query['head'] is not None:
-    n = int(query['head'])
-    newdf = newdf.head(n)
+      plan.take(thinidx)
+    laps.lap('sample')
+  head = int(query['head']) if query['head'] is not None else None
+  sorts = [(query[key],key == 'asc') for key in ('desc','asc') if query[key] is not None]
+  for i,(col,ascending) in enumerate(sorts):
+    # the last sort before a head only has to find the top rows, which are all that's kept
+    last = i == len(sorts) - 1 and head is not None and head >= 0
+    plan.sort(col,ascending,head if last else None)
+  if head is not None:
+    plan.take(np.arange(plan.count())[:head])
   if query['tail'] is not None:
     n = int(query['tail'])
-    newdf = newdf.tail(n)
+    plan.take(np.arange(plan.count())[-n:] if n != 0 else [])
+  if len(sorts) > 0 or head is not None or query['tail'] is not None: laps.lap('sort')
   if query['bin'] is not None:
-    newdf = quantileStats(newdf,cols[0],int(query['bin']))
-    # the CategoricalIndex returned by quantile breaks to_json
-    # so we convert it to str
-    newdf.index = newdf.index.astype(str)
-  return newdf
+    n = int(query['bin'])
+    qstats = None
+    # the rows of the plan are still the rows of df selected by the filter, so the sorted order of the column applies
+    sameRows = all([query[key] is None for key in ('aggregator','cumsum','histogram','rnd','thin','head','tail')])
+    if sameRows and plan.expr is None and cols[0] in df.columns:
+      if query['approx'] is not None and query['filter'] is None:
+        sketch = srcIndexes.derived(('sketch',cols[0]),lambda d: quantiles.sketchColumn(d[cols[0]].values))
+        qstats = quantiles.approxBins(sketch,n)
+      else:
+        qstats = sortedQuantileStats(srcIndexes,cols[0],n,subset)
+    if qstats is None: qstats = quantileStats(pd.DataFrame({ cols[0] : plan.values(cols[0]) }),cols[0],n)
+    if query['approx'] is not None and 'count_error' not in qstats.columns: qstats['count_error'] = 0 # exact
+    laps.lap('bin')
+    return qstats # keyed by the bin labels as strings, as a CategoricalIndex breaks to_json
+  result = plan.materialize(outCols)
+  laps.lap('materialize')
+  return result
+
+
+BINARY_FORMAT = 1
+
+def binaryColumn(vals):
+  '''The little endian typed array (one of float64, float32, int32 or uint8) that represents vals in the 
+     binary format along with the list of labels its int32 codes point to if vals are strings or other objects'''
+  vals = np.asarray(vals)
+  kind = vals.dtype.kind
+  if kind == 'b': return vals.astype('<u1'), None
+  if kind in 'iu':
+    if len(vals) == 0 or (vals.min() >= -2**31 and vals.max() < 2**31): return vals.astype('<i4'), None
+    return vals.astype('<f8'), None # too big for int32, but exact in float64 up to 2**53
+  if kind == 'f': return vals.astype('<f4' if vals.dtype.itemsize <= 4 else '<f8'), None
+  if kind in 'mM': # milliseconds (since the epoch for datetimes) as in the json format, with NaT as NaN
+    ms = vals.astype('%s8[ms]' % kind).astype(np.int64).astype('<f8')
+    ms[pd.isnull(vals)] = np.nan
+    return ms, None
+  codes,labels = pd.factorize(vals) # missing values get the code -1
+  return codes.astype('<i4'), labels.tolist()
+
+def binaryChunks(df):
+  '''Generate the binary columnar encoding of df: a 4 byte little endian header length, a json header 
+     describing each column and the index, and then the raw typed array of each column, so clients read them 
+     as typed arrays without parsing any text. The header is like
+       { "format" : 1, "rows" : n, "columns" : [names], "index" : column, "data" : [column,...] }
+     where each column is { "dtype" : "float64"|"float32"|"int32"|"uint8", "offset" : o, "length" : l } plus 
+     "labels" : [values] for string columns stored as int32 codes (-1 is null). Offsets are in bytes from the 
+     end of the header and both the header and every array are padded to multiples of 8 bytes.'''
+  arrays  = []
+  entries = []
+  offset  = 0
+  for vals in [df.index.values] + [df.iloc[:,i].values for i in range(len(df.columns))]:
+    arr,labels = binaryColumn(vals)
+    entry = { 'dtype' : str(arr.dtype.name), 'offset' : offset, 'length' : arr.nbytes }
+    if labels is not None: entry['labels'] = labels
+    entries.append(entry)
+    arrays.append(arr)
+    offset += arr.nbytes + (-arr.nbytes % 8)
+  header = json.dumps({ 'format'  : BINARY_FORMAT,
+                        'rows'    : len(df.index),
+                        'columns' : df.columns.tolist(),
+                        'index'   : entries[0],
+                        'data'    : entries[1:] }, default=str).encode('utf-8')
+  header += b' ' * (-(len(header) + 4) % 8)
+  yield np.array([len(header)],dtype='<u4').tobytes() + header
+  for arr in arrays:
+    yield np.ascontiguousarray(arr).tobytes() + b'\0' * (-arr.nbytes % 8)
+
+def serialize(df,fmt=None):
+  '''Encode a query result as csv if fmt is 'csv', in the binary columnar format if fmt is 'npy' (see binaryChunks) 
+     and otherwise as split oriented json'''
+  if fmt == 'csv': return df.to_csv().encode('utf-8')
+  if fmt == 'npy': return b''.join(binaryChunks(df))
+  return df.to_json(orient='split').encode('utf-8')
+
+def serializeChunks(df,fmt=None,chunkRows=None):
+  '''Generate the same bytes as serialize(df,fmt) in pieces of at most chunkRows rows, so a large result can be
+     streamed to the client without ever holding the whole encoded result in memory'''
+  if chunkRows is None: chunkRows = getattr(data_cfg,'streamChunkRows',10000)
+  n = len(df.index)
+  if fmt == 'npy': # already columnar, so streamed a column at a time
+    for chunk in binaryChunks(df): yield chunk
+    return
+  if fmt == 'csv':
+    yield df.iloc[:0].to_csv().encode('utf-8') # the header line
+    for i in range(0,n,chunkRows):
+      yield df.iloc[i:i + chunkRows].to_csv(header=False).encode('utf-8')
+    return
+  # split oriented json is {"columns":[...],"index":[...],"data":[[...],...]}, so the index is streamed first and
+  # the rows second, each chunk without the [] of its own json list
+  empty = df.iloc[:0].to_json(orient='split')
+  head,tail = empty.split('"index":[]',1)
+  if tail != ',"data":[]}': # not the layout this relies on, so fall back to encoding it in one piece
+    yield serialize(df,fmt)
+    return
+  yield (head + '"index":[').encode('utf-8')
+  for i in range(0,n,chunkRows):
+    chunk = pd.Series(df.index[i:i + chunkRows]).to_json(orient='values')[1:-1]
+    yield ((',' if i > 0 else '') + chunk).encode('utf-8')
+  yield '],"data":['.encode('utf-8')
+  for i in range(0,n,chunkRows):
+    chunk = df.iloc[i:i + chunkRows].to_json(orient='values')[1:-1]
+    yield ((',' if i > 0 else '') + chunk).encode('utf-8')
+  yield ']}'.encode('utf-8')
+
+class ShapeDictionary(object):
+  '''The load shape dictionary of a source prefix, built once per loaded version of its *DictMembers, *DictKwh,
+     *DictCenters and *CategoryMapping sources. The per customer shape counts and kWh are held as float32 matrices
+     (sparse when scipy is available and most customers use few of the shapes) aligned on one id to row index,
+     and the totals over all customers are precomputed, so summarizing a filtered set of customers is a lookup of
+     their rows followed by a column sum of each matrix.'''
+  def __init__(self,dictMembers,dictKwh,shapes,categoryMap,idName='id',firstDataColIdx=1):
+    self.shapes      = shapes
+    self.categoryMap = categoryMap
+    self.categories  = pd.factorize(categoryMap['name'])
+    # rows of both tables are summed by id, which gives the same totals as the inner joins on id they replace
+    members = dictMembers.iloc[:,firstDataColIdx:].groupby(dictMembers[idName].values).sum()
+    kwh     = dictKwh.iloc[:,firstDataColIdx:].groupby(dictKwh[idName].values).sum()
+    self.ids = members.index.union(kwh.index)
+    self.countsAreInts = all([dictMembers[c].dtype.kind in 'biu' for c in dictMembers.columns[firstDataColIdx:]])
+    self.members = self.matrix(members.reindex(self.ids,fill_value=0).values)
+    self.kwh     = self.matrix(kwh.reindex(self.ids,fill_value=0).values)
+    # total all the cluster members (total # of shapes) and all the kwh
+    self.totalMembers = float(dictMembers.iloc[:,firstDataColIdx:].values.sum()) # ensuring float outcome
+    self.totalKwh     = float(dictKwh.iloc[:,firstDataColIdx:].values.sum())
+
+  @staticmethod
+  def matrix(vals):
+    vals = np.asarray(vals,dtype=np.float32)
+    if sparse is not None and np.count_nonzero(vals) < vals.size // 3:
+      return sparse.csr_matrix(vals)
+    return np.ascontiguousarray(vals)
+
+  @staticmethod
+  def columnTotals(matrix,rows):
+    '''Sum the given rows (with repeats) of matrix, accumulating in float64'''
+    if sparse is not None and sparse.issparse(matrix):
+      weights = np.bincount(rows,minlength=matrix.shape[0]).astype(np.float64)
+      return np.asarray(matrix.T.dot(weights)).ravel()
+    return matrix[rows].sum(axis=0,dtype=np.float64)
 
+  def totals(self,ids):
+    '''The shape counts and kWh summed over the customers with the given ids, counting repeated ids repeatedly'''
+    rows = self.ids.get_indexer(np.asarray(ids))
+    rows = rows[rows >= 0]
+    countSum = self.columnTotals(self.members,rows)
+    if self.countsAreInts: countSum = np.round(countSum).astype(np.int64)
+    return countSum, self.columnTotals(self.kwh,rows), len(np.unique(rows))
+
+def shapeDictionary(sourcePrefix):
+  membersName = '%sDictMembers' % sourcePrefix
+  others = ['%sDictKwh' % sourcePrefix, '%sDictCenters' % sourcePrefix, '%sCategoryMapping' % sourcePrefix]
+  loaded = [DataSource().getLoaded(name) for name in [membersName] + others] # (df,version,indexes) of each
+  dfs = [df for df,version,srcIndexes in loaded]
+  firstDataColIdx = 1
+  idName = 'id'
+  # TODO: hack to support hand coded pgeres data along side standardized new VISDOM-R encoded data
+  if sourcePrefix == 'pgeres':
+    firstDataColIdx = 3
+    idName = 'sp_id'
+  # cached with the members source, under a key that changes whenever one of the other sources is reloaded
+  key = ('shapeDictionary',) + tuple([version for df,version,srcIndexes in loaded[1:]])
+  build = lambda dictMembers: ShapeDictionary(dictMembers,dfs[1],dfs[2],dfs[3],idName,firstDataColIdx)
+  return loaded[0][2].derived(key,build)
+
+def shapeSummary(qs):
+  '''Summarize the top N load shapes and the shape categories of the customers selected by a /query/shape query string like
+     /s/basics/kwh/10/f/(kw_mean>1) as json'''
+  pieces = qs.split('/')
+  print(pieces)
+  sourceName = pieces[2]
+  sourceCfg = DataSource().getCfg(sourceName)
+  if sourceCfg is None: 
+    raise ValueError("no config info available for %s" % sourceName)
+  sourcePrefix = sourceCfg.get('prefix',None)
+  if sourcePrefix is None: sourcePrefix = sourceName
+  sortType = pieces[3]  # 'counts' or 'kwh'
+  topN = int(pieces[4])
+  qs = '/' + '/'.join(pieces[5:])
+  #print sortType, topN, qs
+  #/counts/10 or /kwh/10
+  laps = querystats.Laps()
+  ids = restQuery('/s/' + sourceName + '|id' + qs) # find the list of unique ids filtered using the /f/etc. query 
+  laps.lap('ids')
+  # the shape matrices and overall totals are built once per loaded version of the shape dictionary sources
+  shapeDict = shapeDictionary(sourcePrefix)
+  laps.lap('shapes')
+  totalMembers = shapeDict.totalMembers
+  totalKwh     = shapeDict.totalKwh
+  print('Total: Members: %d, kWh: %0.1f' % (totalMembers, totalKwh))
+  countSum, kwhSum, nWithShapes = shapeDict.totals(ids['id'].values)
+  
+  print('Filtered customer count: %d' % len(ids))
+  print('Filtered customers with shape data: %d' % nWithShapes)
+  shapes = shapeDict.shapes
+  if topN > len(shapes.index): topN = len(shapes.index)
+
+  # compute the membership counts and total energy for each of the qualitative categories 
+  codes,names = shapeDict.categories
+  valid = codes >= 0
+  categoryStats = pd.DataFrame({ 'total_members' : np.bincount(codes[valid],weights=countSum[valid],minlength=len(names)),
+                                 'total_kwh'     : np.bincount(codes[valid],weights=kwhSum[valid],  minlength=len(names)) },
+                               index=pd.Index(names,name='name'), columns=['total_members','total_kwh']).sort_index()
+  if shapeDict.countsAreInts: categoryStats['total_members'] = categoryStats['total_members'].round().astype(np.int64)
+  categoryStats['pct_kwh']              = categoryStats.total_kwh     / totalKwh
+  categoryStats['pct_members']          = categoryStats.total_members / totalMembers
+  categoryStats['pct_filtered_kwh']     = categoryStats.total_kwh     / kwhSum.sum()
+  categoryStats['pct_filtered_members'] = categoryStats.total_members / countSum.sum()
+  categoryStats['name']                 = categoryStats.index # add the index as a regular column, so the json format can be recor
+  print(categoryStats)
+  if sortType == 'members':
+    sortIdx = np.argsort(countSum)[::-1] # note that [::-1] reverses the array
+  elif sortType == 'kwh':
+    sortIdx = np.argsort(  kwhSum)[::-1]
+  else: 
+    raise ValueError('Bad sortType=%s from query %s' % (sortType,qs))
+  
+  topIdx = sortIdx[:topN]
+
+  topShapes = shapes.iloc[topIdx,:].copy() # a copy, so the cached shapes are never modified
+  print('Filtered: Members: %d, kWh: %0.1f' % (countSum[topIdx].sum(), kwhSum[topIdx].sum()))
+
+  topShapes['total_kwh']            = kwhSum[topIdx]
+  topShapes['total_members']        = countSum[topIdx]
+  topShapes['pct_kwh']              = kwhSum[topIdx]   * 100 / totalKwh
+  topShapes['pct_members']          = countSum[topIdx] * 100 / totalMembers
+  topShapes['pct_filtered_kwh']     = kwhSum[topIdx]   * 100 / kwhSum.sum()
+  topShapes['pct_filtered_members'] = countSum[topIdx] * 100 / float(countSum.sum())
+  laps.lap('summarize')
+  
+  # building a json format map with the top shapes under "top" and the categorical totals under "categories"
+  out = '{"top":%s,"categories":%s}' % (topShapes.to_json(orient='split'),categoryStats.to_json(orient='records'))
+  laps.lap('serialize')
+  return out
+
+def sortOrder(vals,ascending=True):
+  '''The stable order that sorts vals ascending or descending, with NaNs last either way (as pandas sorts)'''
+  if np.asarray(vals).dtype.kind not in 'biuf': # i.e. strings, ranked in order of appearance for ties
+    ranks = pd.Series(vals).rank(method='first',ascending=ascending,na_option='bottom').values
+    return np.argsort(ranks,kind='mergesort')
+  vals  = np.asarray(vals,dtype=float)
+  nans  = np.isnan(vals)
+  valid = np.flatnonzero(~nans)
+  order = np.argsort(vals[valid] if ascending else -vals[valid],kind='mergesort')
+  return np.concatenate([valid[order],np.flatnonzero(nans)])
+
+class ResponseEvents(object):
+  '''The events of a *ResponseEvent source with their forecast, actual, savings and pct_savings computed once,
+     by gathering the hkw<hour>_fcst and hkw<hour>_obs value of each event's hour across the whole table at once, 
+     and with the sort order of each sort key cached so the top N events are a slice.'''
+  def __init__(self,eventResponse):
+    firstFcst = eventResponse.columns.get_loc('hkw1_fcst')
+    firstObs  = eventResponse.columns.get_loc('hkw1_obs')
+    hour = eventResponse['hour'].values.astype(int)
+    rows = np.arange(len(hour))
+    nHours = int(hour.max()) if len(hour) > 0 else 0
+    # the hourly columns are consecutive, so hour h of each row is h - 1 columns after the first
+    fcstBlock = eventResponse.iloc[:,firstFcst:firstFcst + nHours].values.astype(float)
+    obsBlock  = eventResponse.iloc[:,firstObs: firstObs  + nHours].values.astype(float)
+    forecast = fcstBlock[rows,hour - 1] + 0.0000001 # prevent divide by zero
+    actual   = obsBlock[ rows,hour - 1] + 0.0000001 # prevent imbalance from / 0
+    derived = pd.DataFrame({ 'pct_savings' : (forecast - actual) / forecast,
+                             'savings'     : forecast - actual,
+                             'forecast'    : forecast,
+                             'actual'      : actual },
+                           index=eventResponse.index, columns=['pct_savings','savings','forecast','actual'])
+    # a new frame, so the shared cached source is never modified
+    self.events = pd.concat([eventResponse.drop(derived.columns,axis=1,errors='ignore'),derived],axis=1)
+    self.orders = {}
+    self.lock   = threading.Lock()
+    for sortType in ('savings','pct_savings'):
+      for desc in (True,False): self.order(sortType,desc)
+
+  def order(self,sortType,desc):
+    key = (sortType,desc)
+    order = self.orders.get(key)
+    if order is None:
+      order = sortOrder(self.events[sortType].values,ascending=(not desc))
+      with self.lock: self.orders[key] = order
+    return order
+
+  def top(self,sortType,desc,topN):
+    return self.events.iloc[self.order(sortType,desc)[:topN]]
+
+def eventResponses(qs):
+  '''Rank the demand response events of the customers selected by a /query/response query string like
+     /s/basics/savings/true/10/f/(kw_mean>1) as json'''
+  pieces = qs.split('/')
+  print(pieces)
+  sourceName = pieces[2]
+  sourceCfg = DataSource().getCfg(sourceName)
+  if sourceCfg is None: 
+    raise ValueError("no config info available for %s" % sourceName)
+  sourcePrefix = sourceCfg.get('prefix',None)
+  if sourcePrefix is None: sourcePrefix = sourceName
+  sortType = pieces[3]  # 'savings' or 'pct_savings'
+  desc = pieces[4] == 'true'
+  topN = int(pieces[5])
+  qs = '/' + '/'.join(pieces[6:])
+  #print sortType, topN, qs
+  #/counts/10 or /kwh/10
+  laps = querystats.Laps()
+  ids = restQuery('/s/' + sourceName + '|id' + qs) # find the list of unique ids filtered using the /f/etc. query 
+  laps.lap('ids')
+  # the derived savings and sort orders are computed once per loaded version of the event source
+  eventSource = '%sResponseEvent' % sourcePrefix
+  events = DataSource().getLoaded(eventSource)[2].derived('responseEvents',ResponseEvents)
+  laps.lap('events')
+  
+  # building a json format map with the top shapes under "top" and the categorical totals under "categories"
+  #return '{"top":%s,"categories":%s}' % (topShapes.to_json(orient='split'),categoryStats.to_json(orient='records')) 
+  out = '{"top":%s}' % (events.top(sortType,desc,topN).to_json(orient='split'))
+  laps.lap('serialize')
+  return out
 
 def loadHDF5(fName,tblName):
   print(( 'Loading hdf5 data, %s (%s), into python DataFrame (via Pandas)' % (fName,tblName) ))
   return pd.read_hdf(fName,tblName)
 
+def loadHDF5Table(fName,tblName,columns=None):
+  print(( 'Loading hdf5 table data, %s (%s), columns %s, into python DataFrame (via Pandas)' % (fName,tblName,columns) ))
+  return pd.read_hdf(fName,tblName,columns=columns)
+
+def loadParquet(fName,tblName=None,columns=None):
+  print(( 'Loading parquet data, %s, columns %s, into python DataFrame (via Pandas)' % (fName,columns) ))
+  return pd.read_parquet(fName,columns=columns)
+
+def loadFeather(fName,tblName=None,columns=None):
+  print(( 'Loading feather data, %s, columns %s, into python DataFrame (via Pandas)' % (fName,columns) ))
+  return pd.read_feather(fName,columns=columns)
+
+def hdf5TableColumns(fName,tblName):
+  store = pd.HDFStore(fName,'r')
+  try:     return store.select(tblName,stop=0).columns.tolist()
+  finally: store.close()
+
+def parquetColumns(fName,tblName=None):
+  import pyarrow.parquet # pip install pyarrow
+  schema = pyarrow.parquet.read_schema(fName)
+  indexCols = (schema.pandas_metadata or {}).get('index_columns',[]) # stored indexes are restored, not loaded as columns
+  return [name for name in schema.names if name not in indexCols]
+
+def featherColumns(fName,tblName=None):
+  import pyarrow.ipc # pip install pyarrow
+  return pyarrow.ipc.open_file(fName).schema.names
+
 def loadCSV(fName,tblName=None):
   print(( 'Loading csv data, %s, into python DataFrame (via Pandas)' % (fName) ))
   return pd.read_csv( fName, index_col=False )
@@ -407,17 +1326,117 @@ def loadSQLite(fName,tblName):
     if con: con.close()
   return out
 
+engines = {}
+enginesLock = threading.Lock()
+
+def getEngine(db_uri):
+  '''The SQLAlchemy engine of db_uri, created once per process so its connection pool is shared by every load and query'''
+  with enginesLock:
+    engine = engines.get(db_uri)
+    if engine is None:
+      from sqlalchemy import create_engine
+      engine = create_engine(db_uri,pool_pre_ping=True)
+      engines[db_uri] = engine
+  return engine
+
 def loadSQL(db_uri,dataQuery):
-  from sqlalchemy import create_engine
   connection = None
   try:
-    engine = create_engine(db_uri)
+    engine = getEngine(db_uri)
     connection = engine.raw_connection()
     df = pandas.read_sql(dataQuery, connection)
   finally:
     if connection: connection.close()
   return df
 
+def sanitize(df):
+  '''Replace Inf and -Inf values with NaN in the float columns of df, which is modified and returned.
+     Only the columns that actually contain infinite values are replaced, so the frame as a whole is not copied.'''
+  for col in df.columns:
+    if df[col].dtype.kind != 'f': continue
+    vals = df[col].values
+    inf = np.isinf(vals)
+    if inf.any():
+      vals = vals.copy()
+      vals[inf] = np.nan
+      df[col] = vals
+  return df
+
+def readOnly(df):
+  '''The columns of df (not copied) in a frame whose column arrays are flagged read only, so any stage that writes to
+     the frame shared by every request raises rather than changing the data for all of the requests after it'''
+  data = OrderedDict()
+  for col in df.columns:
+    vals = df[col].values
+    if isinstance(vals,np.ndarray): # extension arrays like Categorical have no flags
+      vals = vals.view()
+      vals.flags.writeable = False
+    data[col] = vals
+  return pd.DataFrame(data,index=df.index,columns=list(df.columns),copy=False)
+
+def sqlVersion(cfg):
+  '''The first row of the 'versionQuery' of a sql or sqlite source config, e.g. SELECT MAX(updated) FROM ...'''
+  try:
+    if cfg['dataFormat'] == 'sqlite':
+      con = sqlite3.connect(cfg['dataIdentifier'])
+      try:     return con.execute(cfg['versionQuery']).fetchone()
+      finally: con.close()
+    import sqlalchemy
+    with getEngine(cfg['dataIdentifier']).connect() as con:
+      return tuple(con.execute(sqlalchemy.text(cfg['versionQuery'])).fetchone() or ())
+  except Exception as e:
+    logging.warning('Could not run the versionQuery of %s: %s' % (cfg['dataIdentifier'],e))
+    return 'unavailable'
+
+def sourceFingerprint(cfg):
+  '''Summarize the size and modification time of the files behind a source config (its data and its column 
+     metadata, whose formulas and types shape the loaded data) into a string that changes when they do.
+     sql sources can't be checked without querying them, so they are fingerprinted by their configuration alone,
+     plus the result of their optional 'versionQuery'.'''
+  parts = [ cfg['dataFormat'], cfg['dataIdentifier'], str(cfg.get('dataTable')) ]
+  if cfg.get('versionQuery') and cfg['dataFormat'] in ('sql','sqlite'): parts.append(repr(sqlVersion(cfg)))
+  files = [ cfg.get('colMetaFile') ]
+  if cfg['dataFormat'] != 'sql': files.insert(0,cfg['dataIdentifier'])
+  for f in files:
+    if not f: continue
+    try:
+      st = os.stat(f)
+      parts.append('%d:%d' % (st.st_size,int(st.st_mtime)))
+    except OSError: 
+      parts.append('missing')
+  return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+def sourceToken(dfName):
+  '''A token that changes whenever the data of a source might: its version token if it is loaded in this process 
+     and otherwise (e.g. before its first query, or when queries run in worker processes) the fingerprint of its
+     files. The source is never loaded for its token, which would load every column of column oriented sources.'''
+  cfg = DataSource().getCfg(dfName)
+  if cfg is None: return None
+  if DataSource().isPushedDown(dfName): return None # the database can change at any time
+  version = DataSource().getVersion(dfName)
+  if version is not None: return version
+  return sourceFingerprint(cfg)
+
+def queryETag(queryObj):
+  '''A strong http ETag for the response to a parsed query, built from the tokens of its sources and the 
+     query with its filter normalized (so reordered or reformatted filters share one tag). None if the 
+     response can't be cached, i.e. for random samples or unknown sources.'''
+  if queryObj.get('rnd') is not None: return None
+  sources = queryObj.get('dataSource') or {}
+  names  = [[source] + [other for other,myKey,theirKey in joins] for source,joins in [parseJoin(name) for name in sources]]
+  tokens = [sourceToken(name) for name in sorted(itertools.chain(*names))]
+  if len(tokens) == 0 or None in tokens: return None
+  key = dict(queryObj)
+  if key.get('filter') is not None: key['filter'] = repr(compileFilters(key['filter']).root)
+  text = json.dumps([tokens,key],sort_keys=True,default=str)
+  return '"%s"' % hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def sourceStatus(names=None):
+  '''The load state of each configured source (or just those named): 'unloaded', 'loading', 'ready' or 'failed', 
+     with the load time, size and version token of the loaded ones and the error of the failed ones'''
+  if names is None: names = DataSource.directory.keys()
+  return dict([(name,DataSource.loadStates.get(name,{ 'state' : 'unloaded' })) for name in names])
+
 def publicSources():
   dataSources = DataSource.directory
   out = {}
@@ -433,6 +1452,12 @@ def publicSources():
 
 from singleton import Singleton
 import data_cfg
+import catalog
+import indexes
+import quantiles
+import querystats
+import snapshot
+import sqlpushdown
 class DataSource(six.with_metaclass(Singleton, object)):
   ''' '''
   directory = data_cfg.sources
@@ -444,65 +1469,358 @@ class DataSource(six.with_metaclass(Singleton, object)):
     'sqlite' : loadSQLite,
     'csv'    : loadCSV,
     'sql'    : loadSQL,
+    'hdftable' : loadHDF5Table,
+    'parquet'  : loadParquet,
+    'feather'  : loadFeather,
+  }
+
+  # the column oriented formats, which load only the columns queries use (see getdf), and how to list their columns
+  columnfn = {
+    'hdftable' : hdf5TableColumns,
+    'parquet'  : parquetColumns,
+    'feather'  : featherColumns,
   }
 
   memCache = { }
 
+  # version tokens identify each load of a source, so cached results computed from one load are never 
+  # confused with those of another. They start with the fingerprint of the data, as the load count of a 
+  # process starts over when it restarts and is not shared with the other query worker processes
+  versions = { }
+  loadCount = itertools.count(1)
+
+  # filter masks shared across all sessions, with a memory budget (in bytes) that can be set in data_cfg
+  maskCache = MaskCache( getattr(data_cfg, 'maskCacheBytes', 128 * 1024 * 1024) )
+
+  # lazily built column indexes (see indexes.py) of the currently loaded version of each source
+  indexCache = { }
+
+  # the fingerprint of the data each loaded source was loaded from, and the column statistics catalog 
+  # (see catalog.py) of each source
+  fingerprints = { }
+  catalogs = { }
+
+  # the columns that can be loaded from each column oriented source: its stored columns plus derived features
+  sourceColumns = { }
+
+  # the derived features of each source whose formulas failed to evaluate, which are left out of its columns
+  failedFormulas = { }
+
+  # one lock per source, so concurrent requests for a source that isn't loaded yet wait for a single load, and the 
+  # load state, timing and size of each source (see sourceStatus)
+  loadLocks = { }
+  loadLocksLock = threading.Lock()
+  loadStates = { }
+
+  def getVersion(self,dfName):
+    return self.versions.get(dfName,None)
+
+  def getIndexes(self,dfName):
+    return self.indexCache.get(dfName,None)
+
+  def getLoaded(self,dfName,columns=None):
+    '''The df, version token and indexes of the loaded version of dfName (loading it, or the columns of it given,
+       if needed), read together so a reload swapping in a new version can't mix up two of them'''
+    querystats.source(dfName) # the latency of the request counts towards the source
+    for attempt in range(3): # again if a reload swapped in a version without the columns in between
+      self.getdf(dfName,columns)
+      srcIndexes = self.indexCache[dfName]
+      df = srcIndexes.df
+      missing = self.missingColumns(dfName,df,columns)
+      if len(missing) == 0: return df,srcIndexes.version,srcIndexes
+    raise ValueError('Could not load the columns %s of %s' % (missing,dfName))
+
   def getCfg(self,dfName):
     return self.directory.get(dfName,None)
 
-  def getdf(self,dfName):
-    try: 
-      df = self.memCache[dfName]
-      #print "DataSource found cached data"
-    except:
+  def getdf(self,dfName,columns=None):
+    # the returned df is loaded, cleaned and sanitized once and then shared by every request, so its column
+    # arrays are flagged read only (see readOnly) and callers must copy what they change. Sources in a column oriented format only load the columns that have been asked
+    # for, so if columns is given the df is only guaranteed to have those (and by default it has all of them).
+    df = self.memCache.get(dfName)
+    if df is not None and len(self.missingColumns(dfName,df,columns)) == 0: return df
+    with self.getLoadLock(dfName):
+      df = self.memCache.get(dfName)
+      if df is None: # not loaded by another thread while this one waited for the lock
+        df = self.load(dfName,columns)
+      else:
+        missing = self.missingColumns(dfName,df,columns)
+        if len(missing) > 0: df = self.widen(dfName,df,missing)
+    return df
+
+  def isColumnar(self,dfName):
+    return self.directory[dfName]['dataFormat'] in self.columnfn or self.isPushedDown(dfName)
+
+  def isPushedDown(self,dfName):
+    '''Whether queries of dfName run in its database (see sqlpushdown.py), which also means it is loaded by column'''
+    cfg = self.directory[dfName]
+    return cfg.get('pushdown',False) and cfg['dataFormat'] in ('sql','sqlite')
+
+  def getColumns(self,dfName):
+    '''All the columns of a column oriented source, in the order they are loaded: stored columns then derived features'''
+    columns = self.sourceColumns.get(dfName)
+    if columns is None:
       cfg = self.directory[dfName]
+      if self.isPushedDown(dfName): columns = sqlpushdown.getSource(dfName).columns()
+      else:                         columns = self.columnfn[cfg['dataFormat']]( cfg['dataIdentifier'], cfg.get('dataTable') )
+      meta = self.getMetaData(dfName)
+      if meta is not None: columns = columns + [c for c in meta.index[meta['formula'].notnull()] if c not in columns]
+      self.sourceColumns[dfName] = columns
+    failed = self.failedFormulas.get(dfName)
+    if failed: columns = [c for c in columns if c not in failed]
+    return columns
+
+  def missingColumns(self,dfName,df,columns=None):
+    '''The known columns of dfName that the loaded df lacks, out of columns or all of them if columns is None'''
+    if not self.isColumnar(dfName): return [] # always fully loaded
+    known = self.getColumns(dfName)
+    if columns is None: columns = known
+    known = set(known)
+    return [c for c in columns if c in known and c not in df.columns]
+
+  def widen(self,dfName,df,columns):
+    '''Load more columns into the cached df of a column oriented source. The rows are the same, so the version,
+       the cached filter masks and the built indexes of the source all stay valid.'''
+    if sourceFingerprint(self.directory[dfName]) != self.fingerprints.get(dfName):
+      # the source changed since df was loaded, so its new columns wouldn't line up with the old ones
+      return self.load(dfName,list(df.columns) + list(columns))
+    start = currentTime()
+    more = self.loadSource(dfName,columns)
+    data = dict([(c,df[c].values) for c in df.columns])
+    for c in more.columns:
+      if c not in data: data[c] = more[c].values
+    order = [c for c in self.getColumns(dfName) if c in data] + [c for c in data if c not in self.getColumns(dfName)]
+    df = readOnly(pd.DataFrame(data,index=df.index,columns=order,copy=False))
+    self.indexCache[dfName].df = df
+    self.memCache[dfName] = df
+    self.loadStates[dfName].update({ 'seconds' : self.loadStates[dfName]['seconds'] + currentTime() - start,
+                                     'columns' : len(df.columns),
+                                     'bytes'   : int(df.memory_usage(index=True).sum()) })
+    return df
+
+  def getLoadLock(self,dfName):
+    with self.loadLocksLock:
+      return self.loadLocks.setdefault(dfName,threading.Lock())
+
+  def load(self,dfName,columns=None):
+    start = currentTime()
+    self.loadStates[dfName] = { 'state' : 'loading', 'started' : time.time() }
+    try:
+      df,fingerprint = self.build(dfName,columns)
+    except Exception as e:
+      self.loadStates[dfName] = { 'state'   : 'failed', 
+                                  'seconds' : currentTime() - start,
+                                  'error'   : '%s: %s' % (type(e).__name__,e) }
+      raise
+    return self.install(dfName,df,fingerprint,start)
+
+  def build(self,dfName,columns=None):
+    '''Load the current data of dfName (or just the given columns of column oriented sources) without caching it.
+       Returns the df and the fingerprint of the data it was loaded from.'''
+    cfg = self.directory[dfName]
+    fingerprint = sourceFingerprint(cfg)
+    self.failedFormulas.pop(dfName,None) # their formulas or inputs may have been fixed since
+    snapshotPath = self.getSnapshotPath(dfName)
+    if self.isColumnar(dfName): # already stored by column, so there is no need for a snapshot
+      return self.loadSource(dfName,columns if columns is not None else self.getColumns(dfName)),fingerprint
+    if snapshotPath is None: return self.loadSource(dfName),fingerprint
+    # restarts and other processes map the columns of an up to date snapshot 
+    df = snapshot.readSnapshot(snapshotPath,fingerprint)
+    if df is not None: return df,fingerprint
+    with snapshot.snapshotLock(snapshotPath):
+      df = snapshot.readSnapshot(snapshotPath,fingerprint) # written by another process while this one waited
+      if df is None:
+        df = self.loadSource(dfName)
+        if snapshot.writeSnapshot(df,snapshotPath,fingerprint):
+          # switch to the mapped copy, so this process shares the page cache with the others instead of holding its own
+          mapped = snapshot.readSnapshot(snapshotPath,fingerprint)
+          if mapped is not None: df = mapped # otherwise e.g. replaced by a newer one already, so keep the loaded df
+    return df,fingerprint
+
+  def install(self,dfName,df,fingerprint,start):
+    '''Make df the loaded version of dfName, with a new version token and indexes. Returns the read only df.'''
+    version = '%s@%s.%d' % (dfName, fingerprint[:16], next(self.loadCount))
+    df = readOnly(df) # shared by every request from here on
+    # readers take the df and version from the indexes (see getLoaded), so replacing them is the swap
+    self.indexCache[dfName] = indexes.SourceIndexes(df,self.getMetaData(dfName),version)
+    self.versions[dfName] = version
+    self.fingerprints[dfName] = fingerprint
+    self.memCache[dfName] = df # cache it for later
+    self.loadStates[dfName] = { 'state'   : 'ready',
+                                'version' : version,
+                                'loaded'  : time.time(),
+                                'seconds' : currentTime() - start,
+                                'rows'    : len(df.index),
+                                'columns' : len(df.columns),
+                                'bytes'   : int(df.memory_usage(index=True).sum()) } # object columns count pointers only
+    return df
+
+  def isStale(self,dfName):
+    '''Whether dfName is loaded and its data has changed since'''
+    loaded = self.fingerprints.get(dfName)
+    return loaded is not None and dfName in self.memCache and sourceFingerprint(self.directory[dfName]) != loaded
+
+  def reload(self,dfName):
+    '''Load the current data of a loaded source while queries keep using the loaded version, then swap the new
+       version in and drop everything cached for the old one. If the load fails the old version stays.'''
+    old = self.indexCache.get(dfName)
+    if old is None: return self.getdf(dfName)
+    start = currentTime()
+    print('[DataService.reload] INFO: Reloading %s, which has changed since %s was loaded' % (dfName,old.version))
+    self.loadStates[dfName]['reloading'] = time.time()
+    if self.isColumnar(dfName): self.sourceColumns.pop(dfName,None) # the stored columns may have changed too
+    try:
+      df,fingerprint = self.build(dfName,list(old.df.columns) if self.isColumnar(dfName) else None)
+    except Exception as e:
+      self.loadStates[dfName].pop('reloading',None)
+      self.loadStates[dfName]['reloadError'] = '%s: %s' % (type(e).__name__,e)
+      raise
+    with self.getLoadLock(dfName): # not while another thread widens the old version
+      current = self.indexCache.get(dfName)
+      self.install(dfName,df,fingerprint,start)
+    # requests that already hold the old version finish with it, but nothing new is cached for it
+    self.maskCache.purge(old.version)
+    if current is not None and current is not old: self.maskCache.purge(current.version) # reloaded by a widen
+    self.catalogs.pop(dfName,None)
+    sqlpushdown.sources.pop(dfName,None)
+    print('[DataService.reload] INFO: Swapped in %s in %0.3f seconds' % (self.versions[dfName],currentTime() - start))
+    return df
+
+  def getCatalog(self,dfName):
+    '''The column statistics catalog of dfName. It describes the loaded version of the source if there is one, and
+       otherwise the current source data, read from the catalog sidecar file when that is up to date so the source
+       doesn't have to be loaded. Catalogs are computed (loading the source if needed) at most once per version.'''
+    fingerprint = self.fingerprints.get(dfName)
+    if fingerprint is None: fingerprint = sourceFingerprint(self.directory[dfName])
+    cat = self.catalogs.get(dfName)
+    if cat is not None and cat.fingerprint == fingerprint: return cat
+    catalogPath = self.getCatalogPath(dfName)
+    cat = None
+    if catalogPath is not None: cat = catalog.readCatalog(catalogPath,fingerprint)
+    if cat is None:
+      if self.isColumnar(dfName): # a few columns at a time, without loading all of them into the cache
+        cat = self.computeColumnarCatalog(dfName,fingerprint)
+      else:
+        df = self.getdf(dfName)
+        cat = catalog.computeCatalog(df,self.fingerprints[dfName])
+      if catalogPath is not None: catalog.writeCatalog(cat,catalogPath)
+    self.catalogs[dfName] = cat
+    return cat
+
+  def computeColumnarCatalog(self,dfName,fingerprint,batchSize=16):
+    columns = self.getColumns(dfName)
+    stats = []
+    rows = 0
+    for i in range(0,len(columns),batchSize):
+      batch = self.loadSource(dfName,columns[i:i + batchSize])
+      rows = len(batch.index)
+      stats.extend([catalog.columnStats(c,batch[c].values) for c in columns[i:i + batchSize] if c in batch.columns])
+    return catalog.Catalog(fingerprint,rows,stats)
+
+  def getCatalogPath(self,dfName):
+    '''The catalog sidecar file of dfName, which is 'catalogFile' from its config if set, or else next to its data
+       file (or under the snapshotDir for sql sources). None if the source has nowhere to keep its catalog.'''
+    cfg = self.directory[dfName]
+    if 'catalogFile' in cfg: return cfg['catalogFile']
+    if cfg['dataFormat'] != 'sql': return '%s.%s.catalog.json' % (cfg['dataIdentifier'],dfName)
+    snapshotDir = getattr(data_cfg, 'snapshotDir', None)
+    if snapshotDir is None: return None
+    return os.path.join(snapshotDir,'%s.catalog.json' % dfName)
+
+  def getSnapshotPath(self,dfName):
+    '''The directory of the columnar snapshot of dfName under the snapshotDir configured in data_cfg, 
+       or None if snapshots are not configured or the source opts out with 'snapshot' : False'''
+    snapshotDir = getattr(data_cfg, 'snapshotDir', None)
+    if snapshotDir is None or not self.directory[dfName].get('snapshot',True): return None
+    return os.path.join(snapshotDir,dfName)
+
+  def loadSource(self,dfName,columns=None):
+    '''Load dfName from its original format and clean it up: strip special characters, compute derived 
+       features, convert categories to strings and replace Inf and -Inf values. For column oriented formats, 
+       columns limits the load to those columns (plus any their derived feature formulas use).'''
+    cfg = self.directory[dfName]
+    meta = self.getMetaData(dfName)
+    if columns is None:
       df = self.loadfn[cfg['dataFormat']]( cfg['dataIdentifier'], cfg.get('dataTable') ) # in some cases, like for csv files, dataTable can be None
-      df = df.replace([ '&', '\,', '\(', '\)', '\\/', '\\\\' ],' ', regex=True)
+    else:
+      stored,meta = self.projection(dfName,columns,meta)
+      if self.isPushedDown(dfName): df = sqlpushdown.getSource(dfName).load(stored)
+      else:                         df = self.loadfn[cfg['dataFormat']]( cfg['dataIdentifier'], cfg.get('dataTable'), stored )
+    df = self.cleanSource(df,meta)
+    if meta is not None:
+      failed = [c for c in meta.index[meta['formula'].notnull()] if c not in df.columns]
+      if len(failed) > 0: # so they aren't loaded again and again for the queries that ask for them
+        print('[DataService.loadSource] WARNING: Leaving out derived feature(s) %s of %s, whose formulas failed' % (failed,dfName))
+        self.failedFormulas.setdefault(dfName,set()).update(failed)
+    return df
+
+  def cleanSource(self,df,meta):
+    '''Strip special characters, compute the derived features in meta, convert its categories to strings and 
+       replace Inf and -Inf values in a freshly loaded df'''
+    df = df.replace([ '&', '\,', '\(', '\)', '\\/', '\\\\' ],' ', regex=True)
     # /
     # ()
     # ,
     # &
-      meta = self.getMetaData(dfName)
-      if(meta is not None):
-        formulas = meta.loc[meta['formula'].notnull(),:]
-        print('[DataService.getdf] INFO: Dynamically computing values for %d derived feature(s).' % len(formulas.index))
-        for i in range(len(formulas.index)):
-          try:
-            evalStr = formulas.index[i] + '=' + formulas.ix[i,'formula']
-            print('\t %d: %s' % (i+1,evalStr))
-            # if version 0.18 or after inplace can be included as an argument
-            try:
-              assert( int(pd.__version__.split('.')[0]) > 0 or int(pd.__version__.split('.')[1]) >= 18 )
-              df.eval(evalStr, inplace=True)
-            except:
-              df.eval(evalStr)
-          except:
-            print('Eval failed')
-            print("Error:", sys.exc_info()[0])
-            traceback.print_exc()
-        categories = meta.loc[meta['type'] == 'category',:]
-        #print categories.index
-        print('[DataService.getdf] INFO: Ensuring categorical values are strings.')
-        for i in categories.index:
+    if(meta is not None):
+      formulas = meta.loc[meta['formula'].notnull(),:]
+      print('[DataService.getdf] INFO: Dynamically computing values for %d derived feature(s).' % len(formulas.index))
+      for i in range(len(formulas.index)):
+        try:
+          evalStr = formulas.index[i] + '=' + formulas.ix[i,'formula']
+          print('\t %d: %s' % (i+1,evalStr))
+          # if version 0.18 or after inplace can be included as an argument
           try:
-            cat = categories.loc[i,:]
-            print(i, df[i].dtypes)
-            if df[i].dtypes != object: 
-              print('Converting %s to strings' % i)
-              if( i == 'zip5' ):
-                def pad(n):
-                  return( format(n,'05d') )
-                df[i] = df[i].apply(pad)
-              else:
-                df[i] = df[i].apply(str)
+            assert( int(pd.__version__.split('.')[0]) > 0 or int(pd.__version__.split('.')[1]) >= 18 )
+            df.eval(evalStr, inplace=True)
           except:
-            print('Category conversion failed for %s' % i)
-            print("Error:", sys.exc_info()[0])
-            #print err
-      self.memCache[dfName] = df # cache it for later
+            df.eval(evalStr)
+        except:
+          print('Eval failed')
+          print("Error:", sys.exc_info()[0])
+          traceback.print_exc()
+      categories = meta.loc[meta['type'] == 'category',:]
+      #print categories.index
+      print('[DataService.getdf] INFO: Ensuring categorical values are strings.')
+      for i in categories.index:
+        try:
+          cat = categories.loc[i,:]
+          print(i, df[i].dtypes)
+          if df[i].dtypes != object: 
+            print('Converting %s to strings' % i)
+            if( i == 'zip5' ):
+              def pad(n):
+                return( format(n,'05d') )
+              df[i] = df[i].apply(pad)
+            else:
+              df[i] = df[i].apply(str)
+        except:
+          print('Category conversion failed for %s' % i)
+          print("Error:", sys.exc_info()[0])
+          #print err
+    # protect against Inf and -Inf values once, at load time, so queries can use the cached df without copying it. 
+    # VISDOM can handle NaNs
+    df = sanitize(df)
     return df
 
+  def projection(self,dfName,columns,meta):
+    '''The stored columns to load for columns of dfName, including the inputs of the derived ones (recursively),
+       and the rows of meta that apply to the loaded and derived columns'''
+    formulas = {}
+    if meta is not None: 
+      formulas = dict([(c,f) for c,f in meta['formula'].items() if pd.notnull(f)])
+    known = set(self.getColumns(dfName))
+    wanted = set()
+    pending = [c for c in columns if c in known]
+    while len(pending) > 0:
+      c = pending.pop()
+      if c in wanted: continue
+      wanted.add(c)
+      if c in formulas: pending.extend([name for name in IDENTIFIER_PATTERN.findall(formulas[c]) if name in known])
+    stored = [c for c in self.getColumns(dfName) if c in wanted and c not in formulas]
+    if meta is not None: meta = meta.loc[[c in wanted for c in meta.index],:]
+    return stored,meta
+
   def getMetaData(self,nm): 
     cfg = self.directory[nm]
     try:
@@ -515,10 +1833,6 @@ class DataSource(six.with_metaclass(Singleton, object)):
       logging.debug('Could not find metadata file "%s" returning None' % cfg.get('colMetaFile','unspecified') )
       return None
 
-  
-  def mergeWith( other,myCol,theirCol ):
-    pass
-
 def pretty(dic,ind=2):
   import json
   return json.dumps(dic, indent=ind)
@@ -15,8 +15,6 @@ except ImportError:
   from urllib.parse import unquote
 import logging
 import mimetypes
-# this is a new dependency
-import cachetools # pip install cachetools
 import numpy as np
 import pandas as pd
 
@@ -29,6 +27,10 @@ from jinja2        import Environment, FileSystemLoader
 from jinja2support import Jinja2TemplatePlugin, Jinja2Tool
 
 import DataService as ds
+import querypool
+import querystats
+import reloader
+import warmup
 from six.moves import range
 
 code_dir = os.path.dirname(os.path.abspath(__file__))
@@ -102,6 +104,24 @@ class Root: # the root serves (mostly) static site content
 class QueryService(object):
   
   META_CACHE = {}
+  WARMUP     = None # the WarmupPlugin, if one is running
+  def checkETag(self,etag,cacheControl):
+    # tag the response and answer a matching If-None-Match with a 304 before any query work is done.
+    # cacheControl tells browsers and proxies how long they can reuse the response without asking
+    if etag is None: return
+    cherrypy.response.headers['ETag']          = etag
+    cherrypy.response.headers['Cache-Control'] = cacheControl
+    if cherrypy.request.method not in ('GET','HEAD'): return
+    conditions = [tag.strip() for tag in cherrypy.request.headers.get('If-None-Match','').split(',')]
+    match = etag in conditions or '*' in conditions
+    if conditions != ['']: querystats.hit('etags', match) # how often clients already have the response
+    if match:
+      raise cherrypy.HTTPRedirect([], 304)
+
+  def metaMaxAge(self):
+    # column lists and stats change only when a source is reloaded
+    return 'public, max-age=%d' % getattr(ds.data_cfg, 'metaMaxAge', 300)
+
   def metaDataResponse(self,qs):
     if type(qs) == str:
       queryObj = ds.parseDesc(qs)
@@ -110,67 +130,118 @@ class QueryService(object):
     if queryObj['colList'] or queryObj['colInfo']:
       # todo: what to do when there is more than one source?
       dataSourceName = list(queryObj['dataSource'].keys())[0] # note that this is a hack to return just the first one
-      # todo: what to do with data sources that are too big?
+      dataSourceName = ds.parseJoin(dataSourceName)[0]        # and just the first of the sources it joins
+      querystats.source(dataSourceName)
+      # column names and stats come from the catalog of the source, which is read from its sidecar file 
+      # without loading the data when it is up to date (see catalog.py)
+      with querystats.stage('catalog'):
+        fingerprint,columns = self.runTask('catalog',dataSourceName)
+      self.checkETag('"%s-%s"' % (fingerprint,'colList' if queryObj['colList'] else 'colInfo'),self.metaMaxAge())
       if queryObj['colList']:
-        df = ds.restQuery('/s/' + dataSourceName) # get the full set of data
-        return json.dumps(df.columns.values.tolist()).encode('utf-8')
+        return json.dumps(columns).encode('utf-8')
       if queryObj['colInfo']: 
-        if dataSourceName in self.META_CACHE: # check for and use the cache
+        cacheKey = (dataSourceName,fingerprint)
+        querystats.hit('colInfo', cacheKey in self.META_CACHE)
+        if cacheKey in self.META_CACHE: # check for and use the cache
           print('Metadata from memory cache for %s' % (dataSourceName))
-          meta = self.META_CACHE[dataSourceName]
-        else:
-          df = ds.restQuery('/s/' + dataSourceName) # get the full set of data
-          desc = df.describe().transpose() # get basic stats for numerical columns
-          meta = ds.DataSource().getMetaData(dataSourceName) # get manual column metadata
-          if(meta is None): meta = pd.DataFrame(df.columns.values,index=df.columns.values,columns=['label'])
-          #meta = meta.join(desc)           # join on feature names, which are the indices
-          meta = pd.merge(meta, desc, left_index=True, right_index=True, how='left') # alternate join approach is more flexible
-          self.META_CACHE[dataSourceName] = meta
-        print(meta.head())
-        print('That was the head of the column metadata')
-        # must convert mixed data types (NaNs are considered floats or float64s)
-        # to single str dtype due to bug in pandas. the JS lient doesn't care whether strings or 
-        # mixed values are provided, so this work around is OK.
-        # see: https://github.com/pydata/pandas/issues/10289
-        return meta.astype(str).to_json(orient='index').encode('utf-8')
+          return self.META_CACHE[cacheKey]
+        fingerprint,body = self.runTask('colInfo',dataSourceName)
+        body = body.encode('utf-8')
+        for key in [k for k in self.META_CACHE if k[0] == dataSourceName]: del self.META_CACHE[key] # older versions
+        self.META_CACHE[(dataSourceName,fingerprint)] = body
+        return body
     else: return None
  
   @cherrypy.expose
+  @querystats.timed('query')
   def default(self,*args,**kwargs):
+    # the time of each stage of the request is sent back in its Server-Timing header (see querystats.py)
     # accept json structured query objects via post
-    if cherrypy.request.method == 'POST':
-      cl       = cherrypy.request.headers['Content-Length']
-      rawbody  = cherrypy.request.body.read(int(cl))
-      queryObj = json.loads(rawbody)
-    else: 
-      qs = unquote(cherrypy.request.query_string) # decode < and > symbols
-      queryObj = ds.parseDesc(qs)
+    with querystats.stage('parse'):
+      if cherrypy.request.method == 'POST':
+        cl       = cherrypy.request.headers['Content-Length']
+        rawbody  = cherrypy.request.body.read(int(cl))
+        queryObj = json.loads(rawbody)
+      else: 
+        qs = unquote(cherrypy.request.query_string) # decode < and > symbols
+        queryObj = ds.parseDesc(qs)
     cherrypy.response.headers['Content-Type'] = 'application/json'
     mdr = self.metaDataResponse(queryObj)
     if mdr: return mdr
-    # TODO: deprecate the use of ExpiringDict as it doesn't support Python 3 (md5 is gone)
-    # Use cachetools.TTLCache(maxsize=20, ttl=30*60)
-    # Note that memory isn't freed for expired items until a mutating set/delete operation is called.
-    # https://pythonhosted.org/cachetools/
-
-    expiringFilterCache = cherrypy.session.setdefault('EXPIRING_FILTER_CACHE', cachetools.TTLCache(maxsize=20, ttl=30*60))
-    # ExpiringDict is a fisrt in first out
-    #expiringFilterCache = cherrypy.session.setdefault('EXPIRING_FILTER_CACHE', ExpiringDict(max_len=20, max_age_seconds=30*60))
-    # OR non-expiring version which would leak memory
-    #expiringFilterCache = cherrypy.session.setdefault('EXPIRING_FILTER_CACHE', dict())
-    
-    df = ds.executeQuery(queryObj, expiringFilterCache) # pass in the session to allow query result caching
+    # clients and proxies may store results, but must check they are still current before reusing them
+    # (sources are tagged by their loaded version, or by the fingerprint of their files when they aren't loaded
+    # in this process, so the tag is made here without loading them)
+    with querystats.stage('etag'):
+      etag = ds.queryETag(queryObj)
+    self.checkETag(etag,'public, no-cache')
     if (queryObj['fmt'] == 'csv'): 
       cherrypy.response.headers['Content-Type']        = 'text/csv'
       cherrypy.response.headers["Content-Disposition"] = "attachment; filename=VISDOM_export.csv"
       cherrypy.response.headers["Pragma"]              = "no-cache"
       cherrypy.response.headers["Expires"]             = "0"
-      return df.to_csv().encode('utf-8')
-    return df.to_json(orient='split').encode('utf-8')
+    elif (queryObj['fmt'] == 'npy'): # typed arrays per column, see ds.binaryChunks
+      cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
+    # filter results are cached across all sessions in ds.DataSource.maskCache, which is sized in bytes 
+    # via maskCacheBytes in data_cfg
+    if self.poolRunning(): return self.runTask('query',queryObj)
+    # stream the result in chunks of rows (gzipped chunk by chunk by tools.gzip) rather than encoding 
+    # the whole result in memory before the first byte is sent
+    df = ds.executeQuery(queryObj)
+    cherrypy.response.stream = True
+    return ds.serializeChunks(df,queryObj['fmt'])
+
+  def poolRunning(self):
+    return len(cherrypy.engine.listeners.get('execute-query',[])) > 0
+
+  def runTask(self,task,*args):
+    # run query work in the pool of worker processes when one is configured (see querypool.py)
+    # or otherwise right here in the http thread
+    results = cherrypy.engine.publish('execute-query', task, *args)
+    if results: return results.pop()
+    return querypool.TASKS[task](*args)
   
   @cherrypy.expose
-  def sources(self):
+  @querystats.timed('histograms')
+  def histograms(self,*args,**kwargs):
+    # batched leave-one-out histograms for the crossfilter panel. Accepts a json object via post like
+    # { "source"     : "basics",
+    #   "filters"    : ["(kw_mean>1+kw_mean<5)", "(zip5'in'[93304,94611])"],
+    #   "histograms" : [{"column" : "kw_mean", "bins" : 100, "domain" : [0,10], "exclude" : 0}] }
+    # where each histogram is filtered by all the filters except the one at index "exclude" and
+    # responds with a json list of split oriented histogram tables, one per requested histogram
+    if cherrypy.request.method != 'POST':
+      raise cherrypy.HTTPError(405, 'Batched histograms must be requested via POST')
+    cl      = cherrypy.request.headers['Content-Length']
+    rawbody = cherrypy.request.body.read(int(cl))
+    req     = json.loads(rawbody)
     cherrypy.response.headers['Content-Type'] = 'application/json'
+    return self.runTask('histograms', req['source'], req.get('filters',[]), req['histograms']).encode('utf-8')
+
+  @cherrypy.expose
+  def status(self):
+    # readiness probe for load balancers: 503 until the sources configured to preload have been warmed up, 
+    # along with the load state, time and size of every source
+    cherrypy.response.headers['Content-Type']  = 'application/json'
+    cherrypy.response.headers['Cache-Control'] = 'no-cache'
+    ready = self.WARMUP is None or self.WARMUP.ready()
+    if not ready: cherrypy.response.status = 503
+    return json.dumps({ 'ready' : ready, 'sources' : ds.sourceStatus() }).encode('utf-8')
+
+  @cherrypy.expose
+  def stats(self):
+    # the p50, p95 and p99 latencies of each endpoint, stage and source over the last statsWindow minutes and
+    # the hit rates of the caches (see querystats.py), along with the mask cache of this process, which
+    # holds the masks of the queries that don't run in worker processes
+    cherrypy.response.headers['Content-Type']  = 'application/json'
+    cherrypy.response.headers['Cache-Control'] = 'no-cache'
+    stats = querystats.STATS.summary()
+    stats['maskCache'] = ds.DataSource.maskCache.stats()
+    return json.dumps(stats).encode('utf-8')
+
+  @cherrypy.expose
+  def sources(self):
+    cherrypy.response.headers['Content-Type']  = 'application/json'
+    cherrypy.response.headers['Cache-Control'] = self.metaMaxAge() # the sources only change with a restart
     return json.dumps(ds.publicSources()).encode('utf-8')
 
   @cherrypy.expose
@@ -181,134 +252,24 @@ class QueryService(object):
     return ds.pretty(ds.parseDesc(qs)).encode('utf-8')
 
   @cherrypy.expose
+  @querystats.timed('shape')
   def shape(self,*args,**kwargs):
     cherrypy.response.headers['Content-Type'] = 'application/json'
     # query string
     qs = unquote(cherrypy.request.query_string) # decode < and > symbols
     mdr = self.metaDataResponse(qs)
     if mdr: return mdr
-    pieces = qs.split('/')
-    print(pieces)
-    sourceName = pieces[2]
-    sourceCfg = ds.DataSource().getCfg(sourceName)
-    if sourceCfg is None: 
-      raise ValueError("no config info available for %s" % sourceName)
-    sourcePrefix = sourceCfg.get('prefix',None)
-    if sourcePrefix is None: sourcePrefix = sourceName
-    sortType = pieces[3]  # 'counts' or 'kwh'
-    topN = int(pieces[4])
-    qs = '/' + '/'.join(pieces[5:])
-    #print sortType, topN, qs
-    #/counts/10 or /kwh/10
-    ids = ds.restQuery('/s/' + sourceName + '|id' + qs) # find the list of unique ids filtered using the /f/etc. query 
-    # load the counts of shapes per customer per dict shape
-    dictMembers = ds.restQuery('/s/%sDictMembers' % sourcePrefix)
-    dictKwh     = ds.restQuery('/s/%sDictKwh' % sourcePrefix)
-    firstDataColIdx = 1
-    idName = 'id'
-    filteredDataColIdx = 1
-    # TODO: hack to support hand coded pgeres data along side standardized new VISDOM-R encoded data
-    if sourcePrefix == 'pgeres':
-      firstDataColIdx = 3
-      filteredDataColIdx = 4
-      idName = 'sp_id'
-
-    # total all the cluster members (total # of shapes) and all the kwh
-    totalMembers  = float(dictMembers.iloc[:,firstDataColIdx:].sum().sum()) # sum both dimensions, ensuring float outcome
-    totalKwh      = dictKwh.iloc[:,firstDataColIdx:].sum().sum()            # sum both dimensions
-    print('Total: Members: %d, kWh: %0.1f' % (totalMembers, totalKwh))
-    filteredCounts = pd.merge(ids, dictMembers, left_on='id', right_on=idName, how='inner')
-    # load the kwh sums of shapes per customer per dict shape
-    filteredKwh    = pd.merge(ids, dictKwh,     left_on='id', right_on=idName, how='inner')
-
-    
-    print('Filtered customer count: %d' % len(ids))
-    print('Filtered customers with shape data: %d' % len(filteredCounts.index))
-    # load the dictionary shapes
-    shapes = ds.restQuery('/s/%sDictCenters' % sourcePrefix)
-    if topN > len(shapes.index): topN = len(shapes.index)
-    countSum = filteredCounts.iloc[:,filteredDataColIdx:].sum(axis=0) # sum the cluster membership count columns
-    kwhSum   =    filteredKwh.iloc[:,filteredDataColIdx:].sum(axis=0) # sum the cluster kwh total columns
-
-    # compute the membership counts and total energy for each of the qualitative categories 
-    categoryMap = ds.restQuery('/s/%sCategoryMapping'  % sourcePrefix) # load shapes to qualitative categories
-    categoryMap['total_members'] = countSum.tolist() # strip the index so they match
-    categoryMap['total_kwh']     = kwhSum.tolist()   # strip the index so they match
-    categoryGroups = categoryMap[['name','total_members','total_kwh']].groupby('name')
-    
-    categoryStats                         = categoryGroups.sum()
-    categoryStats['pct_kwh']              = categoryStats.total_kwh     / totalKwh
-    categoryStats['pct_members']          = categoryStats.total_members / totalMembers
-    categoryStats['pct_filtered_kwh']     = categoryStats.total_kwh     / categoryMap['total_kwh'].sum()
-    categoryStats['pct_filtered_members'] = categoryStats.total_members / categoryMap['total_members'].sum()
-    categoryStats['name']                 = categoryStats.index # add the index as a regular column, so the json format can be records.
-    print(categoryStats)
-    if sortType == 'members':
-      sortIdx = np.argsort(countSum)[::-1] # note that [::-1] reverses the array
-    elif sortType == 'kwh':
-      sortIdx = np.argsort(  kwhSum)[::-1]
-    else: 
-      raise ValueError('Bad sortType=%s from query %s' % (sortType,qs))
-    
-    topIdx = sortIdx[list(range(topN))].as_matrix()
-
-    topShapes = shapes.iloc[topIdx,:]
-    #print pd.Series(kwhSum[topIdx].as_matrix(), index=topShapes.index)
-    print('Filtered: Members: %d, kWh: %0.1f' % (kwhSum[topIdx].sum(), countSum[topIdx].sum()))
-
-    topShapes['total_kwh']            = pd.Series(  kwhSum[topIdx].as_matrix(),                               index=topShapes.index)
-    topShapes['total_members']        = pd.Series(countSum[topIdx].as_matrix(),                               index=topShapes.index)
-    topShapes['pct_kwh']              = pd.Series(  kwhSum[topIdx].as_matrix() * 100 / totalKwh,              index=topShapes.index)
-    topShapes['pct_members']          = pd.Series(countSum[topIdx].as_matrix() * 100 / totalMembers,          index=topShapes.index)
-    topShapes['pct_filtered_kwh']     = pd.Series(  kwhSum[topIdx].as_matrix() * 100 / kwhSum.sum(),          index=topShapes.index)
-    topShapes['pct_filtered_members'] = pd.Series(countSum[topIdx].as_matrix() * 100 / float(countSum.sum()), index=topShapes.index)
-    
-    # building a json format map with the top shapes under "top" and the categorical totals under "categories"
-    out = '{"top":%s,"categories":%s}' % (topShapes.to_json(orient='split'),categoryStats.to_json(orient='records'))
-    return out.encode('utf-8')
+    return self.runTask('shape',qs).encode('utf-8')
 
   @cherrypy.expose
+  @querystats.timed('response')
   def response(self,*args,**kwargs):
     cherrypy.response.headers['Content-Type'] = 'application/json'
     # query string
     qs = unquote(cherrypy.request.query_string) # decode < and > symbols
     mdr = self.metaDataResponse(qs)
     if mdr: return mdr
-    pieces = qs.split('/')
-    print(pieces)
-    sourceName = pieces[2]
-    sourceCfg = ds.DataSource().getCfg(sourceName)
-    if sourceCfg is None: 
-      raise ValueError("no config info available for %s" % sourceName)
-    sourcePrefix = sourceCfg.get('prefix',None)
-    if sourcePrefix is None: sourcePrefix = sourceName
-    sortType = pieces[3]  # 'savings' or 'pct_savings'
-    desc = pieces[4] == 'true'
-    topN = int(pieces[5])
-    qs = '/' + '/'.join(pieces[6:])
-    #print sortType, topN, qs
-    #/counts/10 or /kwh/10
-    ids = ds.restQuery('/s/' + sourceName + '|id' + qs) # find the list of unique ids filtered using the /f/etc. query 
-    # load the counts of shapes per customer per dict shape
-    custResponse  = ds.restQuery('/s/%sResponseCustomer' % sourcePrefix)
-    eventResponse = ds.restQuery('/s/%sResponseEvent' % sourcePrefix)
-    firstFcst = eventResponse.columns.get_loc('hkw1_fcst')
-    firstObs  = eventResponse.columns.get_loc('hkw1_obs')
-    forecast = np.array( [ float( row[ firstFcst - 1 + row['hour']] + 0.0000001 ) # prevent divide by zero
-                            for index, row in eventResponse.iterrows() ] )
-    actual   = np.array( [ float( row[ firstObs  - 1 + row['hour']] + 0.0000001 ) # prevent imbalance from / 0
-                            for index, row in eventResponse.iterrows() ] )
-    eventResponse['pct_savings'] = (forecast - actual) / forecast
-    eventResponse['savings']     = forecast - actual
-    eventResponse['forecast']    = forecast
-    eventResponse['actual']      = actual
-    # sort using the specified sort order
-    eventResponse = eventResponse.sort(sortType,ascending=(not desc))
-    
-    # building a json format map with the top shapes under "top" and the categorical totals under "categories"
-    #return '{"top":%s,"categories":%s}' % (topShapes.to_json(orient='split'),categoryStats.to_json(orient='records')) 
-    out = '{"top":%s}' % (eventResponse.head(topN).to_json(orient='split'))
-    return out.encode('utf-8')
+    return self.runTask('response',qs).encode('utf-8')
 
 if __name__ == "__main__":
   CONSOLE_LOG = False
@@ -335,6 +296,21 @@ if __name__ == "__main__":
   #root.upload   = UploadService()
   cherrypy.server.socket_host = '0.0.0.0' # bind to all available interfaces (is this bad?)
 
+  # optionally run queries in worker processes, which are shut down with the engine
+  queryWorkers = getattr(ds.data_cfg, 'queryWorkers', 0)
+  preload = warmup.preloadSources()
+  if queryWorkers > 0:
+    querypool.QueryPoolPlugin(cherrypy.engine, queryWorkers, preload, getattr(ds.data_cfg, 'queryTimeout', None)).subscribe()
+  # load the preload sources in the background (only their catalogs when the workers hold the data)
+  QueryService.WARMUP = warmup.WarmupPlugin(cherrypy.engine, preload, getattr(ds.data_cfg, 'warmupThreads', 1), 
+                                            loadData=(queryWorkers <= 0))
+  QueryService.WARMUP.subscribe()
+  # the window of the latency percentiles served by /query/stats
+  querystats.STATS.minutes = getattr(ds.data_cfg, 'statsWindow', 15)
+  # reload sources whose data files change, swapping in the new data without a restart
+  if reloader.reloadInterval() > 0:
+    reloader.ReloadPlugin(cherrypy.engine, reloader.reloadInterval()).subscribe()
+
   # HACK to get cherrypy config parsed correctly under python 3.5
   # see https://github.com/cherrypy/cherrypy/issues/1382
   from cherrypy._cpconfig import reprconf
@@ -0,0 +1,11 @@
+'''Benchmarks of the VISDOM query pipeline over synthetic data shaped like the real feature data.
+
+  python -m benchmark --rows 1000000 --out before.json
+  git checkout <change>
+  python -m benchmark --rows 1000000 --out after.json
+  python -m benchmark.compare before.json after.json
+
+synthetic.py generates the sources (once per spec, in a temporary directory unless --data is given), suite.py
+times parseDesc, the filters, the executeQuery stages, quantileStats, serialization and the QueryService
+endpoints over them and compare.py compares the json results of two runs. Run from the repository root.
+'''
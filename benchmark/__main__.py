@@ -0,0 +1,38 @@
+'''Generate the synthetic data if needed and run the benchmarks over it, e.g.
+
+  python -m benchmark --rows 1000000 --columns 200 --only executeQuery --out results.json
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import os
+import sys
+import tempfile
+
+from benchmark import suite, synthetic
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Time the VISDOM query pipeline over synthetic data')
+  parser.add_argument('--rows',    type=int, default=100000, help='customers in the feature source')
+  parser.add_argument('--columns', type=int, default=50,     help='features in the feature source')
+  parser.add_argument('--shapes',  type=int, default=30,     help='load shapes in the shape dictionary')
+  parser.add_argument('--format',  default='csv', choices=sorted(synthetic.FORMATS.keys()))
+  parser.add_argument('--seed',    type=int, default=0)
+  parser.add_argument('--data',    help='directory for the generated data, by default under the temp directory')
+  parser.add_argument('--repeat',  type=int, default=5, help='timings of each benchmark')
+  parser.add_argument('--warmup',  type=int, default=1, help='untimed calls of each benchmark first')
+  parser.add_argument('--only',    action='append', help='run just the benchmarks whose names contain this')
+  parser.add_argument('--no-endpoints', dest='endpoints', action='store_false', help="skip the QueryService endpoints")
+  parser.add_argument('--out',     default='benchmark.json', help='where to write the json results')
+  args = parser.parse_args(argv)
+  dataDir = args.data
+  if dataDir is None:
+    dataDir = os.path.join(tempfile.gettempdir(),'visdom-benchmark','%s-%dx%d-%d' % (args.format,args.rows,args.columns,args.seed))
+  spec = synthetic.generate(dataDir,args.rows,args.columns,args.shapes,fmt=args.format,seed=args.seed)
+  results = suite.run(dataDir,spec,args.repeat,args.warmup,args.only,args.endpoints)
+  suite.save(results,args.out)
+  print('Wrote %d results to %s' % (len(results['results']),args.out),file=sys.stderr)
+  return 1 if len([r for r in results['results'] if 'error' in r]) > 0 else 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
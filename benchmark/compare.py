@@ -0,0 +1,52 @@
+'''Compare two benchmark result files (see suite.py), e.g. from the commits before and after a change:
+
+  python -m benchmark.compare before.json after.json
+
+prints the ratio of the best time and peak memory of each benchmark in both, marking the ones that got slower
+or faster by more than the threshold (10% by default), and exits with status 1 if any got slower, so it can gate
+a build. The best of the repeated timings is the least affected by other work on the machine, but timings are
+still only comparable between runs on the same machine over the same data spec.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+import json
+import sys
+
+__all__ = ['compare', 'loadResults']
+
+def loadResults(path):
+  with open(path) as f: return json.load(f)
+
+def compare(before,after,threshold=1.1):
+  '''The (name, time ratio, memory ratio, verdict) of each benchmark in both result dicts, where the verdict is
+     'slower', 'faster' or '' depending on whether the time ratio is beyond threshold either way'''
+  old = dict([(r['name'],r) for r in before['results'] if 'error' not in r])
+  rows = []
+  for r in after['results']:
+    o = old.get(r['name'])
+    if o is None or 'error' in r: continue
+    ratio = r['min'] / o['min'] if o['min'] > 0 else float('nan')
+    memory = None
+    if r.get('peakBytes') and o.get('peakBytes'): memory = float(r['peakBytes']) / o['peakBytes']
+    verdict = 'slower' if ratio > threshold else 'faster' if ratio < 1.0 / threshold else ''
+    rows.append((r['name'],ratio,memory,verdict))
+  return rows
+
+def main(argv):
+  import argparse
+  parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+  parser.add_argument('before')
+  parser.add_argument('after')
+  parser.add_argument('--threshold', type=float, default=1.1, help='time ratio beyond which a change is reported')
+  args = parser.parse_args(argv)
+  before,after = loadResults(args.before),loadResults(args.after)
+  if before.get('data') != after.get('data'):
+    print('Warning: the runs used different data: %s vs %s' % (before.get('data'),after.get('data')))
+  print('%s (%s) -> %s (%s)' % (args.before,before.get('commit'),args.after,after.get('commit')))
+  rows = compare(before,after,args.threshold)
+  for name,ratio,memory,verdict in rows:
+    print('%-36s time x%6.2f  memory %s  %s' % (name,ratio,'x%6.2f' % memory if memory is not None else '     -',verdict))
+  return 1 if len([row for row in rows if row[3] == 'slower']) > 0 else 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,228 @@
+'''Timing and memory benchmarks of the query pipeline over synthetic data (see synthetic.py).
+
+Each benchmark is a function run once to warm up (so the indexes, sorted orders and precomputed histograms a
+running server would have are built), then timed repeat times with the garbage collector off, each time over
+number calls, and then run once more under tracemalloc to find the peak memory it allocates (where tracemalloc
+is available). Benchmarks named *.cold run their filters without the shared mask cache.
+
+The results are saved as json along with the commit, the versions of python, numpy and pandas and the spec of
+the data, so runs on different commits can be compared with compare.py.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+
+from timeit import default_timer as currentTime
+try:
+  import tracemalloc
+except ImportError: # python 2, where memory isn't measured
+  tracemalloc = None
+
+__all__ = ['Benchmark', 'benchmarks', 'run', 'timeBenchmark']
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_VERSION = 1
+
+class Quiet(object):
+  '''Send the progress printed by DataService to /dev/null while benchmarks run'''
+  def __enter__(self):
+    self.stdout = sys.stdout
+    self.devnull = open(os.devnull,'w')
+    sys.stdout = self.devnull
+    return self
+
+  def __exit__(self,*exc):
+    sys.stdout = self.stdout
+    self.devnull.close()
+
+class Benchmark(object):
+  '''A named function to time, run number times per timing, and repeat times at most if given'''
+  def __init__(self,group,name,fn,number=1,repeat=None):
+    self.group  = group
+    self.name   = name
+    self.fn     = fn
+    self.number = number
+    self.repeat = repeat
+
+def loadServer():
+  '''The VISDOM-server module, whose file name isn't a valid module name'''
+  path = os.path.join(REPO_DIR,'VISDOM-server.py')
+  try:
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('visdom_server',path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+  except ImportError: # python 2
+    import imp
+    module = imp.load_source('visdom_server',path)
+  return module
+
+def endpoint(service,method,qs):
+  '''Call a QueryService endpoint outside of a running server, with qs as its query string'''
+  import cherrypy
+  def call():
+    cherrypy.request.method = 'GET'
+    cherrypy.request.query_string = qs
+    out = getattr(service,method)()
+    if not isinstance(out,bytes): out = b''.join(out) # streamed
+    return out
+  return call
+
+def benchmarks(ds,prefix,server=None):
+  '''The benchmarks of the sources generated with prefix, including the QueryService endpoints if the
+     VISDOM-server module is given'''
+  P = prefix
+  df,version,srcIndexes = ds.DataSource().getLoaded(P)
+  zips = sorted(df['zip5'].value_counts().index[:3])
+  RANGE    = '(kw_mean>1+kw_mean<3)'
+  CATEGORY = "(zip5'in'[%s])" % ','.join([str(z) for z in zips])
+  COMPOUND = '(%s+nObs>1000)|%s' % (RANGE,CATEGORY)
+  filters  = dict([(name,ds.parseFilters(f)) for name,f in [('range',RANGE),('category',CATEGORY),('compound',COMPOUND)]])
+  query = lambda qs,cold=False: (lambda: ds.executeQuery(ds.parseDesc(qs),{} if cold else None))
+  out = [
+    Benchmark('parse','parseDesc',lambda: ds.parseDesc('/s/%s|kw_mean+kw_max+zip5/f/%s/a/zip5|mean/desc/kw_mean/head/100' % (P,COMPOUND)),number=1000),
+    Benchmark('parse','compileFilters',lambda: ds.FilterPlan(ds.filterNode(filters['compound'])),number=1000),
+    Benchmark('filter','runFilters.range.scan',lambda: ds.runFilters(df,filters['range'])),
+    Benchmark('filter','runFilters.range.indexed',lambda: ds.runFilters(df,filters['range'],None,version,srcIndexes)),
+    Benchmark('filter','runFilters.category.scan',lambda: ds.runFilters(df,filters['category'])),
+    Benchmark('filter','runFilters.category.indexed',lambda: ds.runFilters(df,filters['category'],None,version,srcIndexes)),
+    Benchmark('filter','runFilters.compound.indexed',lambda: ds.runFilters(df,filters['compound'],None,version,srcIndexes)),
+    Benchmark('filter','runFilters.compound.cached',lambda: ds.runFilters(df,filters['compound'],ds.DataSource.maskCache,version,srcIndexes)),
+    Benchmark('query','executeQuery.select',query('/s/%s|id+kw_mean+kw_max' % P)),
+    Benchmark('query','executeQuery.filter.cold',query('/s/%s|id+kw_mean/f/%s' % (P,COMPOUND),cold=True)),
+    Benchmark('query','executeQuery.filter',query('/s/%s|id+kw_mean/f/%s' % (P,COMPOUND))),
+    Benchmark('query','executeQuery.aggregate',query('/s/%s|kw_mean+kw_max+nObs/f/%s/a/zip5|mean' % (P,RANGE))),
+    Benchmark('query','executeQuery.aggregate.median',query('/s/%s|kw_mean+kw_max/f/%s/a/zip5|median' % (P,RANGE))),
+    Benchmark('query','executeQuery.hist.superset',query('/s/%s|kw_mean/hist/100' % P)),
+    Benchmark('query','executeQuery.hist',query('/s/%s|kw_mean/f/%s/hist/100' % (P,CATEGORY))),
+    Benchmark('query','executeQuery.sort',query('/s/%s|id+kw_mean/f/%s/asc/kw_mean' % (P,RANGE))),
+    Benchmark('query','executeQuery.sort.head',query('/s/%s|id+kw_mean/f/%s/desc/kw_max/head/100' % (P,RANGE))),
+    Benchmark('query','executeQuery.rnd',query('/s/%s|id+kw_mean/f/%s/rnd/1000' % (P,RANGE))),
+    Benchmark('query','executeQuery.thin',query('/s/%s|id+kw_mean/f/%s/asc/kw_mean/thin/1000' % (P,RANGE))),
+    Benchmark('query','executeQuery.bin',query('/s/%s|kw_max/f/%s/bin/10' % (P,RANGE))),
+    Benchmark('query','executeQuery.bin.approx',query('/s/%s|kw_max/bin/10/approx' % P)),
+    Benchmark('query','executeQuery.eval',query('/s/%s|eval(kw_max - kw_min)/f/%s' % (P,RANGE))),
+    Benchmark('query','executeQuery.join',query('/s/%s*%sWeather@zip5|kw_mean+cdd/f/(cdd>1500+kw_mean>1)' % (P,P))),
+    Benchmark('query','leaveOneOutHistograms',lambda: ds.leaveOneOutHistograms(P,[RANGE,CATEGORY,'(nObs>1000)'],
+      [{ 'column' : col, 'bins' : 100, 'exclude' : i } for i,col in enumerate(['kw_mean','kw_max','nObs','tout_mean'])])),
+    Benchmark('quantiles','quantileStats',lambda: ds.quantileStats(df,'kw_mean',10)),
+    Benchmark('quantiles','quantileStats.missing',lambda: ds.quantileStats(df,'f000' if 'f000' in df.columns else 'kw_max',10)),
+  ]
+  result = ds.executeQuery(ds.parseDesc('/s/%s|id+zip5+kw_mean+kw_max+nObs/f/%s' % (P,RANGE)))
+  for fmt in ('json','csv','npy'):
+    out.append(Benchmark('serialize','serializeChunks.%s' % fmt,lambda fmt=fmt: b''.join(ds.serializeChunks(result,fmt))))
+  out.append(Benchmark('serialize','serialize.json',lambda: ds.serialize(result)))
+  if server is not None:
+    service = server.QueryService()
+    out += [
+      Benchmark('endpoint','QueryService.query',endpoint(service,'default','/s/%s|id+kw_mean/f/%s/fmt/csv' % (P,RANGE))),
+      Benchmark('endpoint','QueryService.colInfo',endpoint(service,'default','/s/%s/colInfo' % P)),
+      Benchmark('endpoint','QueryService.shape',endpoint(service,'shape','/s/%s/kwh/10/f/%s' % (P,RANGE))),
+      Benchmark('endpoint','QueryService.response',endpoint(service,'response','/s/%s/savings/true/10/f/%s' % (P,RANGE))),
+    ]
+  out.append(Benchmark('load','DataSource.build',lambda: ds.DataSource().build(P)[0],repeat=3))
+  return out
+
+def timeBenchmark(bench,repeat=5,warmup=1):
+  '''Time a Benchmark, returning a dict of the min, median, mean, max and standard deviation of the seconds
+     per call, the peak bytes allocated by one call (None without tracemalloc) and the rows of its result'''
+  with Quiet():
+    for i in range(warmup): out = bench.fn()
+    repeat = min(repeat,bench.repeat) if bench.repeat is not None else repeat
+    times = []
+    enabled = gc.isenabled()
+    try:
+      for i in range(repeat):
+        gc.collect()
+        gc.disable()
+        start = currentTime()
+        for j in range(bench.number): out = bench.fn()
+        times.append((currentTime() - start) / bench.number)
+        if enabled: gc.enable()
+    finally:
+      if enabled: gc.enable()
+    peak = None
+    if tracemalloc is not None:
+      gc.collect()
+      tracemalloc.start()
+      try:
+        out = bench.fn()
+        peak = tracemalloc.get_traced_memory()[1]
+      finally:
+        tracemalloc.stop()
+  times = np.array(times)
+  result = { 'group' : bench.group, 'name' : bench.name, 'number' : bench.number, 'repeat' : repeat,
+             'min' : times.min(), 'median' : float(np.median(times)), 'mean' : times.mean(), 'max' : times.max(),
+             'stdev' : times.std(), 'peakBytes' : peak, 'rows' : None }
+  if isinstance(out,(pd.DataFrame,pd.Series)): result['rows'] = len(out.index)
+  return dict([(k,float(v) if isinstance(v,np.floating) else v) for k,v in result.items()])
+
+def gitCommit():
+  try:
+    commit = subprocess.check_output(['git','rev-parse','HEAD'],cwd=REPO_DIR).decode('utf-8').strip()
+    dirty  = subprocess.check_output(['git','status','--porcelain','--untracked-files=no'],cwd=REPO_DIR).strip() != b''
+    return commit + ('-dirty' if dirty else '')
+  except (OSError,subprocess.CalledProcessError):
+    return None
+
+def environment():
+  return { 'python' : platform.python_version(), 'numpy' : np.__version__, 'pandas' : pd.__version__,
+           'platform' : platform.platform(), 'machine' : platform.machine(), 'processor' : platform.processor() }
+
+def importDataService(dataDir):
+  '''Import DataService configured by the data_cfg.py that synthetic.generate wrote to dataDir'''
+  cfg = sys.modules.get('data_cfg')
+  if cfg is not None and os.path.dirname(os.path.abspath(cfg.__file__)) != os.path.abspath(dataDir):
+    raise RuntimeError('data_cfg is already imported from %s, so the benchmarks need a fresh process' % cfg.__file__)
+  sys.path.insert(0,os.path.abspath(dataDir))
+  if REPO_DIR not in sys.path: sys.path.insert(1,REPO_DIR)
+  import DataService as ds
+  return ds
+
+def run(dataDir,spec,repeat=5,warmup=1,only=None,endpoints=True,log=sys.stderr):
+  '''Run the benchmarks (or those whose names contain any of the strings in only) over the data written to
+     dataDir by synthetic.generate with spec, and return the results as a json compatible dict'''
+  ds = importDataService(dataDir)
+  server = None
+  if endpoints:
+    try:
+      with Quiet(): server = loadServer()
+    except ImportError as e:
+      print('Skipping the QueryService endpoints, which need the server dependencies: %s' % e,file=log)
+  start = currentTime()
+  with Quiet():
+    for name in sorted(ds.DataSource.directory.keys()): ds.DataSource().getdf(name)
+    suite = benchmarks(ds,spec['prefix'],server)
+  print('Loaded the sources in %0.1f seconds' % (currentTime() - start),file=log)
+  results = []
+  for bench in suite:
+    if only and not any([s in bench.name for s in only]): continue
+    try:
+      result = timeBenchmark(bench,repeat,warmup)
+    except Exception as e:
+      traceback.print_exc()
+      result = { 'group' : bench.group, 'name' : bench.name, 'error' : '%s: %s' % (type(e).__name__,e) }
+    else:
+      peak = '' if result['peakBytes'] is None else '%10.1f MB' % (result['peakBytes'] / 1e6)
+      print('%-36s %10.3f ms %s' % (bench.name,result['median'] * 1000,peak),file=log)
+    results.append(result)
+  return { 'version'  : RESULTS_VERSION,
+           'created'  : time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'commit'   : gitCommit(),
+           'env'      : environment(),
+           'data'     : spec,
+           'settings' : { 'repeat' : repeat, 'warmup' : warmup },
+           'results'  : results }
+
+def save(results,path):
+  with open(path,'w') as f: json.dump(results,f,indent=2,sort_keys=True)
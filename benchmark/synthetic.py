@@ -0,0 +1,172 @@
+'''Synthetic data sources shaped like the VISDOM feature data, for benchmarks.
+
+generate() writes a set of related sources to a directory, along with a data_cfg.py that configures them:
+
+- <prefix>                  one row of features per customer: id, a zip5 category, nObs and the consumption
+                            features, plus numbered float features (with a few missing values) up to the requested
+                            number of columns, described by <prefix>_META.csv (which also defines a formula feature)
+- <prefix>DictMembers       the number of days each customer matched each load shape, for most of the customers
+- <prefix>DictKwh           the kWh of those days, by shape
+- <prefix>DictCenters       the 24 hourly values of each load shape
+- <prefix>CategoryMapping   the qualitative category of each load shape
+- <prefix>ResponseEvent     the hourly forecast and observed demand of customers during demand response events
+- <prefix>Weather           weather features by zip5, which can be joined to the features (see DataService.parseJoin)
+
+The data is drawn from a seeded random generator, so the same arguments always give the same data, and a
+directory that already holds the data for the same arguments is reused rather than written again.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+import json
+import os
+import pprint
+
+import numpy as np
+import pandas as pd
+
+from timeit import default_timer as currentTime
+
+__all__ = ['generate', 'FORMATS']
+
+# the file extension of each dataFormat sources can be written in
+FORMATS = { 'csv' : 'csv', 'parquet' : 'parquet', 'feather' : 'feather', 'hdftable' : 'h5' }
+
+BASE_FEATURES = ['id','zip5','nObs','kw_mean','kw_max','kw_min','kw_total','tout_mean'] # before the numbered ones
+N_HOURS = 24
+
+def writeTable(df,path,fmt,name):
+  if   fmt == 'csv':      df.to_csv(path,index=False)
+  elif fmt == 'parquet':  df.to_parquet(path,index=False)
+  elif fmt == 'feather':  df.reset_index(drop=True).to_feather(path)
+  elif fmt == 'hdftable': df.to_hdf(path,key=name,format='table',mode='w')
+  else: raise ValueError('Unknown format %s, not one of %s' % (fmt,sorted(FORMATS.keys())))
+
+def zipCodes(rng,n,nZips):
+  '''n zip codes drawn from nZips of them, a few of which are much more common than the rest as in real data'''
+  zips = np.sort(rng.choice(np.arange(90001,96162),nZips,replace=False))
+  weights = 1.0 / np.arange(1,nZips + 1)
+  return zips[rng.choice(nZips,n,p=weights / weights.sum())]
+
+def features(rng,rows,columns):
+  kw = rng.lognormal(0.0,0.6,rows)
+  df = pd.DataFrame({ 'id'        : rng.permutation(rows) + 1,
+                      'zip5'      : zipCodes(rng,rows,max(10,rows // 2000)),
+                      'nObs'      : rng.randint(300,8761,rows),
+                      'kw_mean'   : kw,
+                      'kw_max'    : kw * rng.uniform(2.0,6.0,rows),
+                      'kw_min'    : kw * rng.uniform(0.05,0.5,rows),
+                      'kw_total'  : kw * 8760,
+                      'tout_mean' : rng.normal(62.0,8.0,rows) }, columns=BASE_FEATURES)
+  for i in range(max(0,columns - len(BASE_FEATURES))):
+    vals = rng.normal(0.0,1.0,rows) * (i + 1)
+    vals[rng.rand(rows) < 0.02] = np.nan
+    df['f%03d' % i] = vals
+  return df
+
+def featureMeta(df):
+  rows = [('zip5','','1.geography','','category','5 digit zip code'),
+          ('nObs','','7.meta','count','int','# of electricity observations'),
+          ('kw_mean','','2.consumption','kW','float','mean demand (all obs)'),
+          ('kw_max','','2.consumption','kW','float','max demand'),
+          ('kw_min','','2.consumption','kW','float','min demand'),
+          ('kw_total','','2.consumption','kWh','float','total consumption'),
+          ('tout_mean','','6.weather','deg F','float','mean outside temperature'),
+          ('kw_range','kw_max - kw_min','2.consumption','kW','float','demand range')]
+  rows += [(c,'','8.other','','float','feature %s' % c) for c in df.columns if c not in BASE_FEATURES]
+  meta = pd.DataFrame(rows,columns=['variable','formula','group','units','type','label'])
+  return meta.set_index('variable')
+
+def shapeTables(rng,ids,nShapes,shapesPerCustomer=5):
+  '''The DictMembers, DictKwh, DictCenters and CategoryMapping tables of the load shapes of 90% of the ids'''
+  members = np.sort(rng.choice(ids,int(len(ids) * 0.9),replace=False))
+  n = len(members)
+  counts = np.zeros((n,nShapes),dtype=np.int32)
+  rows = np.repeat(np.arange(n),shapesPerCustomer)
+  np.add.at(counts,(rows,rng.randint(0,nShapes,len(rows))),rng.randint(1,60,len(rows)).astype(np.int32))
+  centers = rng.dirichlet(np.ones(N_HOURS),nShapes)
+  shapeNames = ['s%d' % i for i in range(nShapes)]
+  dictMembers = pd.DataFrame(counts,columns=shapeNames)
+  dictMembers.insert(0,'id',members)
+  dictKwh = pd.DataFrame(counts * centers.sum(axis=1) * rng.uniform(5.0,40.0,(n,1)),columns=shapeNames)
+  dictKwh.insert(0,'id',members)
+  dictCenters = pd.DataFrame(centers,columns=['h%d' % h for h in range(N_HOURS)])
+  categories = pd.DataFrame({ 'name' : rng.choice(['night','morning','peak','evening','flat'],nShapes) })
+  return dictMembers,dictKwh,dictCenters,categories
+
+def responseEvents(rng,ids,nRows,nEvents=20):
+  '''Hourly forecast and observed demand of customers in nEvents events, one row per customer and event'''
+  df = pd.DataFrame({ 'id'    : rng.choice(ids,nRows),
+                      'event' : rng.randint(0,nEvents,nRows),
+                      'hour'  : rng.randint(1,N_HOURS + 1,nRows) }, columns=['id','event','hour'])
+  fcst = rng.lognormal(0.3,0.5,(nRows,N_HOURS))
+  obs  = fcst * rng.uniform(0.7,1.1,(nRows,N_HOURS))
+  for h in range(N_HOURS): df['hkw%d_fcst' % (h + 1)] = fcst[:,h]
+  for h in range(N_HOURS): df['hkw%d_obs' % (h + 1)]  = obs[:,h]
+  return df
+
+def weather(rng,zips):
+  zips = np.unique(zips)
+  return pd.DataFrame({ 'zip5' : zips,
+                        'cdd'  : rng.uniform(0,3000,len(zips)),
+                        'hdd'  : rng.uniform(0,4000,len(zips)),
+                        'climate_zone' : rng.randint(1,17,len(zips)) }, columns=['zip5','cdd','hdd','climate_zone'])
+
+def sourceConfig(name,path,fmt,label,meta=None,public=False,prefix=None):
+  cfg = { 'label' : label, 'public' : public, 'dataFormat' : fmt, 'dataIdentifier' : path }
+  if fmt == 'hdftable': cfg['dataTable'] = name
+  if meta is not None:   cfg['colMetaFile'] = meta
+  if prefix is not None: cfg['prefix'] = prefix
+  return cfg
+
+def generate(outDir,rows=100000,columns=50,shapes=30,eventRows=None,fmt='csv',prefix='bench',seed=0,force=False):
+  '''Write the synthetic sources with rows customers and columns features to outDir, along with the data_cfg.py
+     that configures them, unless outDir already has them. Returns the spec of the data, as saved in spec.json.'''
+  if eventRows is None: eventRows = max(1,rows // 5)
+  spec = { 'rows' : rows, 'columns' : columns, 'shapes' : shapes, 'eventRows' : eventRows, 'format' : fmt,
+           'prefix' : prefix, 'seed' : seed }
+  specPath = os.path.join(outDir,'spec.json')
+  if not force and os.path.exists(specPath) and os.path.exists(os.path.join(outDir,'data_cfg.py')):
+    with open(specPath) as f:
+      if json.load(f) == spec:
+        print('[synthetic.generate] Reusing the data in %s' % outDir)
+        return spec
+  if not os.path.isdir(outDir): os.makedirs(outDir)
+  start = currentTime()
+  rng = np.random.RandomState(seed)
+  ext = FORMATS.get(fmt)
+  if ext is None: raise ValueError('Unknown format %s, not one of %s' % (fmt,sorted(FORMATS.keys())))
+  path = lambda name: os.path.abspath(os.path.join(outDir,'%s.%s' % (name,ext)))
+  sources = {}
+  df = features(rng,rows,columns)
+  metaPath = os.path.abspath(os.path.join(outDir,'%s_META.csv' % prefix))
+  featureMeta(df).to_csv(metaPath)
+  writeTable(df,path(prefix),fmt,prefix)
+  sources[prefix] = sourceConfig(prefix,path(prefix),fmt,'Synthetic features',metaPath,public=True,prefix=prefix)
+  tables = dict(zip(['DictMembers','DictKwh','DictCenters','CategoryMapping'],shapeTables(rng,df['id'].values,shapes)))
+  tables['ResponseEvent'] = responseEvents(rng,df['id'].values,eventRows)
+  tables['Weather'] = weather(rng,df['zip5'].values)
+  for suffix,table in sorted(tables.items()):
+    name = prefix + suffix
+    writeTable(table,path(name),fmt,name)
+    sources[name] = sourceConfig(name,path(name),fmt,'Synthetic %s' % suffix)
+  with open(os.path.join(outDir,'data_cfg.py'),'w') as f:
+    f.write('# synthetic sources written by benchmark/synthetic.py\n')
+    f.write('reloadInterval = 0\n')
+    f.write('sources = %s\n' % pprint.pformat(sources))
+  with open(specPath,'w') as f: json.dump(spec,f,sort_keys=True)
+  print('[synthetic.generate] Wrote %d rows of %d features and %d related sources to %s in %0.1f seconds' %
+        (rows,len(df.columns),len(tables),outDir,currentTime() - start))
+  return spec
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser(description='Write synthetic VISDOM sources and their data_cfg.py to a directory')
+  parser.add_argument('outDir')
+  parser.add_argument('--rows',    type=int, default=100000)
+  parser.add_argument('--columns', type=int, default=50)
+  parser.add_argument('--shapes',  type=int, default=30)
+  parser.add_argument('--format',  default='csv', choices=sorted(FORMATS.keys()))
+  parser.add_argument('--prefix',  default='bench')
+  parser.add_argument('--seed',    type=int, default=0)
+  args = parser.parse_args()
+  generate(args.outDir,args.rows,args.columns,args.shapes,fmt=args.format,prefix=args.prefix,seed=args.seed,force=True)
@@ -0,0 +1,94 @@
+'''Column statistics catalogs of data sources.
+
+A catalog lists the columns of a loaded source with their dtype, count of non null values, null count and,
+for numeric columns, the mean, std, min, quartiles and max that pandas.DataFrame.describe reports. It is
+computed once per version of the source data and written as a json sidecar file, tagged with the fingerprint
+of the data it describes, so the column lists and stats the client asks for first on every page load are
+answered from the sidecar without loading the source.
+
+Usage:
+  cat = readCatalog('data/basic_features.csv.catalog.json',fingerprint) # None if missing or out of date
+  if cat is None:
+    cat = computeCatalog(df,fingerprint)
+    writeCatalog(cat,'data/basic_features.csv.catalog.json')
+  cat.columns    # the column names, in order
+  cat.describe() # like df.describe().transpose()
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+CATALOG_FORMAT = 1
+DESCRIBE = ['count','mean','std','min','25%','50%','75%','max']
+
+class Catalog(object):
+  '''The column statistics of one version of a source'''
+  def __init__(self,fingerprint,rows,stats):
+    self.fingerprint = fingerprint
+    self.rows        = rows
+    self.stats       = stats # list of dicts, one per column, in column order
+    self.columns     = [s['name'] for s in stats]
+
+  def describe(self):
+    '''The stats of the numeric columns in the layout of df.describe().transpose()'''
+    numeric = [s for s in self.stats if 'mean' in s]
+    return pd.DataFrame([[s[k] for k in DESCRIBE] for s in numeric],
+                        index=[s['name'] for s in numeric],columns=DESCRIBE,dtype=float)
+
+  def toJson(self):
+    return { 'format'      : CATALOG_FORMAT,
+             'fingerprint' : self.fingerprint,
+             'rows'        : self.rows,
+             'columns'     : self.stats }
+
+def columnStats(name,vals):
+  vals  = np.asarray(vals)
+  nulls = int(pd.isnull(vals).sum())
+  stats = { 'name' : name, 'dtype' : str(vals.dtype), 'count' : len(vals) - nulls, 'nulls' : nulls }
+  if vals.dtype.kind in 'iuf': # the columns describe() summarizes
+    valid = vals[~np.isnan(vals)] if vals.dtype.kind == 'f' else vals
+    stats['mean'] = stats['std'] = stats['min'] = stats['25%'] = stats['50%'] = stats['75%'] = stats['max'] = None
+    if len(valid) > 0:
+      valid = valid.astype(float)
+      stats['mean'] = float(valid.mean())
+      stats['std']  = float(valid.std(ddof=1)) if len(valid) > 1 else None
+      q = np.percentile(valid,[0,25,50,75,100]) # linear interpolation, as describe() uses
+      for k,v in zip(['min','25%','50%','75%','max'],q): stats[k] = float(v)
+  return stats
+
+def computeCatalog(df,fingerprint):
+  return Catalog(fingerprint,len(df.index),[columnStats(col,df[col].values) for col in df.columns])
+
+def writeCatalog(cat,path):
+  '''Write the catalog as json to path via a temporary file, so readers never see a partial catalog.
+     Returns True if the catalog was written.'''
+  tmpPath = '%s.tmp-%d' % (path,os.getpid())
+  try:
+    with open(tmpPath,'w') as f:
+      json.dump(cat.toJson(),f)
+    os.rename(tmpPath,path)
+    print('[catalog.writeCatalog] INFO: Wrote %d column catalog to %s' % (len(cat.columns),path))
+    return True
+  except (TypeError, ValueError, IOError, OSError) as e:
+    logging.warning('Could not write catalog to %s: %s' % (path,e))
+    print('[catalog.writeCatalog] WARNING: Could not write catalog to %s: %s' % (path,e))
+    try: os.remove(tmpPath)
+    except OSError: pass
+    return False
+
+def readCatalog(path,fingerprint):
+  '''Read the catalog at path, or return None if there is none or it describes data with another fingerprint'''
+  try:
+    with open(path) as f:
+      cat = json.load(f)
+  except (IOError, OSError, ValueError):
+    return None
+  if cat.get('format') != CATALOG_FORMAT or cat.get('fingerprint') != fingerprint:
+    print('[catalog.readCatalog] INFO: Catalog at %s is out of date' % path)
+    return None
+  return Catalog(cat['fingerprint'],cat['rows'],cat['columns'])
@@ -0,0 +1,215 @@
+'''Column indexes over loaded data sources that answer filter clauses without scanning the whole column.
+
+Which columns are indexed is controlled by an optional "index" column in the colMetaFile of a source,
+with a value of "sorted" for numeric columns filtered by ranges or "category" for categorical columns
+filtered by = and 'in'. If the colMetaFile has no "index" column, the int and float columns (the ones the
+filter sliders produce range clauses for) get sorted indexes and the category columns get category indexes.
+Indexes are built lazily, the first time a filter needs them, and belong to one loaded version of a source.
+Any column can also get a KeyIndex, which is built the first time a query joins another source on it.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+import threading
+
+import numpy as np
+import pandas as pd
+
+from timeit import default_timer as currentTime
+
+def indexKinds(meta):
+  '''Map column names to the kind of index they should have, based on the column metadata of a source'''
+  kinds = {}
+  if meta is None: return kinds
+  if 'index' in meta.columns:
+    for col,kind in meta['index'].items():
+      if pd.notnull(kind) and str(kind).strip() != '': kinds[col] = str(kind).strip()
+  else:
+    for col,typ in meta['type'].items():
+      if   typ in ('int','float'): kinds[col] = 'sorted'
+      elif typ == 'category':      kinds[col] = 'category'
+  return kinds
+
+class SortedIndex(object):
+  '''The permutation that sorts a numeric column, with NaNs last, so that a range of values is found by
+     two binary searches and its rows are a contiguous slice of the permutation.'''
+  def __init__(self,vals):
+    vals = np.asarray(vals,dtype=float)
+    self.n      = len(vals)
+    order       = np.argsort(vals,kind='mergesort')
+    self.order  = order.astype(np.int32) if self.n < 2**31 else order
+    self.values = vals[order]
+    self.nValid = self.n - int(np.isnan(self.values).sum()) # NaNs are sorted to the end and never match a range
+
+  def positions(self,lo=None,loInclusive=False,hi=None,hiInclusive=False):
+    '''The start and stop positions in the sorted order of the values within the (lo,hi) bounds,
+       where either bound can be None for an open ended range'''
+    valid = self.values[:self.nValid]
+    start = 0           if lo is None else int(np.searchsorted(valid,lo,side='left'  if loInclusive else 'right'))
+    stop  = self.nValid if hi is None else int(np.searchsorted(valid,hi,side='right' if hiInclusive else 'left'))
+    return start,max(start,stop)
+
+  def rangeMask(self,lo=None,loInclusive=False,hi=None,hiInclusive=False):
+    '''The boolean mask of the rows with values within the bounds, built by scattering whichever of the
+       selected or unselected rows is the smaller set'''
+    start,stop = self.positions(lo,loInclusive,hi,hiInclusive)
+    if stop - start <= self.n // 2:
+      mask = np.zeros(self.n,dtype=bool)
+      mask[self.order[start:stop]] = True
+    else:
+      mask = np.ones(self.n,dtype=bool)
+      mask[self.order[:start]] = False
+      mask[self.order[stop:]]  = False # includes the NaNs
+    return mask
+
+class CategoryIndex(object):
+  '''An inverted index of a categorical column: the row ids of each distinct value, stored as contiguous
+     slices of one permutation that groups the rows by value, so = and 'in' clauses become unions of 
+     precomputed row lists instead of string comparisons over every row.'''
+  def __init__(self,vals):
+    codes,uniques = pd.factorize(vals) # missing values get the code -1
+    self.n       = len(codes)
+    self.codes   = codes.astype(np.int32)
+    self.uniques = uniques
+    self.lookup  = dict([(str(v),i) for i,v in enumerate(uniques)])
+    order        = np.argsort(self.codes,kind='mergesort') # rows grouped by code, in row order within each group
+    self.order   = order.astype(np.int32) if self.n < 2**31 else order
+    self.nNull   = int((self.codes < 0).sum())             # the -1 codes sort first
+    counts       = np.bincount(self.codes[self.codes >= 0],minlength=len(uniques))
+    self.offsets = np.concatenate([[0],np.cumsum(counts)]) + self.nNull
+    self.valueOrder = None
+
+  def rows(self,value):
+    '''The row ids with the given (string) value'''
+    code = self.lookup.get(value)
+    if code is None: return self.order[:0]
+    return self.order[self.offsets[code]:self.offsets[code + 1]]
+
+  def mask(self,values):
+    '''The boolean mask of the rows with any of the given (string) values'''
+    mask = np.zeros(self.n,dtype=bool)
+    for value in values:
+      mask[self.rows(value)] = True
+    return mask
+
+  def sortOrder(self):
+    '''The codes in the sorted order of their values, which is the order groupby puts its groups in'''
+    if self.valueOrder is None: self.valueOrder = np.asarray(pd.Index(self.uniques).argsort())
+    return self.valueOrder
+
+  def grouped(self,mask=None):
+    '''The non null rows (or just those selected by the boolean mask) grouped by code, in row order within each
+       group, and the number of rows with each code'''
+    rows = self.order[self.nNull:]
+    if mask is not None: rows = rows[mask[rows]]
+    return rows,np.bincount(self.codes[rows],minlength=len(self.uniques))
+
+  def nullMask(self):
+    mask = np.zeros(self.n,dtype=bool)
+    mask[self.order[:self.nNull]] = True
+    return mask
+
+def isNumberKey(keys): return keys.dtype.kind in 'iuf'
+
+def isTextKey(keys):   return keys.dtype.kind in 'OSU'
+
+def numberKeys(keys):
+  '''Text keys as numbers, or NaN (which matches nothing) for those that aren't numbers'''
+  return pd.Index(pd.to_numeric(np.asarray(keys,dtype=object),errors='coerce'))
+
+class KeyIndex(object):
+  '''The row of each distinct value of a key column (its first row if the value is repeated), so the rows of a
+     source matching the keys of another are looked up in one pass of the hash table of a unique pandas Index,
+     for joins that gather the columns of one source at the rows matching another (see DataService.joinColumns)'''
+  def __init__(self,vals):
+    keys  = pd.Index(vals)
+    first = ~keys.duplicated() & ~keys.isna() # missing keys never match
+    self.nDuplicates = int(len(keys) - first.sum() - keys.isna().sum())
+    self.rows = np.flatnonzero(first)
+    self.keys = keys[first]
+    self.numbers = None
+
+  def lookup(self,vals):
+    '''The row of each of vals, or -1 for the values without one. Text and numeric keys are compared as numbers,
+       as the same key is often text in one source and a number in another (e.g. a zip5 category, which is
+       converted to zero padded strings at load time, joined to the numeric zip codes of another source).'''
+    vals = pd.Index(vals)
+    if isNumberKey(vals) and isTextKey(self.keys): return self.asNumbers().lookup(vals)
+    if isTextKey(vals) and isNumberKey(self.keys): vals = numberKeys(vals)
+    pos = self.keys.get_indexer(vals)
+    return np.where(pos >= 0,self.rows[pos],-1)
+
+  def asNumbers(self):
+    '''The KeyIndex of the keys as numbers, with the rows of this one'''
+    if self.numbers is None:
+      numbers = KeyIndex(numberKeys(self.keys))
+      numbers.rows = self.rows[numbers.rows]
+      self.numbers = numbers
+    return self.numbers
+
+class SourceIndexes(object):
+  '''The lazily built indexes of one loaded version of a source, identified by its version token'''
+  def __init__(self,df,meta,version=None):
+    self.df      = df
+    self.version = version
+    self.kinds   = indexKinds(meta)
+    self.indexes = {}
+    self.lock    = threading.Lock()
+
+  def get(self,kind,col,build):
+    key = (kind,col)
+    idx = self.indexes.get(key)
+    if idx is None:
+      with self.lock: # build each index once, even if several threads ask for it at the same time
+        idx = self.indexes.get(key)
+        if idx is None:
+          start = currentTime()
+          idx = build(self.df[col].values)
+          self.indexes[key] = idx
+          print('[indexes.SourceIndexes] INFO: Built %s index of %s in %0.3f seconds' % (kind,col,currentTime() - start))
+    return idx
+
+  def derived(self,key,build):
+    '''A structure derived from the whole df of this version of the source by build(df), built once and cached'''
+    result = self.indexes.get(key)
+    if result is None:
+      with self.lock:
+        result = self.indexes.get(key)
+        if result is None:
+          start = currentTime()
+          result = build(self.df)
+          self.indexes[key] = result
+          print('[indexes.SourceIndexes] INFO: Built %s in %0.3f seconds' % (key,currentTime() - start))
+    return result
+
+  def extend(self,key,names,build):
+    '''A dict of structures derived per name (i.e. per column) from the whole df, cached under key, where the
+       ones missing for names are built together by build(df,missing), which returns a dict of them'''
+    result = self.derived(key,lambda df: {})
+    missing = [name for name in names if name not in result]
+    if len(missing) > 0:
+      with self.lock:
+        missing = [name for name in names if name not in result]
+        if len(missing) > 0:
+          start = currentTime()
+          result.update(build(self.df,missing))
+          print('[indexes.SourceIndexes] INFO: Built %s of %d column(s) in %0.3f seconds' % (key,len(missing),currentTime() - start))
+    return result
+
+  def sorted(self,col):
+    '''The SortedIndex of col, or None if col is not configured for one (or isn't numeric)'''
+    if self.kinds.get(col) != 'sorted' or col not in self.df.columns: return None
+    if self.df[col].dtype.kind not in 'biuf': return None
+    return self.get('sorted',col,SortedIndex)
+
+  def category(self,col):
+    '''The CategoryIndex of col, or None if col is not configured for one (or is numeric, in which case 
+       = and 'in' clauses compare numbers rather than the string values the index is keyed on)'''
+    if self.kinds.get(col) != 'category' or col not in self.df.columns: return None
+    if self.df[col].dtype.kind in 'biufc': return None
+    return self.get('category',col,CategoryIndex)
+
+  def keys(self,col):
+    '''The KeyIndex of col, for joins on it, which any column can have'''
+    idx = self.get('key',col,KeyIndex)
+    if idx.nDuplicates > 0: print('[indexes.SourceIndexes] WARNING: %d repeated values of %s, which match their first row' % (idx.nDuplicates,col))
+    return idx
@@ -0,0 +1,132 @@
+'''Quantile bins of numeric columns, for /bin/ queries.
+
+/bin/n splits the values of a column into n bins with roughly equal numbers of values in each, with edges at the
+quantiles of the values (linearly interpolated, as pandas computes them), and returns the min, max and count of
+each bin keyed by its (low,high] bounds. The first bin is widened by 0.001 to include the smallest value.
+
+The exact bins are computed from the sorted values of the column: the edges are read off the sorted order by
+position and the bins are contiguous slices of it, found by binary search, so no groupby is needed. When the
+column has a SortedIndex (see indexes.py) its sorted order is reused, filtered by the query mask in one pass.
+
+Values repeated often enough to span several quantiles give several equal edges. These are merged, so a
+heavily repeated value gets a single bin of its own and fewer than n bins are returned.
+
+With /approx/ the bins of unfiltered columns come from a QuantileSketch, a mergeable summary of a fixed number of
+weighted points that is built once per loaded version of the source, a chunk of rows at a time. Approximate
+results have a count_error column bounding the difference between each count and the exact count of its bin.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+
+import numpy as np
+import pandas as pd
+
+SKETCH_SIZE  = 2000    # points kept per sketch, which bounds its rank error to about rows / SKETCH_SIZE
+SKETCH_CHUNK = 65536   # rows summarized at a time when building a sketch
+LOW_MARGIN   = 0.001   # the bins are (low,high] so the first edge is moved down to include the smallest value
+
+class QuantileSketch(object):
+  '''A mergeable summary of the distribution of n values: sorted points, each an actual value standing for the
+     weight values at or below it (and above the previous point). The number of values <= x estimated from the
+     points is within error of the true number.'''
+  def __init__(self,points,weights,error,lo,hi):
+    self.points  = points
+    self.weights = weights
+    self.ranks   = np.cumsum(weights)
+    self.n       = int(self.ranks[-1]) if len(weights) > 0 else 0
+    self.error   = error
+    self.lo      = lo # the exact min and max values
+    self.hi      = hi
+
+  def rank(self,x):
+    '''The estimated number of values <= each of x'''
+    pos = np.searchsorted(self.points,x,side='right')
+    return np.where(pos > 0,self.ranks[np.maximum(pos - 1,0)],0)
+
+  def quantiles(self,ps):
+    '''The value at each fraction ps of the way through the sorted values, to within error positions'''
+    target = np.floor(np.asarray(ps,dtype=float) * (self.n - 1))
+    out = self.points[np.minimum(np.searchsorted(self.ranks,target + 1,side='left'),len(self.points) - 1)]
+    out[np.asarray(ps) <= 0] = self.lo
+    out[np.asarray(ps) >= 1] = self.hi
+    return out
+
+  def compress(self,size=SKETCH_SIZE):
+    '''A sketch of at most size points with runs of adjacent points combined, which adds the largest combined
+       weight to the error'''
+    if len(self.points) <= size: return self
+    idx = np.searchsorted(self.ranks,np.arange(1,size + 1) * (float(self.n) / size),side='left')
+    idx = np.unique(np.minimum(idx,len(self.points) - 1))
+    weights = np.diff(np.concatenate([[0],self.ranks[idx]]))
+    return QuantileSketch(self.points[idx],weights,self.error + int(weights.max()),self.lo,self.hi)
+
+def sketchValues(vals,size=SKETCH_SIZE):
+  '''The QuantileSketch of an array of values, ignoring NaNs'''
+  vals = np.asarray(vals,dtype=float)
+  vals = np.sort(vals[~np.isnan(vals)])
+  if len(vals) == 0: return QuantileSketch(vals,np.zeros(0,dtype=np.int64),0,np.nan,np.nan)
+  if len(vals) <= size: return QuantileSketch(vals,np.ones(len(vals),dtype=np.int64),0,vals[0],vals[-1])
+  ends = np.ceil(np.arange(1,size + 1) * (float(len(vals)) / size)).astype(np.int64) - 1 # the last value of each run
+  weights = np.diff(np.concatenate([[-1],ends]))
+  return QuantileSketch(vals[ends],weights,int(weights.max()),vals[0],vals[-1])
+
+def mergeSketches(sketches,size=SKETCH_SIZE):
+  '''One sketch of all the values summarized by sketches, whose errors add up'''
+  sketches = [s for s in sketches if s.n > 0]
+  if len(sketches) == 0: return sketchValues([],size)
+  points  = np.concatenate([s.points for s in sketches])
+  weights = np.concatenate([s.weights for s in sketches])
+  order   = np.argsort(points,kind='mergesort')
+  merged  = QuantileSketch(points[order],weights[order],sum([s.error for s in sketches]),
+                           min([s.lo for s in sketches]),max([s.hi for s in sketches]))
+  return merged.compress(size)
+
+def sketchColumn(vals,size=SKETCH_SIZE,chunk=SKETCH_CHUNK):
+  '''The QuantileSketch of a column, built a chunk of rows at a time so only one chunk is sorted at once'''
+  vals = np.asarray(vals)
+  return mergeSketches([sketchValues(vals[i:i + chunk],size) for i in range(0,len(vals),chunk)],size)
+
+def binLabels(edges):
+  '''The labels pandas.cut gives the (low,high] bins between edges, as strings'''
+  return np.asarray(pd.cut(np.zeros(0),edges).categories.astype(str))
+
+def binEdges(quantiles):
+  edges = np.array(quantiles,dtype=float)
+  edges[0] = edges[0] - LOW_MARGIN
+  return np.unique(edges) # merge the equal edges of heavily repeated values
+
+def binFrame(labels,mins,maxs,counts):
+  qstats = pd.DataFrame({ 'min' : mins, 'max' : maxs, 'count' : counts },index=labels,columns=['min','max','count'])
+  qstats.index.name = 'bin_bounds'
+  return qstats
+
+def exactBins(sortedVals,n):
+  '''The n quantile bins of values already sorted in ascending order, without NaNs'''
+  m = len(sortedVals)
+  if m == 0: return binFrame([],[],[],np.zeros(0,dtype=np.int64))
+  h = np.linspace(0,1,n + 1) * (m - 1) # positions of the quantiles, interpolated between values
+  below = np.floor(h).astype(np.int64)
+  above = np.minimum(below + 1,m - 1)
+  edges = binEdges(sortedVals[below] + (h - below) * (sortedVals[above] - sortedVals[below]))
+  pos = np.searchsorted(sortedVals,edges,side='right') # bin i is sortedVals[pos[i]:pos[i+1]]
+  counts = np.diff(pos)
+  full = counts > 0
+  return binFrame(binLabels(edges)[full],sortedVals[pos[:-1][full]],sortedVals[pos[1:][full] - 1],counts[full])
+
+def approxBins(sketch,n):
+  '''The n quantile bins estimated from a QuantileSketch, with the bound on the error of each count. The min and
+     max of each bin are the smallest and largest sketch points in it (the exact min and max for the end bins).'''
+  if sketch.n == 0:
+    qstats = binFrame([],[],[],np.zeros(0,dtype=np.int64))
+    qstats['count_error'] = np.zeros(0,dtype=np.int64)
+    return qstats
+  edges = binEdges(sketch.quantiles(np.linspace(0,1,n + 1)))
+  pos = np.searchsorted(sketch.points,edges,side='right')
+  counts = np.diff(sketch.rank(edges))
+  full = counts > 0
+  mins = sketch.points[np.minimum(pos[:-1],len(sketch.points) - 1)]
+  maxs = sketch.points[np.maximum(pos[1:] - 1,0)]
+  mins[0],maxs[-1] = sketch.lo,sketch.hi
+  qstats = binFrame(binLabels(edges)[full],mins[full],maxs[full],counts[full])
+  qstats['count_error'] = 2 * sketch.error # each of the two edge ranks is off by at most error
+  return qstats
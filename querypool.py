@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+'''Optional multi-process execution of query work.
+
+Pandas groupby, eval and serialization hold the GIL, so the CherryPy http threads of one process
+share a single core. When queryWorkers is set in data_cfg, the server subscribes a QueryPoolPlugin
+that runs queries, batched histograms and the column catalogs in a pool of worker processes and the
+http threads only wait on their results, so the server process never loads a source itself.
+
+Each worker keeps its own DataSource caches (loaded sources, filter masks, compiled filters) warm
+for its lifetime. Workers attach to the data through the memory mapped snapshots written under
+snapshotDir (see snapshot.py), so all of them share one page cache copy of each source. Without
+snapshotDir every worker loads its own private copy of each source it touches.
+
+The stages of each task are timed in the worker and sent back with its result, so they show up in the
+Server-Timing header of the request and in the /query/stats of the server process (see querystats.py).
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+import multiprocessing
+import signal
+
+import pandas as pd
+
+import cherrypy
+from cherrypy.process import plugins
+
+import DataService as ds
+import querystats
+import reloader
+
+__all__ = ['QueryPoolPlugin', 'TASKS']
+
+def initWorker(preload):
+  # the parent engine handles ctrl-c and shuts the pool down cleanly
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  for dfName in preload: # warm up the caches of this worker
+    ds.DataSource().getdf(dfName)
+  if reloader.reloadInterval() > 0: reloader.watch(reloader.reloadInterval()) # this worker's copies of the data
+
+def runQuery(queryObj):
+  # serialize in the worker, so only the encoded bytes cross back to the http thread
+  df = ds.executeQuery(queryObj)
+  with querystats.stage('serialize'):
+    return ds.serialize(df,queryObj['fmt'])
+
+def runHistograms(sourceName,filters,hists):
+  hists = ds.leaveOneOutHistograms(sourceName,filters,hists)
+  with querystats.stage('serialize'):
+    return '[%s]' % ','.join([h.to_json(orient='split') for h in hists])
+
+def runCatalog(sourceName):
+  # the fingerprint and column names of the catalog of a source, which is loaded to compute it when
+  # the catalog sidecar file is missing or out of date
+  cat = ds.DataSource().getCatalog(sourceName)
+  return cat.fingerprint,cat.columns
+
+def runColInfo(sourceName):
+  # the manual column metadata of a source joined to the stats of its numeric columns, as json, along
+  # with the fingerprint of the catalog the stats came from
+  cat = ds.DataSource().getCatalog(sourceName)
+  with querystats.stage('describe'):
+    desc = cat.describe() # get basic stats for numerical columns
+  meta = ds.DataSource().getMetaData(sourceName) # get manual column metadata
+  if(meta is None): meta = pd.DataFrame(cat.columns,index=cat.columns,columns=['label'])
+  #meta = meta.join(desc)           # join on feature names, which are the indices
+  meta = pd.merge(meta, desc, left_index=True, right_index=True, how='left') # alternate join approach is more flexible
+  print(meta.head())
+  print('That was the head of the column metadata')
+  # must convert mixed data types (NaNs are considered floats or float64s)
+  # to single str dtype due to bug in pandas. the JS lient doesn't care whether strings or 
+  # mixed values are provided, so this work around is OK.
+  # see: https://github.com/pydata/pandas/issues/10289
+  return cat.fingerprint,meta.astype(str).to_json(orient='index')
+
+# the work that can be sent to the pool, by name
+TASKS = {
+  'query'      : runQuery,
+  'histograms' : runHistograms,
+  'catalog'    : runCatalog,
+  'colInfo'    : runColInfo,
+  'shape'      : ds.shapeSummary,
+  'response'   : ds.eventResponses,
+}
+
+def runTask(task,*args):
+  # time the task in this worker, and send what was timed back along with its result
+  return querystats.collect(TASKS[task],*args)
+
+class QueryPoolPlugin(plugins.SimplePlugin):
+  """A WSPBus plugin that runs query work in a pool of worker processes"""
+
+  def __init__(self, bus, workers, preload=None, timeout=None):
+    plugins.SimplePlugin.__init__(self, bus)
+    self.workers = workers
+    self.preload = preload or []
+    self.timeout = timeout
+    self.pool    = None
+
+  def start(self):
+    """
+    Called when the engine starts.
+    """
+    self.bus.log('Starting %d query worker processes' % self.workers)
+    self.pool = multiprocessing.Pool(self.workers, initWorker, (self.preload,))
+    self.bus.subscribe("execute-query", self.execute)
+  # fork the workers before the http server (priority 75) starts its threads
+  start.priority = 70
+
+  def stop(self):
+    """
+    Called when the engine stops.
+    """
+    self.bus.log('Stopping query worker processes')
+    self.bus.unsubscribe("execute-query", self.execute)
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+
+  def execute(self, task, *args):
+    """
+    Runs the named task in a worker process and returns its result.
+
+    Used as follow:
+    >>> body = cherrypy.engine.publish('execute-query', 'query', queryObj).pop()
+    """
+    result,collected = self.pool.apply_async(runTask, (task,) + args).get(self.timeout)
+    querystats.merge(collected) # into the request this thread is handling
+    return result
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+'''Per stage timing of query work, sent back in Server-Timing headers and summarized by /query/stats.
+
+Each request to a timed QueryService endpoint (see timed) gets a RequestTimer that collects the time spent in
+each stage of its work: the parse, etag, catalog, describe and serialize stages of the server and the load,
+filter, aggregate, hist, sample, sort, bin and materialize stages of DataService.executeQuery, among others. The
+stages are sent back in a Server-Timing header, which browser developer tools show alongside the request, and
+every stage, request and source a request read from is recorded in a LatencyHistogram, so /query/stats can
+report the p50, p95 and p99 latencies of each over the last statsWindow minutes (from data_cfg, 15 by default).
+Cache lookups report their hits and misses with hit(), which are counted since the server started.
+
+Streamed responses are serialized after their headers are sent, so their serialize stage only shows up in the
+stats. Work done in query worker processes (see querypool.py) is timed there, and what was collected is sent
+back with the result and merged into the request, so the stats of the server process cover it too.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+import collections
+import contextlib
+import functools
+import threading
+import time
+import types
+
+import numpy as np
+
+from timeit import default_timer as currentTime
+
+__all__ = ['LatencyHistogram', 'QueryStats', 'RequestTimer', 'Laps', 'STATS', 'stage', 'record', 'total', 'source',
+           'hit', 'timed', 'collect', 'merge']
+
+EDGES = 10 ** np.arange(-4.0,2.025,0.05) # upper edges of the latency buckets, in seconds: 0.1 ms to 100 s, 20 per decade
+SLOT_SECONDS = 60
+
+class LatencyHistogram(object):
+  '''Counts of latencies in log spaced buckets, one set per minute for the last minutes minutes, so percentiles
+     over a rolling window are estimated to within a bucket (about 12%) in constant memory'''
+  def __init__(self,minutes=15):
+    self.minutes = minutes
+    self.slots   = collections.deque() # [minute, counts, total seconds, max seconds], oldest first
+
+  def record(self,seconds,now=None):
+    minute = int((now if now is not None else time.time()) // SLOT_SECONDS)
+    if len(self.slots) == 0 or self.slots[-1][0] != minute:
+      self.slots.append([minute,np.zeros(len(EDGES) + 1,dtype=np.int64),0.0,0.0])
+      while self.slots[0][0] <= minute - self.minutes: self.slots.popleft()
+    slot = self.slots[-1]
+    slot[1][np.searchsorted(EDGES,seconds)] += 1 # the last bucket holds everything over the last edge
+    slot[2] += seconds
+    slot[3]  = max(slot[3],seconds)
+
+  def summary(self,now=None):
+    '''The count, mean, p50, p95, p99 and max in milliseconds of the latencies in the window, or None if empty'''
+    minute = int((now if now is not None else time.time()) // SLOT_SECONDS)
+    live = [slot for slot in self.slots if slot[0] > minute - self.minutes]
+    if len(live) == 0: return None
+    counts = np.sum([slot[1] for slot in live],axis=0)
+    n = int(counts.sum())
+    if n == 0: return None
+    longest = max([slot[3] for slot in live])
+    cum = np.cumsum(counts)
+    pct = lambda p: min(EDGES[min(int(np.searchsorted(cum,p * n)),len(EDGES) - 1)],longest) # the upper edge of its bucket
+    return { 'count' : n,
+             'mean'  : 1000.0 * sum([slot[2] for slot in live]) / n,
+             'p50'   : 1000.0 * pct(0.50),
+             'p95'   : 1000.0 * pct(0.95),
+             'p99'   : 1000.0 * pct(0.99),
+             'max'   : 1000.0 * longest }
+
+class QueryStats(object):
+  '''The process wide latency histograms, keyed by kind ('endpoint', 'stage' or 'source') and name, and the
+     hit and miss counts of each cache'''
+  def __init__(self,minutes=15):
+    self.minutes   = minutes
+    self.latencies = {}
+    self.caches    = {}
+    self.started   = time.time()
+    self.lock      = threading.Lock()
+
+  def record(self,kind,name,seconds):
+    with self.lock:
+      hist = self.latencies.get((kind,name))
+      if hist is None:
+        hist = LatencyHistogram(self.minutes)
+        self.latencies[(kind,name)] = hist
+      hist.record(seconds)
+
+  def hit(self,cache,hits=0,misses=0):
+    with self.lock:
+      counts = self.caches.setdefault(cache,[0,0])
+      counts[0] += hits
+      counts[1] += misses
+
+  def summary(self):
+    with self.lock:
+      out = { 'windowMinutes' : self.minutes, 'since' : self.started, 'endpoints' : {}, 'stages' : {}, 'sources' : {},
+              'caches' : {} }
+      for (kind,name),hist in self.latencies.items():
+        summary = hist.summary()
+        if summary is not None: out[kind + 's'][name] = summary
+      for cache,(hits,misses) in self.caches.items():
+        out['caches'][cache] = { 'hits' : hits, 'misses' : misses,
+                                 'hitRate' : float(hits) / (hits + misses) if hits + misses > 0 else None }
+    return out
+
+STATS = QueryStats()
+
+class RequestTimer(object):
+  '''The stages, sources and cache counts of one request, in the order they happened'''
+  def __init__(self,endpoint):
+    self.endpoint = endpoint
+    self.start    = currentTime()
+    self.stages   = []
+    self.sources  = []
+    self.caches   = {}
+
+  def header(self):
+    '''The Server-Timing header value of the stages so far, with repeated stages summed, and the total'''
+    totals = collections.OrderedDict()
+    for name,seconds in self.stages: totals[name] = totals.get(name,0.0) + seconds
+    totals['total'] = currentTime() - self.start
+    return ', '.join(['%s;dur=%0.1f' % (name,1000.0 * seconds) for name,seconds in totals.items()])
+
+  def collected(self):
+    return { 'stages' : list(self.stages), 'sources' : list(self.sources), 'caches' : dict(self.caches) }
+
+  def finish(self):
+    seconds = currentTime() - self.start
+    STATS.record('endpoint',self.endpoint,seconds)
+    for name in self.sources: STATS.record('source',name,seconds)
+
+  def stream(self,chunks):
+    '''Pass the chunks of a streamed response through, timing the making of them as its serialize stage, and
+       finish once the last one has been sent'''
+    chunks  = iter(chunks)
+    seconds = 0.0
+    try:
+      while True:
+        start = currentTime()
+        try:     chunk = next(chunks)
+        except StopIteration: break
+        finally: seconds += currentTime() - start
+        yield chunk
+    finally:
+      STATS.record('stage','serialize',seconds)
+      self.finish()
+
+local = threading.local()
+
+def current():
+  return getattr(local,'timer',None)
+
+def record(name,seconds):
+  '''Record that the stage name took seconds, for the current request (if any) and the stats'''
+  STATS.record('stage',name,seconds)
+  timer = current()
+  if timer is not None: timer.stages.append((name,seconds))
+
+@contextlib.contextmanager
+def stage(name):
+  '''A with block that records the time spent in it as the stage name'''
+  start = currentTime()
+  try:     yield
+  finally: record(name,currentTime() - start)
+
+class Laps(object):
+  '''Times consecutive stages without wrapping each one in a with block: lap(name) records the time since the
+     previous lap (or since the Laps were made) as the stage name'''
+  def __init__(self):
+    self.last = currentTime()
+
+  def lap(self,name):
+    now = currentTime()
+    record(name,now - self.last)
+    self.last = now
+
+def total(name,seconds):
+  '''Record the total time of a call to name. Within a request that is part of the time of its endpoint, so only
+     calls made outside of any request (like warm ups and benchmarks) are recorded, as an endpoint of their own.'''
+  if current() is None: STATS.record('endpoint',name,seconds)
+
+def source(name):
+  '''Note that the current request read the source name, so its latency counts towards that source'''
+  timer = current()
+  if timer is not None and name not in timer.sources: timer.sources.append(name)
+
+def hit(cache,isHit):
+  '''Count a hit (or a miss if not isHit) of cache'''
+  STATS.hit(cache,int(isHit),int(not isHit))
+  timer = current()
+  if timer is not None:
+    counts = timer.caches.setdefault(cache,[0,0])
+    counts[0 if isHit else 1] += 1
+
+def collect(fn,*args):
+  '''Run fn(*args) with a timer of its own, as query workers do, and return its result and what the timer
+     collected, for merge() in the process that handles the request'''
+  previous  = current()
+  local.timer = RequestTimer(fn.__name__)
+  try:
+    result = fn(*args)
+    return result,local.timer.collected()
+  finally:
+    local.timer = previous
+
+def merge(collected):
+  '''Add the stages, sources and cache counts collected by another process to the current request and the stats'''
+  for name,seconds in collected['stages']: record(name,seconds)
+  for name in collected['sources']: source(name)
+  for cache,(hits,misses) in collected['caches'].items():
+    STATS.hit(cache,hits,misses)
+    timer = current()
+    if timer is not None:
+      counts = timer.caches.setdefault(cache,[0,0])
+      counts[0] += hits
+      counts[1] += misses
+
+def timed(endpoint):
+  '''Decorate a CherryPy handler to time its requests as endpoint, with a Server-Timing header of their stages.
+     Streamed responses are finished when their last chunk is sent.'''
+  def decorate(handler):
+    @functools.wraps(handler)
+    def wrapper(*args,**kwargs):
+      import cherrypy
+      previous = current()
+      timer = RequestTimer(endpoint)
+      local.timer = timer
+      streamed = False
+      try:
+        result = handler(*args,**kwargs)
+        if isinstance(result,types.GeneratorType):
+          streamed = True
+          return timer.stream(result)
+        return result
+      finally: # also for the HTTPRedirect of a 304 and for errors
+        local.timer = previous
+        cherrypy.response.headers['Server-Timing'] = timer.header()
+        if not streamed: timer.finish()
+    return wrapper
+  return decorate
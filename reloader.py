@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+'''Hot reload of data sources whose data has changed since they were loaded.
+
+Every reloadInterval seconds (from data_cfg, 0 by default, which turns it off) the fingerprint of each loaded
+source is compared to the one it was loaded with: the size and modification time of its data and colMetaFile
+files, plus the result of its optional 'versionQuery' for sql and sqlite sources (see ds.sourceFingerprint).
+A changed source is loaded again in the background while queries keep using the loaded version, and the new
+version is then swapped in and the filter masks, indexes, histograms and catalog of the old one are dropped
+(see ds.DataSource.reload). Query results are cached by ETags built from the version token, so they are
+revalidated against the new version without any further invalidation.
+
+The server process runs the checks in a ReloadPlugin. Query worker processes (see querypool.py) each hold their
+own copy of the data, so each runs the checks in a watch thread of its own. With snapshotDir set, the first
+process to reload a source writes its new snapshot and the others map it.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+import threading
+import time
+import traceback
+
+from cherrypy.process import plugins
+
+import DataService as ds
+
+__all__ = ['ReloadPlugin', 'reloadChanged', 'watch']
+
+def reloadInterval():
+  return getattr(ds.data_cfg, 'reloadInterval', 0)
+
+def reloadChanged():
+  '''Reload every loaded source whose data has changed, one at a time. Returns the names of the reloaded sources.'''
+  reloaded = []
+  for name in list(ds.DataSource.memCache.keys()):
+    try:
+      if ds.DataSource().isPushedDown(name) or not ds.DataSource().isStale(name): continue
+      ds.DataSource().reload(name)
+      reloaded.append(name)
+    except Exception:
+      # the loaded version stays in use and the reload is tried again at the next check
+      print('[reloader.reloadChanged] ERROR: Could not reload %s' % name)
+      traceback.print_exc()
+  return reloaded
+
+class ReloadPlugin(plugins.Monitor):
+  """A WSPBus plugin that reloads changed data sources in a background thread"""
+
+  def __init__(self, bus, frequency=60):
+    plugins.Monitor.__init__(self, bus, reloadChanged, frequency=frequency, name='SourceReloader')
+
+def watch(frequency):
+  '''Start a daemon thread that reloads changed sources every frequency seconds, for processes without an engine'''
+  def run():
+    while True:
+      time.sleep(frequency)
+      reloadChanged()
+  thread = threading.Thread(target=run, name='reloader')
+  thread.daemon = True
+  thread.start()
+  return thread
@@ -0,0 +1,154 @@
+'''Columnar snapshots of loaded data sources.
+
+A snapshot is a directory holding one .npy file per column plus a manifest.json that describes the columns,
+the index, and the fingerprint of the source data the snapshot was made from. Numeric columns are memory mapped
+read only when a snapshot is read, so every server process on a machine shares one page cache copy of them
+and restarts skip the parse and clean up of the original csv, hdf5 or sql data. String (object) columns are
+stored as integer codes plus a json list of their distinct values and are rebuilt in memory on read.
+
+Usage:
+  writeSnapshot(df,'snapshots/basics',fingerprint)
+  df = readSnapshot('snapshots/basics',fingerprint) # None if there is no snapshot or it is out of date
+
+Processes that load a source at the same time take turns with snapshotLock, so the first one to get it writes the
+snapshot and the others map it instead of each loading the source and writing their own.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+import contextlib
+import errno
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+SNAPSHOT_FORMAT = 1
+MANIFEST        = 'manifest.json'
+LOCK_WAIT       = 600 # seconds to wait for another process to write a snapshot, and after which its lock is stale
+
+def writeSnapshot(df,path,fingerprint):
+  '''Write df as a columnar snapshot to the directory path, replacing any existing snapshot there.
+     The snapshot is written to a temporary directory and renamed into place so readers in other
+     processes never see a partial snapshot. Returns True if the snapshot was written.'''
+  tmpPath = '%s.tmp-%d' % (path,os.getpid())
+  try:
+    if os.path.exists(tmpPath): shutil.rmtree(tmpPath)
+    os.makedirs(tmpPath)
+    columns = []
+    for i,col in enumerate(df.columns):
+      vals = df[col].values
+      fName = 'col%05d.npy' % i
+      entry = { 'name' : col, 'file' : fName, 'dtype' : str(vals.dtype) }
+      if vals.dtype.kind in 'biufcmM':
+        np.save(os.path.join(tmpPath,fName),vals)
+        entry['kind'] = 'array'
+      else: # strings and other python objects are stored as codes into a list of their distinct values
+        codes,labels = pd.factorize(vals)
+        np.save(os.path.join(tmpPath,fName),codes.astype(np.int32))
+        entry['kind']   = 'codes'
+        entry['labels'] = labels.tolist() # raises TypeError below if the values can't be stored as json
+      columns.append(entry)
+    start = int(df.index[0]) if len(df.index) > 0 and df.index.dtype.kind in 'iu' else 0
+    if df.index.equals(pd.RangeIndex(start,start + len(df.index))): # i.e. the default 0..n-1 index
+      index = { 'kind' : 'range', 'start' : start, 'length' : len(df.index) }
+    else:
+      np.save(os.path.join(tmpPath,'index.npy'),df.index.values)
+      index = { 'kind' : 'array', 'file' : 'index.npy' }
+    manifest = { 'format'      : SNAPSHOT_FORMAT,
+                 'fingerprint' : fingerprint,
+                 'rows'        : len(df.index),
+                 'index'       : index,
+                 'columns'     : columns }
+    with open(os.path.join(tmpPath,MANIFEST),'w') as f:
+      json.dump(manifest,f)
+    if os.path.exists(path): shutil.rmtree(path) # readers that have already mapped the old files keep them
+    os.rename(tmpPath,path)
+    print('[snapshot.writeSnapshot] INFO: Wrote %d column snapshot to %s' % (len(columns),path))
+    return True
+  except (TypeError, ValueError, IOError, OSError) as e:
+    logging.warning('Could not write snapshot to %s: %s' % (path,e))
+    print('[snapshot.writeSnapshot] WARNING: Could not write snapshot to %s: %s' % (path,e))
+    shutil.rmtree(tmpPath,ignore_errors=True)
+    return False
+
+@contextlib.contextmanager
+def snapshotLock(path,wait=LOCK_WAIT):
+  '''Hold the lock file of the snapshot at path, waiting while another process holds it (i.e. is loading the source
+     and writing its snapshot). Yields whether the lock was taken: after wait seconds, or if the lock file can't be
+     created, the caller goes ahead without it, as writeSnapshot is safe to run in several processes at once.'''
+  lockPath = path + '.lock'
+  deadline = time.time() + wait
+  held = False
+  while not held:
+    try:
+      if not os.path.isdir(os.path.dirname(lockPath)): os.makedirs(os.path.dirname(lockPath))
+      os.close(os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+      held = True
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        print('[snapshot.snapshotLock] WARNING: Could not lock %s: %s' % (path,e))
+        break
+      try:
+        if time.time() - os.path.getmtime(lockPath) > LOCK_WAIT: # left behind by a process that died writing
+          print('[snapshot.snapshotLock] WARNING: Removing stale lock %s' % lockPath)
+          os.remove(lockPath)
+          continue
+      except OSError: # released in the meantime
+        continue
+      if time.time() > deadline: break
+      time.sleep(0.1)
+  try:
+    yield held
+  finally:
+    if held:
+      try: os.remove(lockPath)
+      except OSError: pass
+
+def readManifest(path):
+  try:
+    with open(os.path.join(path,MANIFEST)) as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError):
+    return None
+
+def readSnapshot(path,fingerprint):
+  '''Read the snapshot in the directory path as a DataFrame whose numeric columns are read only memory maps
+     of the snapshot files. Returns None if there is no snapshot, it was made from data with another fingerprint
+     or its files can't be read (e.g. another process replaced it after its manifest was read).'''
+  manifest = readManifest(path)
+  if manifest is None: return None
+  if manifest.get('format') != SNAPSHOT_FORMAT or manifest.get('fingerprint') != fingerprint:
+    print('[snapshot.readSnapshot] INFO: Snapshot at %s is out of date' % path)
+    return None
+  try:
+    return mapSnapshot(path,manifest)
+  except (IOError, OSError, ValueError) as e:
+    logging.warning('Could not read snapshot from %s: %s' % (path,e))
+    print('[snapshot.readSnapshot] WARNING: Could not read snapshot from %s: %s' % (path,e))
+    return None
+
+def mapSnapshot(path,manifest):
+  data = {}
+  names = []
+  for entry in manifest['columns']:
+    vals = np.load(os.path.join(path,entry['file']),mmap_mode='r')
+    if entry['kind'] == 'codes':
+      # the appended NaN is selected by the -1 code pandas.factorize uses for missing values
+      labels = np.empty(len(entry['labels']) + 1,dtype=object)
+      labels[:-1] = entry['labels']
+      labels[-1]  = np.nan
+      vals = labels.take(vals)
+    data[entry['name']] = vals
+    names.append(entry['name'])
+  index = manifest['index']
+  if index['kind'] == 'range':
+    idx = pd.RangeIndex(index['start'],index['start'] + index['length'])
+  else:
+    idx = pd.Index(np.load(os.path.join(path,index['file']),mmap_mode='r'))
+  print('[snapshot.readSnapshot] INFO: Mapped %d rows x %d columns from %s' % (manifest['rows'],len(names),path))
+  # copy=False keeps the memory maps rather than consolidating the columns into new in memory blocks
+  return pd.DataFrame(data,index=idx,columns=names,copy=False)
@@ -0,0 +1,239 @@
+'''Run queries against sql and sqlite sources in the database instead of in memory.
+
+Sources configured with 'pushdown' : True are not loaded into a DataFrame. Instead, each query is translated
+into a single SQL statement, with its values passed as bound parameters, and only the reduced result is read
+back. The statement can contain:
+
+- the /f/ filter tree, as a WHERE clause
+- the column projection
+- one /a/ aggregation (mean, sum, min, max or count), as a GROUP BY
+- /asc/ or /desc/ ordering (NULLs last), and /head/ as a LIMIT
+- /hist/ histograms, as a GROUP BY over the bin number of each row
+
+Queries that use anything else (eval columns, derived features from the colMetaFile, /cum/, /rnd/, /thin/,
+/tail/, /bin/ or several of the stages above at once) raise NotPushable and run the usual way, over the loaded
+source, as do queries that join other sources to it. Those queries, and everything else that needs the data in memory, load only the columns they use (see
+DataSource.getdf). Pushed down result rows are numbered from 0, rather than by their position in the table.
+
+sqlite sources keep one connection per thread. sql sources share the pooled SQLAlchemy engine of their URI.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+import DataService as ds
+import querystats
+
+__all__ = ['NotPushable', 'SqlSource', 'executeQuery']
+
+AGGREGATES = { 'mean' : 'AVG', 'avg' : 'AVG', 'sum' : 'SUM', 'min' : 'MIN', 'max' : 'MAX', 'count' : 'COUNT' }
+
+class NotPushable(Exception):
+  '''The query uses features that aren't translated to SQL, so it has to run over the loaded source'''
+  pass
+
+class SqlSource(object):
+  '''A sql or sqlite source that queries are pushed down to'''
+  def __init__(self,dfName,cfg,meta):
+    self.dfName = dfName
+    self.cfg    = cfg
+    self.local  = threading.local() # the sqlite connection of each thread
+    self.types  = {}
+    self.meta   = meta
+    if meta is not None:
+      self.types   = dict([(c,t) for c,t in meta['type'].items() if pd.notnull(t)])
+      self.derived = set([c for c,f in meta['formula'].items() if pd.notnull(f)])
+    else:
+      self.derived = set()
+    if cfg['dataFormat'] == 'sqlite':
+      self.relation = self.quote(cfg['dataTable'])
+    else: # the dataTable of sql sources is a select statement
+      self.relation = '(%s) src' % cfg['dataTable']
+
+  def quote(self,name):
+    if self.cfg['dataFormat'] == 'sql':
+      return ds.getEngine(self.cfg['dataIdentifier']).dialect.identifier_preparer.quote(name)
+    return '"%s"' % name.replace('"','""')
+
+  def floor(self,expr):
+    # CAST truncates, which is the floor for the non-negative values it is used on, and is the only option in
+    # older sqlite versions. Other databases may round in a CAST, so they use FLOOR.
+    if self.cfg['dataFormat'] == 'sqlite': return 'CAST(%s AS INTEGER)' % expr
+    return 'FLOOR(%s)' % expr
+
+  def read(self,sql,params):
+    # timed as the sql stage of the request (see querystats.py) rather than logged, as the params are user filter values
+    with querystats.stage('sql'):
+      if self.cfg['dataFormat'] == 'sqlite':
+        con = getattr(self.local,'con',None)
+        if con is None:
+          con = sqlite3.connect(self.cfg['dataIdentifier'])
+          self.local.con = con
+        return pd.read_sql(sql,con,params=params)
+      import sqlalchemy
+      with ds.getEngine(self.cfg['dataIdentifier']).connect() as con:
+        return pd.read_sql(sqlalchemy.text(sql),con,params=params)
+
+  def columns(self):
+    return self.read('SELECT * FROM %s WHERE 1=0' % self.relation,{}).columns.tolist()
+
+  def load(self,columns):
+    '''Read just the given columns of every row'''
+    return self.read('SELECT %s FROM %s' % (', '.join([self.quote(c) for c in columns]),self.relation),{})
+
+  def numeric(self,featureName):
+    return self.types.get(featureName) in ('int','float')
+
+class Statement(object):
+  '''Builds the SQL text of one query, collecting its bound parameters'''
+  def __init__(self,source):
+    self.source = source
+    self.params = {}
+
+  def param(self,value):
+    name = 'p%d' % len(self.params)
+    self.params[name] = value
+    return ':%s' % name
+
+  def column(self,name):
+    if name in self.source.derived: raise NotPushable('%s is a derived feature' % name)
+    return self.source.quote(name)
+
+  def value(self,featureName,value):
+    # = and 'in' values are strings, compared as numbers only on numeric columns like the in memory filters do,
+    # so text columns match '007' but not 7
+    if not self.source.numeric(featureName): return value
+    try:    return float(value)
+    except ValueError: raise NotPushable('%s is not a number' % value)
+
+  def where(self,node):
+    '''Translate a normalized filter node (see DataService.filterNode) to a boolean SQL expression.
+       NULLs never match a comparison but do match its negation, as NaNs do in memory.'''
+    kind = node[0]
+    if kind in ('and','or'):
+      return '(%s)' % (' %s ' % kind.upper()).join([self.where(child) for child in node[1]])
+    if kind == 'range':
+      featureName,lo,loInclusive,hi,hiInclusive = node[2:]
+      col = self.column(featureName)
+      terms = []
+      if lo is not None: terms.append('%s %s %s' % (col,'>=' if loInclusive else '>',self.param(lo)))
+      if hi is not None: terms.append('%s %s %s' % (col,'<=' if hiInclusive else '<',self.param(hi)))
+      return '(%s)' % ' AND '.join(terms)
+    featureName,opr,value,negate = node[2:]
+    col = self.column(featureName)
+    if opr == "'isnull'":
+      return '%s IS %sNULL' % (col,'NOT ' if negate else '')
+    if   opr in ds.RANGE_OPERATORS: expr = '%s %s %s' % (col,opr,self.param(value))
+    elif opr == '=':                expr = '%s = %s' % (col,self.param(self.value(featureName,value)))
+    elif opr == "'in'":
+      expr = '%s IN (%s)' % (col,','.join([self.param(self.value(featureName,v)) for v in value]))
+    if negate: return '(NOT (%s) OR %s IS NULL)' % (expr,col)
+    return expr
+
+def unsupported(query):
+  for key in ('cumsum','rnd','thin','tail','bin'):
+    if query.get(key) is not None: return key
+  if query.get('aggregator') is not None and len(query['aggregator']) > 1: return 'multiple aggregators'
+  if query.get('asc') is not None and query.get('desc') is not None: return 'asc and desc'
+  if query.get('histogram') is not None:
+    for key in ('aggregator','asc','desc','head'):
+      if query.get(key) is not None: return 'hist with %s' % key
+  return None
+
+def executeQuery(query,dfName):
+  '''Run the parsed query against the sql source dfName in the database and return the result like
+     DataService.executeQuery would, or raise NotPushable if it can't be translated'''
+  reason = unsupported(query)
+  if reason is not None: raise NotPushable(reason)
+  source = getSource(dfName)
+  stmt   = Statement(source)
+  cols   = query['dataSource'][dfName]
+  if cols is not None and cols[0] is None: cols = None
+  if cols is not None:
+    for col in cols:
+      if '(' in col: raise NotPushable('eval column %s' % col)
+  where = ''
+  if query.get('filter') is not None:
+    where = ' WHERE %s' % stmt.where(ds.compileFilters(query['filter']).root)
+  if query.get('histogram') is not None:
+    return histogram(source,stmt,where,cols,query['histogram'])
+  if query.get('aggregator') is not None:
+    agg,fns = list(query['aggregator'].items())[0]
+    fn = AGGREGATES.get(str(fns[0]).lower())
+    if fn is None: raise NotPushable('aggregate %s' % fns[0])
+    if cols is None: raise NotPushable('aggregate of all columns')
+    key = stmt.column(agg)
+    select = ['%s AS %s' % (key,source.quote('_key'))]
+    for col in cols:
+      if col == agg: select.append('COUNT(*) AS %s' % stmt.column(col)) # the size of each group, as in memory
+      else:          select.append('%s(%s) AS %s' % (fn,stmt.column(col),stmt.column(col)))
+    # groupby drops the rows without a key and sorts the groups
+    where = '%s %s IS NOT NULL' % (where + ' AND' if where else ' WHERE',key)
+    # ORDER BY the alias, as the name of the key column is also the alias of its COUNT(*)
+    sql = 'SELECT %s FROM %s%s GROUP BY %s ORDER BY %s' % (', '.join(select),source.relation,where,key,source.quote('_key'))
+    df = source.read(sql,stmt.params)
+    keys = df.pop('_key')
+    if source.types.get(agg) == 'category': # group on the strings the in memory source has, in their sort order
+      keys = ds.DataSource().cleanSource(pd.DataFrame({ agg : keys }),source.meta.loc[[agg],:])[agg]
+    df.index = pd.Index(keys.values,name=agg)
+    if source.types.get(agg) == 'category': df = df.sort_index()
+  else:
+    select = '*' if cols is None else ', '.join([stmt.column(col) for col in cols])
+    sql = 'SELECT %s FROM %s%s' % (select,source.relation,where)
+    for key in ('desc','asc'): # with NULLs last, as pandas sorts NaNs
+      if query.get(key) is not None: 
+        col = stmt.column(query[key])
+        sql += ' ORDER BY CASE WHEN %s IS NULL THEN 1 ELSE 0 END, %s %s' % (col,col,key.upper())
+    if query.get('head') is not None: sql += ' LIMIT %s' % stmt.param(int(query['head']))
+    df = source.read(sql,stmt.params)
+  meta = ds.DataSource().getMetaData(dfName)
+  if meta is not None: # the category columns are converted to strings and derived features computed as at load
+    derived = source.derived if cols is None and query.get('aggregator') is None else set()
+    keep = [(c in df.columns and c not in source.derived) or c in derived for c in meta.index]
+    if query.get('aggregator') is not None: # the key column holds the group sizes
+      keep = [k and c not in query['aggregator'] for k,c in zip(keep,meta.index)]
+    meta = meta.loc[keep,:]
+  return ds.DataSource().cleanSource(df,meta)
+
+def histogram(source,stmt,where,cols,hist):
+  '''Count the rows in each of n equal width bins, like DataService.histogram, by grouping on the bin number'''
+  if cols is None or len(cols) != 1: raise NotPushable('hist of %s' % cols)
+  col = stmt.column(cols[0])
+  n   = int(hist['bins'])
+  inRange = '%s %s IS NOT NULL' % (where + ' AND' if where else ' WHERE',col)
+  if hist['min'] is not None:
+    lo,hi = float(hist['min']),float(hist['max'])
+  else:
+    bounds = source.read('SELECT MIN(%s) AS lo, MAX(%s) AS hi FROM %s%s' % (col,col,source.relation,inRange),stmt.params)
+    lo,hi = bounds['lo'][0],bounds['hi'][0]
+    if lo is None or pd.isnull(lo): lo,hi = 0.0,1.0 # no values, where numpy uses a range of (0,1)
+    lo,hi = float(lo),float(hi)
+  if lo == hi: lo,hi = lo - 0.5,hi + 0.5 # as numpy does
+  width = (hi - lo) / n
+  inRange += ' AND %s >= %s AND %s <= %s' % (col,stmt.param(lo),col,stmt.param(hi))
+  binExpr = source.floor('(%s - %s) / %s' % (col,stmt.param(lo),stmt.param(width)))
+  sql = 'SELECT %s AS bin, COUNT(*) AS counts FROM %s%s GROUP BY %s' % (binExpr,source.relation,inRange,binExpr)
+  binned = source.read(sql,stmt.params)
+  counts = np.zeros(n,dtype=np.int64)
+  bins = np.clip(binned['bin'].values.astype(int),0,n - 1) # the max value is in the last bin, which is closed
+  np.add.at(counts,bins,binned['counts'].values.astype(np.int64))
+  edges = np.linspace(lo,hi,n + 1)
+  histdf = pd.DataFrame(counts,columns=['counts'])
+  histdf['bin_min'] = edges[:-1]
+  histdf['bin_max'] = edges[1:]
+  return histdf
+
+sources = {}
+sourcesLock = threading.Lock()
+
+def getSource(dfName):
+  with sourcesLock:
+    source = sources.get(dfName)
+    if source is None:
+      source = SqlSource(dfName,ds.DataSource().getCfg(dfName),ds.DataSource().getMetaData(dfName))
+      sources[dfName] = source
+  return source
@@ -615,57 +615,84 @@
       var filters = this._getFilters(),
           that = this;
 
-      var q = queue()
-        .awaitAll(function(error, updated) {
-          if (error) {
-            done && done(error);
-            return mda.logger.warn("[filters] error updating histogram(s):", error);
+      if (this._subsets) {
+        this._subsets.abort();
+        this._subsets = null;
+      }
+
+      // the active filters, each of which is applied to every histogram but its own
+      var active = [],
+          activeFilters = [];
+      filters.forEach(function(f) {
+        var list = that.getFilterList([f]);
+        if (list) {
+          active.push(f);
+          activeFilters.push(list);
+        }
+      });
+
+      var items = [],
+          updated = [];
+      this.root.selectAll(".stage, .filter")
+        .filter(function hasSubset(f) {
+          return f && f.column && (f.column.numeric || f.column.type === "date");
+        })
+        .each(function(filter) {
+          var node = d3.select(this)
+                .classed("loading", true),
+              exclude = active.indexOf(filter),
+              others = activeFilters.length - (exclude > -1 ? 1 : 0);
+
+          // don't hit the API if there's no filter to apply
+          if (!others) {
+            node.classed("loading", false);
+            filter.subset = filter.column.superset;
+            filter.render.subset(filter.subset);
+            that.renderFilter(node, filter);
+            updated.push(filter);
+            return;
           }
-          // mda.logger.log("[filters] updated", updated.length, "histogram(s)");
-          that.trigger("update", updated);
-          done && done(null, updated);
+
+          items.push({node: node, filter: filter, exclude: exclude});
         });
 
-      function updateFilter(filter, callback) {
-        if (filter._subset) {
-          filter._subset.abort();
-          filter._subset = null;
+      function finish(error) {
+        if (error) {
+          done && done(error);
+          return mda.logger.warn("[filters] error updating histogram(s):", error);
         }
+        // mda.logger.log("[filters] updated", updated.length, "histogram(s)");
+        that.trigger("update", updated);
+        done && done(null, updated);
+      }
 
-        var col = filter.column,
-            node = d3.select(this)
-              .classed("loading", true),
-            _filter = that.getFilterList(filters.filter(function(f) {
-              return f !== filter;
-            }));
-
-        // mda.logger.log("filter:", filter, _filter);
-
-        // don't hit the API if there's no filter to apply
-        if (!_filter || !Object.keys(_filter).length) {
-          node.classed("loading", false);
-          filter.subset = filter.column.superset;
-          filter.render.subset(filter.subset);
-          that.renderFilter(node, filter);
-          return callback(null, filter);
-        }
+      if (!items.length) return finish(null);
 
-        filter._subset = that.api.query({
-          columns: col.name,
-          filter: _filter,
-          sampling: {
-            type: "hist",
+      // request all of the leave-one-out histograms in one batch
+      this._subsets = this.api.query.histograms({
+        filters: activeFilters,
+        histograms: items.map(function(item) {
+          var col = item.filter.column;
+          return {
+            column: col.name,
             count: col.bins || that.options.histogramBins,
-            domain: [col.min, col.max]
-          }
-        }, function(error, res) {
-          node.classed("loading", false);
-          if (error) {
-            callback(error);
-            return mda.logger.error("[filters] histogram load error:", error);
-          }
+            domain: [col.min, col.max],
+            exclude: item.exclude
+          };
+        })
+      }, function(error, res) {
+        that._subsets = null;
+        items.forEach(function(item) {
+          item.node.classed("loading", false);
+        });
+        if (error) {
+          mda.logger.error("[filters] histogram load error:", error);
+          return finish(error);
+        }
 
-          var hist = mda.data.table(res);
+        items.forEach(function(item, i) {
+          var filter = item.filter,
+              hist = mda.data.table(res[i]);
           filter.subset = hist.map(function(d) {
             return {x: d.bin_min, y: d.counts};
           });
@@ -680,20 +707,12 @@
             filter.render.subset(filter.subset);
           }
 
-          that.renderFilter(node, filter);
-          filter._subset = null;
-
-          callback(null, filter);
+          that.renderFilter(item.node, filter);
+          updated.push(filter);
         });
-      }
 
-      this.root.selectAll(".stage, .filter")
-        .filter(function hasSubset(f) {
-          return f && f.column && (f.column.numeric || f.column.type === "date");
-        })
-        .each(function(filter) {
-          q.defer(updateFilter.bind(this), filter);
-        });
+        finish(null);
+      });
     },
 
     renderFilter: function(item, filter) {
@@ -53,11 +53,71 @@
     api.query = function(query, callback) {
       uri = api.queryUri(query);
       // logger.log(uri);
+      if (query.fmt === "npy") return api.getBinary(uri, function(error, data) {
+        return callback.call(this, error, data, query);
+      });
       return api.get(uri, function(error, data) {
         return callback.call(this, error, data, query);
       });
     };
 
+    // send a request by URI for a binary columnar (/fmt/npy) result with
+    // callback(error, data), where data is decoded by
+    // mda.api.query.decodeBinary()
+    api.getBinary = function(uri, callback) {
+      logger.info("api.getBinary(", uri, ")");
+      var req = d3.xhr(baseUrl + uri)
+            .responseType("arraybuffer")
+            .response(function(request) {
+              return mda.api.query.decodeBinary(request.response);
+            }),
+          abort = req.abort;
+      req.abort = function() {
+        logger.warn("ABORT api.getBinary(", uri, ")");
+        abort.call(req);
+      };
+      return req.get(callback);
+    };
+
+    // request a batch of leave-one-out histograms in a single POST, where
+    // query takes the form:
+    // {
+    //   filters: [filter]+,
+    //   histograms: [{column, count, domain, exclude}]+
+    // }
+    // and each histogram is filtered by every filter except filters[exclude].
+    // callback(error, [histogram table]+, query)
+    api.query.histograms = function(query, callback) {
+      if (!query.source) query.source = dataSource;
+      var body = {
+            source: query.source,
+            filters: query.filters.map(function(f) {
+              return mda.api.query.formatFilter(f);
+            }),
+            histograms: query.histograms.map(function(h) {
+              return {
+                column: h.column,
+                bins: h.count,
+                domain: h.domain,
+                exclude: h.exclude
+              };
+            })
+          },
+          uri = "query/histograms";
+      logger.info("api.query.histograms(", uri, ")");
+      var req = d3.json(baseUrl + uri)
+            .header("Content-Type", "application/json"),
+          abort = req.abort;
+      req.abort = function() {
+        logger.warn("ABORT api.query.histograms(", uri, ")");
+        abort.call(req);
+      };
+      req.post(JSON.stringify(body), function(error, data) {
+        return callback.call(this, error, data, query);
+      });
+      return req;
+    };
+
     api.query.shapes = function(query, callback) {
       if (!query.source) query.source = dataSource;
       var q = mda.api.query.formatShape(query),
@@ -359,6 +419,35 @@
       return uri.join("");
     },
 
+    // ArrayBuffer -> {columns, index, values}
+    // decodes a /fmt/npy response, where values maps each column name to
+    // the typed array of its values (or a plain array for string columns)
+    // and index is the array of row labels
+    decodeBinary: function(buffer) {
+      var headerLength = new DataView(buffer).getUint32(0, true),
+          header = JSON.parse(new TextDecoder("utf-8").decode(
+            new Uint8Array(buffer, 4, headerLength))),
+          start = 4 + headerLength,
+          values = {};
+      function column(entry) {
+        var type = BINARY_TYPES[entry.dtype],
+            array = new type(buffer, start + entry.offset,
+              entry.length / type.BYTES_PER_ELEMENT);
+        if (!entry.labels) return array;
+        return Array.prototype.map.call(array, function(code) {
+          return code < 0 ? null : entry.labels[code];
+        });
+      }
+      header.columns.forEach(function(name, i) {
+        values[name] = column(header.data[i]);
+      });
+      return {
+        columns: header.columns,
+        index: column(header.index),
+        values: values
+      };
+    },
+
     version: function(version) {
       switch (version) {
         case 1:
@@ -377,6 +466,13 @@
     }
   };
 
+  var BINARY_TYPES = {
+    float64: Float64Array,
+    float32: Float32Array,
+    int32: Int32Array,
+    uint8: Uint8Array
+  };
+
   function join(d, glue) {
     return Array.isArray(d) ? d.join(glue || mda.api.query.AND) : String(d);
   }
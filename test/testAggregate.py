@@ -0,0 +1,51 @@
+'''Checks that /a/ aggregations computed from the codes of a category index (see DataService.groupAggregate) match
+pandas groupby, with and without a filter.'''
+from __future__ import absolute_import
+from __future__ import print_function
+import unittest
+
+import numpy as np
+
+from testData import ds, loaded, query
+
+VALUES = ['kw_mean','nObs','f000'] # floats, ints and floats with NaNs
+
+class AggregateTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.df,cls.version,cls.srcIndexes = loaded()
+
+  def assertFramesClose(self,result,expected,msg):
+    self.assertEqual(list(result.index),list(expected.index),msg)
+    self.assertEqual(list(result.columns),list(expected.columns),msg)
+    for col in expected.columns:
+      self.assertEqual(result[col].dtype.kind,expected[col].dtype.kind,'%s %s' % (msg,col))
+      self.assertTrue(np.allclose(result[col].values.astype(float),expected[col].values.astype(float),equal_nan=True),
+                      '%s %s' % (msg,col))
+
+  def testGroupAggregate(self):
+    catIndex = self.srcIndexes.category('zip5')
+    self.assertIsNotNone(catIndex)
+    for rows in [None,np.flatnonzero(self.df['kw_mean'].values > 1)]:
+      subset = self.df if rows is None else self.df.iloc[rows]
+      for fn in ds.GROUP_REDUCTIONS:
+        result   = ds.groupAggregate(self.df,rows,catIndex,'zip5',fn,VALUES)
+        expected = subset.groupby('zip5')[VALUES].agg(fn)
+        self.assertFramesClose(result,expected,'%s over %s rows' % (fn,'all' if rows is None else len(rows)))
+
+  def testGroupSizes(self):
+    result   = ds.groupAggregate(self.df,None,self.srcIndexes.category('zip5'),'zip5','mean',['kw_mean'],size=True)
+    expected = self.df.groupby('zip5').size()
+    self.assertEqual(list(result['zip5']),list(expected.values))
+
+  def testQueries(self):
+    for f in ['','/f/kw_mean>1','/f/kw_mean>1000']:
+      subset = self.df[ds.runFilters(self.df,f[3:])] if f else self.df
+      for fn in ds.GROUP_REDUCTIONS:
+        result   = query('/s/bench|%s%s/a/zip5|%s' % ('+'.join(VALUES),f,fn))
+        expected = subset.groupby('zip5')[VALUES].agg(fn)
+        self.assertFramesClose(result,expected,'%s%s' % (fn,f))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,60 @@
+'''Shared set up of the checks in this directory: DataService configured with a small set of synthetic sources
+(see benchmark/synthetic.py), plus sqlite copies of the features for the pushdown checks.
+
+The checks are unittest modules. Run them from the visdom-web directory, all at once or one file at a time:
+  python -m unittest discover -s test -p "test*.py"
+  python test/testFilters.py
+
+The data is written once to visdom-test-data under the temp directory and reused by later runs.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import sqlite3
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path: sys.path.insert(0,REPO_DIR)
+
+from benchmark import synthetic
+from benchmark import suite
+
+DATA_DIR = os.path.join(tempfile.gettempdir(),'visdom-test-data')
+PREFIX   = 'bench'
+ROWS     = 5000
+
+synthetic.generate(DATA_DIR,rows=ROWS,columns=12,shapes=10,prefix=PREFIX,seed=1)
+ds = suite.importDataService(DATA_DIR)
+
+quiet = suite.Quiet # a with block that swallows what DataService prints
+
+def loaded(name=PREFIX):
+  '''The df, version and indexes of a loaded source'''
+  with quiet(): return ds.DataSource().getLoaded(name)
+
+def query(qs):
+  with quiet(): return ds.restQuery(qs)
+
+def sqliteSources():
+  '''Configure the features as two sqlite sources, one loaded into memory and one pushed down (see sqlpushdown.py),
+     along with a table of text codes like '007' that have no META type. Returns their names.'''
+  path = os.path.join(DATA_DIR,'%s.db' % PREFIX)
+  cfg = ds.DataSource.directory[PREFIX]
+  if not os.path.exists(path):
+    con = sqlite3.connect(path)
+    try:
+      pd.read_csv(cfg['dataIdentifier']).to_sql('features',con,index=False)
+      pd.DataFrame({ 'code' : ['007','7','8','abc'], 'n' : [7,7,8,9] }).to_sql('codes',con,index=False,dtype={ 'code' : 'TEXT' })
+      con.commit()
+    finally:
+      con.close()
+  sqlite = { 'label' : 'sqlite', 'dataFormat' : 'sqlite', 'dataIdentifier' : path }
+  ds.DataSource.directory['sqlMemory']      = dict(sqlite,dataTable='features',colMetaFile=cfg['colMetaFile'])
+  ds.DataSource.directory['sqlPushdown']    = dict(sqlite,dataTable='features',colMetaFile=cfg['colMetaFile'],pushdown=True)
+  ds.DataSource.directory['codesMemory']    = dict(sqlite,dataTable='codes')
+  ds.DataSource.directory['codesPushdown']  = dict(sqlite,dataTable='codes',pushdown=True)
+  return 'sqlMemory','sqlPushdown'
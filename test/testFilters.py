@@ -0,0 +1,77 @@
+'''Checks that filters answered from the column indexes (see indexes.py) select the same rows as a scan of the
+values, that FilterPlan collapses ranges without changing their result and that the MaskCache returns the masks
+it was given.'''
+from __future__ import absolute_import
+from __future__ import print_function
+import unittest
+
+import numpy as np
+
+from testData import ds, loaded
+
+FILTERS = [ 'kw_mean>1',
+            'kw_mean>=1&kw_mean<3',
+            'kw_mean>1&kw_mean<3&kw_mean>2',            # collapsed to one range
+            'nObs<=2000|nObs>8000',
+            'kw_mean!>2',                               # negated, which keeps the NaNs
+            'f000>0',                                   # a float column with NaNs
+            "f000'isnull'",
+            "f000!'isnull'",
+            'zip5=%(zip)s',
+            'zip5!=%(zip)s',
+            "zip5'in'[%(zip)s,%(other)s]",
+            "zip5!'in'[%(zip)s,%(other)s]",
+            "(kw_mean>1&nObs<5000)|zip5'in'[%(zip)s]",
+            'zip5=00000',                               # no rows
+            'kw_mean>1000' ]                            # no rows
+
+class FilterTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.df,cls.version,cls.srcIndexes = loaded()
+    zips = cls.df['zip5'].value_counts().index
+    cls.filters = [f % { 'zip' : zips[0], 'other' : zips[-1] } for f in FILTERS]
+
+  def testIndexedMatchesScan(self):
+    for f in self.filters:
+      plan = ds.compileFilters(f)
+      indexed = plan.evaluate(self.df,None,self.version,self.srcIndexes)
+      scanned = plan.evaluate(self.df,None,self.version,None)
+      self.assertTrue(np.array_equal(indexed,scanned),f)
+
+  def testMatchesPandas(self):
+    df = self.df
+    kw = df['kw_mean'].values
+    expected = { 'kw_mean>1&kw_mean<3&kw_mean>2' : (kw > 2) & (kw < 3),
+                 'kw_mean!>2'                    : ~(kw > 2),
+                 'f000>0'                        : (df['f000'] > 0).values,
+                 "f000'isnull'"                  : df['f000'].isnull().values,
+                 'nObs<=2000|nObs>8000'          : ((df['nObs'] <= 2000) | (df['nObs'] > 8000)).values }
+    for f,mask in expected.items():
+      self.assertTrue(np.array_equal(ds.runFilters(self.df,f,None,self.version,self.srcIndexes),mask),f)
+
+  def testRangeCollapse(self):
+    root = ds.compileFilters('kw_mean>1&kw_mean<3&kw_mean>2').root
+    self.assertEqual(root[0],'range')
+    self.assertIs(ds.compileFilters('kw_mean>2&kw_mean<3'),ds.compileFilters('kw_mean<3 & kw_mean>2'))
+
+  def testMaskCache(self):
+    cache = ds.MaskCache(1024 * 1024)
+    for f in self.filters:
+      first = ds.runFilters(self.df,f,cache,self.version,self.srcIndexes)
+      again = ds.runFilters(self.df,f,cache,self.version,self.srcIndexes)
+      self.assertTrue(np.array_equal(first,again),f)
+    stats = cache.stats()
+    self.assertGreater(stats['hits'],0)
+    self.assertLessEqual(stats['bytes'],stats['maxBytes'])
+
+  def testMaskCacheEvicts(self):
+    cache = ds.MaskCache(3 * (len(self.df.index) // 8 + 1)) # room for three masks
+    for f in self.filters[:6]: ds.runFilters(self.df,f,cache,self.version)
+    stats = cache.stats()
+    self.assertGreater(stats['evictions'],0)
+    self.assertLessEqual(stats['bytes'],stats['maxBytes'])
+
+if __name__ == "__main__":
+  unittest.main()
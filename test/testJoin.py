@@ -0,0 +1,49 @@
+'''Checks that joined sources (see DataService.joinColumns) add the columns a pandas left merge would, including
+when the key is a category in one source, converted to strings at load time, and a number in the other.'''
+from __future__ import absolute_import
+from __future__ import print_function
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import indexes
+from testData import loaded, query
+
+class JoinTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.df,cls.version,cls.srcIndexes = loaded()
+    cls.weather = loaded('benchWeather')[0]
+
+  def testCategoryKey(self):
+    self.assertFalse(pd.api.types.is_numeric_dtype(self.df['zip5'])) # the META type of zip5 is category
+    self.assertTrue(pd.api.types.is_numeric_dtype(self.weather['zip5']))
+    result = query('/s/bench*benchWeather@zip5|id+zip5+cdd+climate_zone')
+    self.assertEqual(len(result.index),len(self.df.index))
+    self.assertTrue(result['cdd'].notnull().all())
+    expected = pd.merge(self.df[['id','zip5']].assign(key=self.df['zip5'].astype(int)),
+                        self.weather[['zip5','cdd','climate_zone']].rename(columns={ 'zip5' : 'key' }),on='key',how='left')
+    self.assertTrue(np.allclose(result['cdd'].values,expected['cdd'].values))
+    self.assertEqual(list(result['climate_zone']),list(expected['climate_zone']))
+
+  def testNumericToCategoryKey(self):
+    result = query('/s/benchWeather*bench@zip5|zip5+cdd+kw_mean')
+    self.assertEqual(len(result.index),len(self.weather.index))
+    self.assertTrue(result['kw_mean'].notnull().all()) # every zip of the weather has customers
+
+  def testFilteredJoin(self):
+    result = query('/s/bench*benchWeather@zip5|kw_mean+cdd/f/cdd>1500&kw_mean>1')
+    self.assertGreater(len(result.index),0)
+    self.assertTrue((result['cdd'] > 1500).all() and (result['kw_mean'] > 1).all())
+
+  def testKeyLookup(self):
+    text = indexes.KeyIndex(np.array(['09461','9461','abc',None,'00123'],dtype=object))
+    self.assertEqual(list(text.lookup(np.array([9461,123,5]))),[0,4,-1]) # the first of the repeated keys
+    numbers = indexes.KeyIndex(np.array([9461,123]))
+    self.assertEqual(list(numbers.lookup(np.array(['09461','abc','123',None],dtype=object))),[0,-1,1,-1])
+    self.assertEqual(list(numbers.lookup(np.array([123.0,np.nan]))),[1,-1])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,174 @@
+'''Checks the loading of sources: that query ETags change when the data does, that column oriented sources only
+load the columns queries use (and derived features whose formulas fail don't make them load again and again), and
+that snapshots (see snapshot.py) are written once, mapped by later loads and fall back to the loaded data.'''
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import testData
+from testData import ds, quiet, query
+import snapshot
+
+try:
+  import pyarrow
+except ImportError:
+  pyarrow = None
+
+def copySource(name,dataDir,fmt='csv',meta=None):
+  '''Configure a copy of the bench features, in fmt, as the source name. Returns the path of its data.'''
+  cfg = ds.DataSource.directory[testData.PREFIX]
+  path = os.path.join(dataDir,'%s.%s' % (name,fmt))
+  if fmt == 'csv': shutil.copy(cfg['dataIdentifier'],path)
+  else:            pd.read_csv(cfg['dataIdentifier']).to_parquet(path)
+  metaPath = os.path.join(dataDir,'%s_META.csv' % name)
+  if meta is None: shutil.copy(cfg['colMetaFile'],metaPath)
+  else:            meta.to_csv(metaPath)
+  ds.DataSource.directory[name] = { 'label' : name, 'dataFormat' : fmt, 'dataIdentifier' : path, 'colMetaFile' : metaPath }
+  return path
+
+def etag(qs):
+  return ds.queryETag(ds.parseDesc(qs))
+
+class LoadingTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.dataDir = tempfile.mkdtemp(prefix='visdom-test-')
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.dataDir,ignore_errors=True)
+
+  def rewrite(self,path,scale):
+    '''Change the kw_mean values of a copied source, so its size and modification time change too'''
+    df = pd.read_csv(path)
+    df['kw_mean'] = df['kw_mean'] * scale
+    df.to_csv(path,index=False,float_format='%.9f')
+    st = os.stat(path)
+    os.utime(path,(st.st_atime,st.st_mtime + 10))
+
+  def testETagChangesWithData(self):
+    path = copySource('etagCopy',self.dataDir)
+    qs = '/s/etagCopy|kw_mean/f/kw_mean>1'
+    unloaded = etag(qs)
+    self.assertIsNotNone(unloaded)
+    self.rewrite(path,2.0)
+    self.assertNotEqual(etag(qs),unloaded) # fingerprinted from the files until it is loaded
+    before = query(qs)
+    loadedTag = etag(qs)
+    self.assertEqual(etag(qs),loadedTag)
+    self.rewrite(path,0.5)
+    self.assertTrue(ds.DataSource().isStale('etagCopy'))
+    with quiet(): ds.DataSource().reload('etagCopy')
+    self.assertNotEqual(etag(qs),loadedTag)
+    after = query(qs)
+    self.assertLess(len(after.index),len(before.index))
+
+  def testReloadedVersionsDiffer(self):
+    # version tokens start with the fingerprint of the data, so they don't repeat when the load count starts over
+    path = copySource('versionCopy',self.dataDir)
+    query('/s/versionCopy|kw_mean')
+    first = ds.DataSource().getVersion('versionCopy')
+    self.rewrite(path,3.0)
+    with quiet(): ds.DataSource().reload('versionCopy')
+    second = ds.DataSource().getVersion('versionCopy')
+    self.assertNotEqual(first.split('.')[0],second.split('.')[0])
+
+  @unittest.skipIf(pyarrow is None,'parquet sources need pyarrow')
+  def testColumnarLoadStaysProjected(self):
+    copySource('parquetCopy',self.dataDir,fmt='parquet')
+    qs = '/s/parquetCopy|kw_mean/f/nObs>1000'
+    self.assertIsNotNone(etag(qs))
+    result = query(qs)
+    self.assertIsNotNone(etag(qs)) # neither the ETag of a loaded source nor that of an unloaded one loads columns
+    loaded = ds.DataSource.memCache['parquetCopy']
+    self.assertEqual(sorted(loaded.columns),['kw_mean','nObs'])
+    self.assertEqual(len(result.index),int((loaded['nObs'] > 1000).sum()))
+
+  def testPushedDownLoadStaysProjected(self):
+    memory,pushdown = testData.sqliteSources()
+    query('/s/%s|kw_range/f/kw_mean>2' % pushdown) # a derived feature, so it loads the columns it uses
+    loaded = ds.DataSource.memCache[pushdown]
+    self.assertLess(len(loaded.columns),len(ds.DataSource().getColumns(pushdown)))
+    self.assertIn('kw_range',loaded.columns)
+
+  def testFailedFormula(self):
+    memory,pushdown = testData.sqliteSources()
+    cfg = ds.DataSource.directory[pushdown]
+    meta = pd.read_csv(cfg['colMetaFile'],index_col=0)
+    meta.loc['kw_bad','formula'] = 'kw_mean - not_a_column'
+    meta.loc['kw_bad','type'] = 'float'
+    metaPath = os.path.join(self.dataDir,'bad_META.csv')
+    meta.to_csv(metaPath)
+    ds.DataSource.directory['badFormula'] = dict(cfg,colMetaFile=metaPath)
+    self.assertEqual(len(query('/s/badFormula|kw_range/f/kw_mean>2').columns),1)
+    with self.assertRaises(KeyError): query('/s/badFormula|kw_bad/f/kw_mean>2') # rather than loading it forever
+    self.assertNotIn('kw_bad',ds.DataSource().getColumns('badFormula'))
+    self.assertEqual(len(query('/s/badFormula|kw_range+kw_mean/f/kw_mean>2').columns),2)
+
+class SnapshotTest(unittest.TestCase):
+
+  def setUp(self):
+    self.snapshotDir = tempfile.mkdtemp(prefix='visdom-snapshots-')
+    self.saved = getattr(ds.data_cfg,'snapshotDir',None)
+    ds.data_cfg.snapshotDir = self.snapshotDir
+    self.path = ds.DataSource().getSnapshotPath(testData.PREFIX)
+    self.readSnapshot = snapshot.readSnapshot
+
+  def tearDown(self):
+    snapshot.readSnapshot = self.readSnapshot
+    ds.data_cfg.snapshotDir = self.saved
+    shutil.rmtree(self.snapshotDir,ignore_errors=True)
+
+  def build(self):
+    with quiet(): return ds.DataSource().build(testData.PREFIX)
+
+  def assertSameFrame(self,a,b):
+    self.assertEqual(list(a.columns),list(b.columns))
+    self.assertEqual(list(a.index),list(b.index))
+    for col in a.columns:
+      if a[col].dtype.kind in 'iuf':
+        self.assertTrue(np.allclose(a[col].values.astype(float),b[col].values.astype(float),equal_nan=True),col)
+      else:
+        self.assertEqual([None if pd.isnull(v) else v for v in a[col]],[None if pd.isnull(v) else v for v in b[col]],col)
+
+  def testWriteThenMap(self):
+    self.build()
+    self.assertTrue(os.path.exists(os.path.join(self.path,snapshot.MANIFEST)))
+    self.assertFalse(os.path.exists(self.path + '.lock'))
+    mapped,fingerprint = self.build()
+    self.assertIsInstance(mapped['kw_mean'].values.base,np.memmap)
+    self.assertSameFrame(mapped,testData.loaded()[0])
+
+  def testMissingColumnFile(self):
+    df,fingerprint = self.build()
+    os.remove(os.path.join(self.path,'col00003.npy'))
+    with quiet(): self.assertIsNone(snapshot.readSnapshot(self.path,fingerprint))
+    self.assertSameFrame(self.build()[0],testData.loaded()[0]) # loaded again, and the snapshot rewritten
+    with quiet(): self.assertIsNotNone(snapshot.readSnapshot(self.path,fingerprint))
+
+  def testUnreadableSnapshot(self):
+    snapshot.readSnapshot = lambda path,fingerprint: None # e.g. replaced by another process as soon as it was written
+    df,fingerprint = self.build()
+    self.assertTrue(os.path.exists(os.path.join(self.path,snapshot.MANIFEST)))
+    self.assertSameFrame(df,testData.loaded()[0])
+
+  def testLock(self):
+    with quiet():
+      with snapshot.snapshotLock(self.path) as held:
+        self.assertTrue(held)
+        with snapshot.snapshotLock(self.path,wait=0.2) as other: self.assertFalse(other)
+        self.assertTrue(os.path.exists(self.path + '.lock'))
+      self.assertFalse(os.path.exists(self.path + '.lock'))
+      open(self.path + '.lock','w').close()
+      os.utime(self.path + '.lock',(0,0)) # left behind by a process that died
+      with snapshot.snapshotLock(self.path,wait=0.2) as held: self.assertTrue(held)
+
+if __name__ == "__main__":
+  unittest.main()
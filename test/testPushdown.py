@@ -0,0 +1,89 @@
+'''Checks that queries of a pushed down sqlite source (see sqlpushdown.py) return what the same queries return
+when the table is loaded into memory, and that those that can run in the database did.'''
+from __future__ import absolute_import
+from __future__ import print_function
+import sys
+import unittest
+
+import numpy as np
+
+import testData
+from testData import ds
+
+QUERIES = [ '/s/{source}|kw_mean+zip5/f/kw_mean>2',
+            "/s/{source}|kw_mean/f/(kw_mean>1&kw_mean<=3|zip5'in'[{zip},{other}])",
+            '/s/{source}|id+f000/f/f000!>0.5',
+            "/s/{source}|id/f/f000'isnull'",
+            "/s/{source}|id/f/f000!'isnull'",
+            '/s/{source}|id/f/zip5={zip}',
+            '/s/{source}|id/f/zip5!={zip}',
+            "/s/{source}|id/f/id'in'[5,7,9]",
+            '/s/{source}|kw_mean+zip5/a/zip5|mean',
+            '/s/{source}|kw_mean+nObs/f/kw_mean>1/a/zip5|count',
+            '/s/{source}|id+kw_mean/f/kw_mean>1/desc/kw_mean/head/7',
+            '/s/{source}|kw_mean/asc/kw_mean/head/5',
+            '/s/{source}|kw_mean/f/kw_mean>1/hist/20',
+            '/s/{source}|kw_mean/hist/10[0:5]' ]
+
+# queries that load the columns they use and run in memory, like those of derived features
+LOADED_QUERIES = [ '/s/{source}|kw_range/f/kw_mean>2', '/s/{source}|kw_mean/f/kw_mean>2/bin/10' ]
+
+CODE_QUERIES = [ '/s/{source}|code+n/f/code=007', '/s/{source}|code+n/f/code=7', "/s/{source}|code/f/code'in'[007,8]", '/s/{source}|code/f/n=7' ]
+
+class Capture(object):
+  '''Collect what is printed while queries run, to tell the pushed down ones from those run in memory'''
+  def __enter__(self):
+    self.stdout = sys.stdout
+    self.lines = []
+    sys.stdout = self
+    return self
+
+  def write(self,text): self.lines.append(text)
+
+  def flush(self): pass
+
+  def __exit__(self,*exc):
+    sys.stdout = self.stdout
+
+  def inMemory(self):
+    return 'Running in memory' in ''.join(self.lines)
+
+class PushdownTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.memory,cls.pushdown = testData.sqliteSources()
+    df,version,srcIndexes = testData.loaded()
+    zips = df['zip5'].value_counts().index
+    cls.params = { 'zip' : zips[0], 'other' : zips[-1] }
+
+  def assertSameResult(self,a,b,q):
+    if '/a/' not in q and '/hist/' not in q: # the row labels of a pushed down source are not those of the table
+      a,b = a.reset_index(drop=True),b.reset_index(drop=True)
+    self.assertEqual(list(a.columns),list(b.columns),q)
+    self.assertEqual(list(a.index),list(b.index),q)
+    for col in a.columns:
+      if a[col].dtype.kind in 'iuf':
+        self.assertTrue(np.allclose(a[col].values.astype(float),b[col].values.astype(float),equal_nan=True),'%s %s' % (q,col))
+      else:
+        self.assertEqual(list(a[col]),list(b[col]),'%s %s' % (q,col))
+
+  def check(self,memory,pushdown,q,pushed=True):
+    expected = testData.query(q.format(source=memory,**self.params))
+    q = q.format(source=pushdown,**self.params)
+    with Capture() as out:
+      result = ds.restQuery(q)
+    self.assertEqual(not out.inMemory(),pushed,q)
+    self.assertSameResult(expected,result,q)
+
+  def testQueries(self):
+    for q in QUERIES: self.check(self.memory,self.pushdown,q)
+
+  def testLoadedQueries(self):
+    for q in LOADED_QUERIES: self.check(self.memory,self.pushdown,q,pushed=False)
+
+  def testTextValues(self):
+    for q in CODE_QUERIES: self.check('codesMemory','codesPushdown',q)
+
+if __name__ == "__main__":
+  unittest.main()
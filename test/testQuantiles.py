@@ -0,0 +1,84 @@
+'''Checks that exact /bin/ quantile bins (see quantiles.py) match the pandas.cut bins they replaced and that the
+counts of approximate bins stay within the count_error they report.'''
+from __future__ import absolute_import
+from __future__ import print_function
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import testData
+import quantiles
+
+def cutBins(vals,n):
+  '''The quantile bins as they were computed with pandas.cut and groupby'''
+  vals = pd.Series(vals).dropna()
+  edges = np.percentile(vals.values,np.linspace(0,100,n + 1))
+  edges[0] = edges[0] - quantiles.LOW_MARGIN
+  edges = sorted(set(edges))
+  groups = vals.groupby(pd.cut(vals,edges))
+  qstats = pd.DataFrame({ 'min' : groups.min(), 'max' : groups.max(), 'count' : groups.count() },columns=['min','max','count'])
+  qstats.index = qstats.index.astype(str)
+  return qstats[qstats['count'] > 0]
+
+def samples():
+  rng = np.random.RandomState(2)
+  vals = { 'lognormal' : rng.lognormal(0.0,1.0,20000),
+           'repeated'  : rng.choice([0.0,0.0,0.0,1.0,2.5],20000) + np.where(rng.rand(20000) < 0.1,rng.rand(20000),0),
+           'ints'      : rng.randint(0,50,20000).astype(float),
+           'small'     : rng.normal(0.0,1.0,7) }
+  vals['nans'] = np.where(rng.rand(20000) < 0.2,np.nan,vals['lognormal'])
+  return vals
+
+class QuantileTest(unittest.TestCase):
+
+  def testExactBins(self):
+    for name,vals in samples().items():
+      valid = np.sort(vals[~np.isnan(vals)])
+      for n in [1,4,10,100]:
+        result   = quantiles.exactBins(valid,n)
+        expected = cutBins(vals,n)
+        msg = '%s in %d bins' % (name,n)
+        self.assertEqual(list(result.index),list(expected.index),msg)
+        self.assertEqual(list(result['count']),list(expected['count']),msg)
+        self.assertTrue(np.allclose(result['min'],expected['min']),msg)
+        self.assertTrue(np.allclose(result['max'],expected['max']),msg)
+
+  def testSketchRanks(self):
+    for name,vals in samples().items():
+      valid = np.sort(vals[~np.isnan(vals)])
+      sketch = quantiles.sketchColumn(vals,size=200,chunk=3000) # small enough to be lossy
+      self.assertEqual(sketch.n,len(valid),name)
+      xs = np.unique(np.concatenate([valid[::97],[valid[0] - 1,valid[-1]]]))
+      exact = np.searchsorted(valid,xs,side='right')
+      self.assertTrue(np.all(np.abs(sketch.rank(xs) - exact) <= sketch.error),name)
+
+  def testApproxBinsWithinError(self):
+    for name,vals in samples().items():
+      valid = np.sort(vals[~np.isnan(vals)])
+      sketch = quantiles.sketchColumn(vals,size=200,chunk=3000)
+      for n in [4,10,50]:
+        result = quantiles.approxBins(sketch,n)
+        msg = '%s in %d bins' % (name,n)
+        self.assertEqual(int(result['count'].sum()),len(valid),msg)
+        # the exact counts of the bins approxBins reports, between the same edges
+        edges = quantiles.binEdges(sketch.quantiles(np.linspace(0,1,n + 1)))
+        exact = np.diff(np.searchsorted(valid,edges,side='right'))
+        approx = np.diff(sketch.rank(edges))
+        self.assertEqual(list(result['count']),list(approx[approx > 0]),msg)
+        self.assertTrue(np.all(np.abs(approx - exact) <= 2 * sketch.error),msg)
+        self.assertTrue(np.all(result['count_error'] == 2 * sketch.error),msg)
+        self.assertEqual(result['min'].iloc[0],valid[0],msg)
+        self.assertEqual(result['max'].iloc[-1],valid[-1],msg)
+
+  def testBinQueries(self):
+    df,version,srcIndexes = testData.loaded()
+    for col in ['kw_mean','nObs','f000']:
+      result   = testData.query('/s/bench|%s/bin/10' % col)
+      expected = cutBins(df[col].values.astype(float),10)
+      self.assertEqual(list(result['count']),list(expected['count']),col)
+      approx = testData.query('/s/bench|%s/bin/10/approx' % col)
+      self.assertEqual(int(approx['count'].sum()),int(df[col].notnull().sum()),col)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,57 @@
+'''Checks that results streamed by DataService.serializeChunks are byte for byte the ones serialize encodes whole,
+in every format and chunk size, and that the npy format decodes back to the values of the result.'''
+from __future__ import absolute_import
+from __future__ import print_function
+import json
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from testData import ds, query
+
+FORMATS = [None,'csv','npy']
+
+class SerializeTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.frames = { 'filtered' : query('/s/bench|id+zip5+kw_mean+nObs+f000/f/kw_mean>1'),
+                   'all'      : query('/s/bench'),
+                   'grouped'  : query('/s/bench|kw_mean+nObs/a/zip5|mean'),
+                   'one'      : query('/s/bench|id+kw_mean/desc/kw_mean/head/1'),
+                   'empty'    : query('/s/bench|id+kw_mean/f/kw_mean>1000') }
+
+  def testChunksMatchWhole(self):
+    for name,df in self.frames.items():
+      for fmt in FORMATS:
+        whole = ds.serialize(df,fmt)
+        for chunkRows in [1 if len(df.index) < 100 else 97,1000,len(df.index) + 1]:
+          chunks = list(ds.serializeChunks(df,fmt,chunkRows))
+          self.assertTrue(all([isinstance(chunk,bytes) for chunk in chunks]))
+          self.assertEqual(b''.join(chunks),whole,'%s as %s in chunks of %d' % (name,fmt,chunkRows))
+
+  def testJson(self):
+    df = self.frames['filtered']
+    decoded = json.loads(b''.join(ds.serializeChunks(df,None,100)).decode('utf-8'))
+    self.assertEqual(decoded['columns'],list(df.columns))
+    self.assertEqual(len(decoded['data']),len(df.index))
+
+  def testNpy(self):
+    df = self.frames['filtered']
+    body = ds.serialize(df,'npy')
+    n = int(np.frombuffer(body[:4],dtype='<u4')[0])
+    header = json.loads(body[4:4 + n].decode('utf-8'))
+    self.assertEqual(header['rows'],len(df.index))
+    self.assertEqual(header['columns'],list(df.columns))
+    start = 4 + n
+    for col,entry in zip(df.columns,header['data']):
+      vals = np.frombuffer(body[start + entry['offset']:start + entry['offset'] + entry['length']],dtype=entry['dtype'])
+      if 'labels' in entry: # string columns are codes into their labels
+        labels = np.array(entry['labels'] + [None],dtype=object)
+        self.assertEqual(list(labels[vals]),[None if pd.isnull(v) else v for v in df[col].values],col)
+      else:
+        self.assertTrue(np.allclose(vals.astype(float),df[col].values.astype(float),equal_nan=True),col)
+
+if __name__ == "__main__":
+  unittest.main()
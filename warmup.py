@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+'''Background warm up of data sources when the server starts.
+
+Sources are otherwise loaded by the first request that needs them, which then waits for the whole parse and
+clean up of the source while every other request for it waits behind it. The WarmupPlugin loads the sources
+configured with 'preload' : True in background threads as soon as the engine starts, in order of their optional
+'priority' (lower numbers first, like CherryPy's own priorities), using warmupThreads threads from data_cfg.
+Once a source is loaded its unfiltered filter panel histograms are precomputed too (see ds.supersetHistograms).
+
+When queries run in worker processes (see querypool.py) the workers preload the data themselves, so the server
+process only has a worker warm the column catalogs the client asks for first (see catalog.py).
+
+The progress is reported by ds.sourceStatus(), which the /query/status endpoint serves as a readiness probe.
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+import threading
+import traceback
+
+from six.moves import queue
+
+import cherrypy
+from cherrypy.process import plugins
+
+import DataService as ds
+
+__all__ = ['WarmupPlugin', 'preloadSources']
+
+def preloadSources():
+  '''The names of the sources configured with 'preload' : True, in the order they should be loaded'''
+  sources = [(cfg.get('priority',50),name) for name,cfg in ds.DataSource.directory.items() if cfg.get('preload',False)]
+  return [name for priority,name in sorted(sources)]
+
+class WarmupPlugin(plugins.SimplePlugin):
+  """A WSPBus plugin that loads data sources in background threads when the engine starts"""
+
+  def __init__(self, bus, sources, threads=1, loadData=True):
+    plugins.SimplePlugin.__init__(self, bus)
+    self.sources  = sources
+    self.threads  = max(1,threads)
+    self.loadData = loadData
+    self.pending  = None
+    self.done     = set()
+    self.workers  = []
+
+  def start(self):
+    """
+    Called when the engine starts.
+    """
+    self.bus.log('Warming up %d data sources with %d threads' % (len(self.sources),self.threads))
+    self.pending = queue.Queue()
+    self.done    = set()
+    for name in self.sources: self.pending.put(name) # in priority order
+    self.workers = [threading.Thread(target=self.run, args=(self.pending,), name='warmup-%d' % i) for i in range(self.threads)]
+    for worker in self.workers:
+      worker.daemon = True # don't hold up a shut down for a load in progress
+      worker.start()
+  # after the http server (priority 75) is up, so the readiness endpoint answers while sources load
+  start.priority = 80
+
+  def run(self,pending):
+    while True:
+      try: name = pending.get_nowait()
+      except queue.Empty: return
+      try:
+        if self.loadData:
+          ds.DataSource().getdf(name)
+          if not ds.DataSource().isColumnar(name): ds.supersetHistograms(name) # for the filter panel
+          ds.DataSource().getCatalog(name)
+        else: # in a worker process, which holds the data
+          self.bus.publish('execute-query', 'catalog', name)
+        self.bus.log('Warmed up %s' % name)
+      except Exception:
+        # the state of the source is 'failed' and the first request for it will try again
+        self.bus.log('Could not warm up %s' % name, traceback=True)
+      finally:
+        self.done.add(name)
+
+  def stop(self):
+    """
+    Called when the engine stops.
+    """
+    # sources already loading finish in the background, but no new ones are started
+    try:
+      while self.pending is not None: self.pending.get_nowait()
+    except queue.Empty: pass
+    self.workers = []
+
+  def ready(self):
+    '''Whether every source has been warmed up (or failed to be)'''
+    return len(self.done) == len(self.sources)